@@ -0,0 +1,100 @@
+"""
+Análises do histórico de empréstimos para os relatórios anuais.
+
+Os empréstimos não excluídos são lidos numa única consulta, só com as colunas
+necessárias, para um DataFrame. Todas as contas são feitas por coluna, com
+pandas e NumPy, sem montar objetos do ORM nem calcular datas linha a linha.
+"""
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import String, select, type_coerce
+
+from models import Emprestimo, session
+
+COLUNAS_DATAS = ['emprestado_em', 'devolucao_em', 'devolvido_em']
+FAIXAS_DURACAO = [0, 7, 14, 21, 30, 60, 90, np.inf]
+PERCENTIS_ATRASO = [50, 75, 90, 95, 99]
+
+
+def extrair(inicio: date | None = None, fim: date | None = None) -> pd.DataFrame:
+    # As datas vêm como texto e são convertidas de uma vez pelo pandas, em vez
+    # de passarem uma a uma pelo conversor de datas do SQLAlchemy
+    consulta = (
+        select(
+            Emprestimo.leitor_id,
+            *[type_coerce(getattr(Emprestimo, coluna), String).label(coluna) for coluna in COLUNAS_DATAS],
+            Emprestimo.vezes_adiado
+        )
+        .where(~Emprestimo.excluidos)
+    )
+    if inicio is not None:
+        consulta = consulta.where(Emprestimo.emprestado_em >= inicio)
+    if fim is not None:
+        consulta = consulta.where(Emprestimo.emprestado_em <= fim)
+
+    dados = pd.read_sql(consulta, session.connection())
+    for coluna in COLUNAS_DATAS:
+        dados[coluna] = pd.to_datetime(dados[coluna], format='ISO8601')
+    dados['vezes_adiado'] = dados['vezes_adiado'].fillna(0).astype(int)
+    return dados
+
+
+def _devolvidos(dados: pd.DataFrame) -> pd.DataFrame:
+    return dados[dados['devolvido_em'].notna()]
+
+
+def duracao(dados: pd.DataFrame) -> pd.DataFrame:
+    """Quantos empréstimos devolvidos duraram cada faixa de dias."""
+    devolvidos = _devolvidos(dados)
+    dias = (devolvidos['devolvido_em'] - devolvidos['emprestado_em']).dt.days
+    faixas = pd.cut(dias, FAIXAS_DURACAO, right=False)
+    contagem = faixas.value_counts(sort=False)
+    return pd.DataFrame({
+        'dias': [f'{int(faixa.left)}+' if np.isinf(faixa.right) else f'{int(faixa.left)} a {int(faixa.right) - 1}'
+                 for faixa in contagem.index],
+        'emprestimos': contagem.to_numpy(),
+    })
+
+
+def adiamentos(dados: pd.DataFrame) -> pd.DataFrame:
+    contagem = dados['vezes_adiado'].value_counts().sort_index()
+    return pd.DataFrame({'vezes_adiado': contagem.index, 'emprestimos': contagem.to_numpy()})
+
+
+def atraso(dados: pd.DataFrame) -> pd.DataFrame:
+    """Percentis dos dias de atraso na devolução; devolver no prazo conta como 0."""
+    devolvidos = _devolvidos(dados)
+    dias = (devolvidos['devolvido_em'] - devolvidos['devolucao_em']).dt.days.clip(lower=0).to_numpy()
+    valores = np.percentile(dias, PERCENTIS_ATRASO) if len(dias) else np.full(len(PERCENTIS_ATRASO), np.nan)
+    return pd.DataFrame({'percentil': PERCENTIS_ATRASO, 'dias_atraso': valores})
+
+
+def coortes(dados: pd.DataFrame) -> pd.DataFrame:
+    """
+    Leitores agrupados pelo mês do primeiro empréstimo: quantos deles voltaram
+    a pegar livros em cada mês seguinte (0 é o próprio mês de entrada).
+    """
+    if dados.empty:
+        return pd.DataFrame()
+    mes = dados['emprestado_em'].dt.year * 12 + dados['emprestado_em'].dt.month - 1
+    entrada = mes.groupby(dados['leitor_id']).transform('min')
+    tabela = (
+        pd.DataFrame({'leitor_id': dados['leitor_id'], 'coorte': entrada, 'meses_depois': mes - entrada})
+        .drop_duplicates()
+        .pivot_table(index='coorte', columns='meses_depois', values='leitor_id', aggfunc='count', fill_value=0)
+    )
+    tabela.index = [f'{coorte // 12}-{coorte % 12 + 1:02d}' for coorte in tabela.index]
+    tabela.index.name = 'coorte'
+    return tabela
+
+
+def relatorio(dados: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    # Nome da planilha -> tabela, na ordem em que aparecem no arquivo exportado
+    return {
+        'duracao': duracao(dados),
+        'adiamentos': adiamentos(dados),
+        'atraso': atraso(dados),
+        'coortes': coortes(dados),
+    }
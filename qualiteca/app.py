@@ -7,14 +7,18 @@ import pandas as pd
 from paginas.dados import Dados, Backup
 from paginas.emprestimos import Emprestimos
 from paginas.estante import Estante
+from paginas.estatisticas import Estatisticas
 from paginas.home import Home
 from paginas.pessoas import Pessoas
+from models import usar_banco, encerrar_sessao
+import bibliotecas
 
 
 class Biblioteca:
 
     paginas_navegaveis = {
         Home.nome: Home,
+        Estatisticas.nome: Estatisticas,
         Estante.nome: Estante,
         Pessoas.nome: Pessoas,
         Emprestimos.nome: Emprestimos,
@@ -35,9 +39,9 @@ class Biblioteca:
         )
 
         self.pin()
-        if 'backup_coletado' not in st.session_state:
+        if 'logado' in st.session_state and 'backup_coletado' not in st.session_state:
             with st.spinner('Preparando backup...'):
-                backup = Backup(st.secrets)
+                backup = Backup(st.session_state.configuracao_biblioteca)
                 backup.automatico()
                 st.session_state.backup_coletado = True
 
@@ -45,6 +49,10 @@ class Biblioteca:
         if ('logado' not in st.session_state):
             st.markdown('# Qualiteca')
 
+            nomes_bibliotecas = bibliotecas.nomes(st.secrets)
+            biblioteca = st.selectbox('Biblioteca', options=nomes_bibliotecas) if nomes_bibliotecas else None
+            senha = bibliotecas.configuracao(st.secrets, biblioteca)['SENHA']
+
             pin = st.text_input(
                 'PIN',
                 label_visibility='collapsed',
@@ -53,19 +61,48 @@ class Biblioteca:
                 placeholder="Digite o pin de 4 digitos para desbloquear"
             )
 
-            if str(pin) == str(st.secrets.SENHA):
+            if str(pin) == str(senha):
 
                 st.session_state['logado'] = True
-                self.menu()
+                st.session_state['biblioteca'] = biblioteca
                 st.rerun()
-            elif str(pin) != str(st.secrets.SENHA) and str(pin) != '' and str(pin) is not None:
+            elif str(pin) != str(senha) and str(pin) != '' and str(pin) is not None:
                 st.error('PIN incorreto')
         else:
 
+            self.abrir_biblioteca()
             self.menu()
 
+    def abrir_biblioteca(self):
+        # A cada rodada, a sessão do banco é a da biblioteca escolhida no login
+        configuracao = bibliotecas.configuracao(st.secrets, st.session_state.get('biblioteca'))
+        st.session_state.configuracao_biblioteca = configuracao
+        # Sem o servidor estático as URLs das capas não abririam; elas seguem pelo app
+        capas_publicas = bool(configuracao['CAPAS_PUBLICAS']) and st.get_option('server.enableStaticServing')
+        usar_banco(
+            configuracao['NOME_BANCO_DADOS'], configuracao.get('SQLITE_PRAGMAS'),
+            configuracao['DIRETORIO_CAPAS'], capas_publicas
+        )
+        self.avisar_capas(bool(configuracao['CAPAS_PUBLICAS']), capas_publicas)
+
+    def avisar_capas(self, pedidas: bool, publicas: bool):
+        # Uma vez por sessão do navegador
+        if 'aviso_capas' in st.session_state:
+            return
+        st.session_state.aviso_capas = True
+        if pedidas and not publicas:
+            st.toast('CAPAS_PUBLICAS está ativo, mas server.enableStaticServing não: as capas seguem pelo app.')
+        elif not pedidas:
+            st.toast(
+                'Capas enviadas pelo app a cada página, sem cache no navegador. '
+                'Para URLs com cache longo, ative CAPAS_PUBLICAS nos segredos '
+                '(quem tiver a URL de uma capa poderá baixá-la sem login).'
+            )
+
     def menu(self):
         with st.sidebar:
+            if st.session_state.configuracao_biblioteca['NOME']:
+                st.caption(f"Biblioteca: {st.session_state.configuracao_biblioteca['NOME']}")
             destino = option_menu(
                 menu_title="Vamos lá!",
                 menu_icon="cast",
@@ -86,4 +123,7 @@ class Biblioteca:
         st.session_state.emprestimo_funcao = 'emprestimo_visualizar'
 
 
-Biblioteca()
\ No newline at end of file
+try:
+    Biblioteca()
+finally:
+    encerrar_sessao()
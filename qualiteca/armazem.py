@@ -0,0 +1,128 @@
+import hashlib
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+# Pasta servida pelo streamlit em app/static/ quando server.enableStaticServing está ativo
+DIRETORIO_ESTATICO = Path(__file__).parent / 'static'
+# Com CAPAS_PUBLICAS as capas ficam na pasta estática e ganham URLs com cache
+# longo, mas qualquer um que tenha a URL baixa o arquivo, inclusive capas de
+# livros excluídos. Sem ela ficam fora, e só chegam ao navegador pelo app
+DIRETORIO_PUBLICO = DIRETORIO_ESTATICO / 'capas'
+DIRETORIO_PRIVADO = Path(__file__).parent / 'capas'
+
+
+def diretorio_padrao(publicas: bool) -> Path:
+    return DIRETORIO_PUBLICO if publicas else DIRETORIO_PRIVADO
+
+
+def _trazer_do_outro_padrao(diretorio: Path):
+    # Ao ligar ou desligar CAPAS_PUBLICAS, o armazém padrão muda de pasta
+    # levando as capas já gravadas
+    for atual, outro in [(DIRETORIO_PUBLICO, DIRETORIO_PRIVADO), (DIRETORIO_PRIVADO, DIRETORIO_PUBLICO)]:
+        try:
+            relativo = diretorio.resolve().relative_to(atual.resolve())
+        except ValueError:
+            continue
+        anterior = outro / relativo
+        if anterior.is_dir() and not diretorio.exists():
+            diretorio.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(anterior, diretorio)
+        return
+
+
+class ArmazemCapas:
+    """Guarda arquivos em disco endereçados pelo sha256 do conteúdo.
+
+    Conteúdos iguais resultam no mesmo arquivo, gravado uma única vez. Com
+    `publicas` e o diretório dentro da pasta estática, cada arquivo também tem
+    uma URL estável que o navegador pode guardar em cache indefinidamente;
+    fora disso as capas são enviadas pelo próprio app, só a quem abre a página.
+    """
+
+    def __init__(self, diretorio, publicas: bool = False) -> None:
+        self.diretorio = Path(diretorio)
+        self.publicas = publicas
+        _trazer_do_outro_padrao(self.diretorio)
+        self.diretorio.mkdir(parents=True, exist_ok=True)
+
+        self.url_base = None
+        if publicas:
+            try:
+                relativo = self.diretorio.resolve().relative_to(DIRETORIO_ESTATICO.resolve())
+                self.url_base = f'app/static/{relativo.as_posix()}'
+            except ValueError:
+                pass
+
+    @staticmethod
+    def calcular_digest(conteudo: bytes) -> str:
+        return hashlib.sha256(conteudo).hexdigest()
+
+    def caminho(self, digest: str, extensao: str) -> Path:
+        return self.diretorio / digest[:2] / f'{digest}.{extensao}'
+
+    def url(self, digest: str, extensao: str) -> str | None:
+        # O parâmetro "v" faz o servidor responder com cache de longa duração
+        if self.url_base is None:
+            return None
+        return f'{self.url_base}/{digest[:2]}/{digest}.{extensao}?v={digest}'
+
+    def existe(self, digest: str, extensao: str) -> bool:
+        return self.caminho(digest, extensao).exists()
+
+    def guardar(self, conteudo: bytes, extensao: str) -> str:
+        digest = self.calcular_digest(conteudo)
+        destino = self.caminho(digest, extensao)
+        if not destino.exists():
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            temporario = destino.with_name(f'.{destino.name}.{os.getpid()}.tmp')
+            temporario.write_bytes(conteudo)
+            os.replace(temporario, destino)
+        return digest
+
+    def ler(self, digest: str, extensao: str) -> bytes:
+        return self.caminho(digest, extensao).read_bytes()
+
+    def remover(self, digest: str, extensao: str):
+        self.caminho(digest, extensao).unlink(missing_ok=True)
+
+    def listar(self) -> Iterator[tuple[str, str, Path]]:
+        for caminho in self.diretorio.glob('??/*.*'):
+            if caminho.name.startswith('.'):
+                continue
+            digest, extensao = caminho.name.split('.', 1)
+            yield digest, extensao, caminho
+
+    def verificar(self, referenciados: set[tuple[str, str]]) -> dict[str, list]:
+        ausentes = []
+        corrompidos = []
+        for digest, extensao in referenciados:
+            caminho = self.caminho(digest, extensao)
+            if not caminho.exists():
+                ausentes.append((digest, extensao))
+            elif self.calcular_digest(caminho.read_bytes()) != digest:
+                corrompidos.append((digest, extensao))
+
+        orfaos = [
+            (digest, extensao)
+            for digest, extensao, _ in self.listar()
+            if (digest, extensao) not in referenciados
+        ]
+        return {'ausentes': ausentes, 'corrompidos': corrompidos, 'orfaos': orfaos}
+
+    def coletar_lixo(self, referenciados: set[tuple[str, str]], tolerancia_segundos: int = 3600) -> tuple[int, int]:
+        # Arquivos recentes podem pertencer a uma gravação ainda não confirmada no banco
+        limite = time.time() - tolerancia_segundos
+        removidos = 0
+        bytes_liberados = 0
+        for digest, extensao, caminho in self.listar():
+            if (digest, extensao) in referenciados:
+                continue
+            estado = caminho.stat()
+            if estado.st_mtime > limite:
+                continue
+            caminho.unlink(missing_ok=True)
+            removidos += 1
+            bytes_liberados += estado.st_size
+        return removidos, bytes_liberados
@@ -0,0 +1,45 @@
+"""
+Várias bibliotecas servidas pelo mesmo processo.
+
+Cada biblioteca é uma seção de `[BIBLIOTECAS]` nos segredos, com o próprio
+PIN, banco, diretório de capas e pasta de backup no Dropbox; o que a seção
+não informar vem das chaves de fora dela:
+
+    NOME_BANCO_DADOS = 'biblioteca.db'
+    DROPBOX_APP_KEY = '...'
+
+    [BIBLIOTECAS.centro]
+    SENHA = '1234'
+    NOME_BANCO_DADOS = 'centro.db'
+    DIRETORIO_CAPAS = 'capas/centro'
+    CAPAS_PUBLICAS = false
+
+Sem `[BIBLIOTECAS]` há uma só biblioteca, configurada pelas chaves de fora,
+com os backups na raiz da pasta do app no Dropbox, como sempre foi.
+"""
+from typing import Any, Mapping
+
+from armazem import diretorio_padrao
+
+
+def nomes(segredos: Mapping) -> list[str]:
+    return list(segredos.get('BIBLIOTECAS', {}))
+
+
+def configuracao(segredos: Mapping, nome: str | None = None) -> dict[str, Any]:
+    comuns = {'CAPAS_PUBLICAS': False}
+    comuns.update((chave, valor) for chave, valor in segredos.items() if chave != 'BIBLIOTECAS')
+    if nome is None:
+        return {'DIRETORIO_CAPAS': diretorio_padrao(comuns['CAPAS_PUBLICAS']), 'PASTA_BACKUP': '', **comuns, 'NOME': None}
+
+    propria = dict(segredos['BIBLIOTECAS'][nome])
+    publicas = propria.get('CAPAS_PUBLICAS', comuns['CAPAS_PUBLICAS'])
+    return {
+        **comuns,
+        # Nada de uma biblioteca pode cair por descuido no arquivo ou na pasta de outra
+        'NOME_BANCO_DADOS': f'{nome}.db',
+        'DIRETORIO_CAPAS': diretorio_padrao(publicas) / nome,
+        'PASTA_BACKUP': f'/{nome}',
+        **propria,
+        'NOME': nome,
+    }
@@ -0,0 +1,56 @@
+"""
+Índices de busca textual (FTS5) sobre livros e usuários.
+
+Cada índice é uma tabela FTS5 de conteúdo externo: guarda apenas os termos e
+lê o texto da própria tabela de origem. Gatilhos no banco mantêm o índice em
+dia a cada INSERT, UPDATE e DELETE, qualquer que seja o caminho da escrita.
+Registros excluídos logicamente continuam indexados e são filtrados na consulta.
+"""
+import re
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+# tabela de origem: (tabela de busca, colunas e seus pesos no ranking bm25)
+INDICES_BUSCA = {
+    'livros': ('livros_busca', {'titulo': 10.0, 'autor': 5.0, 'genero': 2.0, 'observacao': 1.0}),
+    'usuarios': ('usuarios_busca', {'nome': 10.0, 'email': 5.0}),
+}
+
+
+def _comandos(tabela: str, tabela_busca: str, pesos: dict[str, float]) -> list[str]:
+    colunas = ', '.join(pesos)
+    novos = ', '.join(f'new.{coluna}' for coluna in pesos)
+    antigos = ', '.join(f'old.{coluna}' for coluna in pesos)
+    remover = f"INSERT INTO {tabela_busca}({tabela_busca}, rowid, {colunas}) VALUES ('delete', old.id, {antigos});"
+    inserir = f'INSERT INTO {tabela_busca}(rowid, {colunas}) VALUES (new.id, {novos});'
+    return [
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS {tabela_busca} USING fts5('
+        f"{colunas}, content='{tabela}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f'CREATE TRIGGER IF NOT EXISTS {tabela_busca}_ai AFTER INSERT ON {tabela} BEGIN {inserir} END',
+        f'CREATE TRIGGER IF NOT EXISTS {tabela_busca}_ad AFTER DELETE ON {tabela} BEGIN {remover} END',
+        f'CREATE TRIGGER IF NOT EXISTS {tabela_busca}_au AFTER UPDATE OF {colunas} ON {tabela} '
+        f'BEGIN {remover} {inserir} END',
+        f"INSERT INTO {tabela_busca}({tabela_busca}, rank) VALUES ('rank', 'bm25({', '.join(map(str, pesos.values()))})')",
+    ]
+
+
+def instalar_busca(conexao: Connection):
+    for tabela, (tabela_busca, pesos) in INDICES_BUSCA.items():
+        for comando in _comandos(tabela, tabela_busca, pesos):
+            conexao.execute(text(comando))
+    reconstruir_busca(conexao)
+
+
+def reconstruir_busca(conexao: Connection):
+    for tabela_busca, _ in INDICES_BUSCA.values():
+        conexao.execute(text(f"INSERT INTO {tabela_busca}({tabela_busca}) VALUES ('rebuild')"))
+
+
+def expressao_busca(termo: str) -> str | None:
+    # Cada palavra vira um prefixo entre aspas, então o que for digitado nunca
+    # é interpretado como sintaxe do FTS5
+    palavras = re.findall(r'\w+', termo or '')
+    if not palavras:
+        return None
+    return ' '.join(f'"{palavra}"*' for palavra in palavras)
@@ -0,0 +1,39 @@
+import streamlit as st
+
+
+def _rotulo(linha) -> str:
+    id, principal, *detalhes = linha
+    return f'({id}) {principal}' + ''.join(f' ({detalhe})' for detalhe in detalhes)
+
+
+def selecionar_por_busca(rotulo: str, modelo, chave: str, *criterios, colunas: tuple[str, ...], limite: int = 10):
+    """
+    Campo de busca seguido de uma caixa de seleção só com os melhores resultados
+    de `modelo.buscar`, em vez da lista completa de registros.
+
+    As opções trazem apenas `colunas` (a primeira deve ser o id); só o registro
+    escolhido é carregado por completo.
+    """
+    termo = st.text_input(
+        rotulo,
+        key=f'{chave}_termo',
+        placeholder='Comece a digitar para encontrar...'
+    )
+    if not termo.strip():
+        return None
+
+    opcoes = {linha[0]: _rotulo(linha) for linha in modelo.buscar(termo, *criterios, limite=limite, colunas=colunas)}
+    if not opcoes:
+        st.caption('Nada encontrado')
+        return None
+
+    escolhido = st.selectbox(
+        f'{rotulo} encontrados',
+        options=list(opcoes),
+        format_func=opcoes.get,
+        index=None,
+        placeholder='Escolha entre os resultados',
+        key=f'{chave}_escolha',
+        label_visibility='collapsed'
+    )
+    return modelo.obter(escolhido) if escolhido is not None else None
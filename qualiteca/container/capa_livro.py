@@ -0,0 +1,27 @@
+from html import escape
+
+import streamlit as st
+
+
+def exibir_capa(livro, miniatura: bool = True):
+    """
+    Mostra a capa de um livro.
+
+    Capas do armazém são referenciadas por URL com o hash do conteúdo, então
+    o navegador reaproveita a cópia em cache a cada nova execução da página.
+    As que ainda estão gravadas no banco são enviadas como bytes.
+    """
+    capa = livro.capa
+    if capa is None:
+        return
+
+    url = capa.url_miniatura if miniatura else capa.url_foto
+    if url:
+        st.markdown(
+            f'<img src="{url}" alt="{escape(livro.titulo)}" loading="lazy" style="max-width: 100%;">',
+            unsafe_allow_html=True
+        )
+    elif miniatura:
+        st.image(image=capa.conteudo_miniatura, output_format='JPEG')
+    else:
+        st.image(image=capa.conteudo_foto, output_format=livro.extensao_foto)
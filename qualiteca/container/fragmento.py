@@ -0,0 +1,44 @@
+from functools import wraps
+from threading import local
+
+import streamlit as st
+
+from models import banco_atual, encerrar_sessao, session
+
+_execucao = local()
+
+
+def reexecucao_parcial() -> bool:
+    # Verdadeiro enquanto só um fragmento roda de novo, sem o resto da página
+    return getattr(_execucao, 'parcial', False)
+
+
+def fragmento(funcao):
+    """
+    Faz de `funcao` um trecho da página que roda de novo sozinho quando um
+    widget dele é usado, sem reexecutar o app inteiro.
+
+    Os argumentos são guardados da última execução completa da página: nela
+    passe os registros já carregados, e releia-os pelo id quando
+    `reexecucao_parcial()` indicar que o resto da página não rodou.
+    """
+    @st.fragment
+    @wraps(funcao)
+    def executar(banco, *args, **kwargs):
+        if session.registry.has():
+            return funcao(*args, **kwargs)
+        # Reexecução só do fragmento: o app.py não roda, então a sessão da
+        # biblioteca em uso é aberta e encerrada aqui
+        session(banco=banco)
+        _execucao.parcial = True
+        try:
+            return funcao(*args, **kwargs)
+        finally:
+            _execucao.parcial = False
+            encerrar_sessao()
+
+    @wraps(funcao)
+    def chamar(*args, **kwargs):
+        return executar(banco_atual(), *args, **kwargs)
+
+    return chamar
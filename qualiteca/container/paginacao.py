@@ -0,0 +1,58 @@
+import streamlit as st
+
+
+class Paginacao:
+    """
+    Guarda na sessão a pilha de cursores já visitados de uma listagem paginada
+    por chave (ver `ModeloBase.paginar`) e desenha os botões de navegação.
+    """
+
+    def __init__(self, chave: str, consulta, tamanho_pagina: int = 20) -> None:
+        self.chave = f'{chave}_cursores'
+        if self.chave not in st.session_state:
+            st.session_state[self.chave] = [None]
+
+        cursores = st.session_state[self.chave]
+        self.itens, self.proximo = consulta(depois_de=cursores[-1], tamanho_pagina=tamanho_pagina)
+
+        # Exclusões podem esvaziar a página atual, então volta para a primeira
+        if not self.itens and len(cursores) > 1:
+            st.session_state[self.chave] = cursores = [None]
+            self.itens, self.proximo = consulta(depois_de=None, tamanho_pagina=tamanho_pagina)
+
+        self.pagina = len(cursores)
+
+    @staticmethod
+    def _avancar(chave, proximo):
+        st.session_state[chave].append(proximo)
+
+    @staticmethod
+    def _voltar(chave):
+        if len(st.session_state[chave]) > 1:
+            st.session_state[chave].pop()
+
+    def controles(self):
+        if self.pagina == 1 and self.proximo is None:
+            return
+
+        colunas = st.columns([0.2, 0.6, 0.2])
+        with colunas[0]:
+            st.button(
+                'Anterior',
+                use_container_width=True,
+                key=f'{self.chave}_anterior',
+                disabled=self.pagina == 1,
+                on_click=self._voltar,
+                args=(self.chave,)
+            )
+        with colunas[1]:
+            st.caption(f'Página {self.pagina}')
+        with colunas[2]:
+            st.button(
+                'Próxima',
+                use_container_width=True,
+                key=f'{self.chave}_proxima',
+                disabled=self.proximo is None,
+                on_click=self._avancar,
+                args=(self.chave, self.proximo)
+            )
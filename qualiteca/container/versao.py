@@ -0,0 +1,32 @@
+import streamlit as st
+
+
+def _chave(registro) -> str:
+    return f'versao_{registro.__tablename__}_{registro.id}'
+
+
+def versao_vista(registro) -> int:
+    """
+    Versão do registro que estava na tela quando o usuário clicou, isto é, a
+    exibida na rodada anterior. Guarda a atual para a próxima rodada.
+
+    Passada para `editar`, faz a edição falhar com `ConflitoEdicao` se outra
+    pessoa tiver alterado o registro nesse meio tempo.
+    """
+    chave = _chave(registro)
+    vista = st.session_state.get(chave, registro.versao)
+    st.session_state[chave] = registro.versao
+    return vista
+
+
+def versao_exibida(registro) -> int:
+    # Como `versao_vista`, mas só consulta: para quando ela ainda será chamada
+    # para o mesmo registro nesta rodada
+    return st.session_state.get(_chave(registro), registro.versao)
+
+
+def avisar_conflito(registro, erro: Exception):
+    # Esquece a versão guardada: a que vale para o próximo clique é a que a
+    # próxima rodada exibir, já atualizada
+    st.session_state.pop(_chave(registro), None)
+    st.error(str(erro))
@@ -0,0 +1,97 @@
+"""
+Estatísticas de circulação mantidas a cada empréstimo gravado.
+
+Cada empréstimo não excluído contribui com contagens em `estatisticas`,
+indexadas por (dimensão, chave): empréstimos e devoluções por mês, por livro,
+por gênero e por doador do livro, além dos totais. Ao gravar um empréstimo a
+contribuição antiga é retirada e a nova somada, então quem lê as estatísticas
+não precisa percorrer o histórico.
+
+Os gêneros e o doador contados são os do livro no momento da gravação; se
+mudarem depois, `reconstruir` recalcula tudo a partir dos empréstimos.
+"""
+from collections import Counter, defaultdict
+
+from sqlalchemy import Table, delete, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Connection
+
+
+def _mes(data) -> str:
+    return data.strftime('%Y-%m')
+
+
+def contar(emprestimos, generos_por_livro: dict[int, list[int]]) -> Counter:
+    # `emprestimos`: linhas (emprestado_em, devolucao_em, devolvido_em, vezes_adiado, livro_id, doador_id)
+    contagens = Counter()
+    for emprestado_em, devolucao_em, devolvido_em, vezes_adiado, livro_id, doador_id in emprestimos:
+        contagens['total', 'emprestimos'] += 1
+        contagens['total', 'adiamentos'] += vezes_adiado or 0
+        contagens['emprestimos_mes', _mes(emprestado_em)] += 1
+        contagens['livro', str(livro_id)] += 1
+        for genero_id in generos_por_livro.get(livro_id, ()):
+            contagens['genero', str(genero_id)] += 1
+        if doador_id is not None:
+            contagens['doador', str(doador_id)] += 1
+
+        if devolvido_em is not None:
+            contagens['total', 'devolucoes'] += 1
+            contagens['devolucoes_mes', _mes(devolvido_em)] += 1
+            if devolvido_em > devolucao_em:
+                contagens['total', 'devolvidos_com_atraso'] += 1
+                contagens['atrasos_mes', _mes(devolvido_em)] += 1
+    return contagens
+
+
+def contribuicoes(conexao: Connection, tabelas, *criterios) -> Counter:
+    # Contagens dos empréstimos não excluídos que atendem aos `criterios`
+    emprestimos, livros, livros_generos = (tabelas[nome] for nome in ('emprestimos', 'livros', 'livros_generos'))
+    linhas = conexao.execute(
+        select(
+            emprestimos.c.emprestado_em, emprestimos.c.devolucao_em, emprestimos.c.devolvido_em,
+            emprestimos.c.vezes_adiado, emprestimos.c.livro_id, livros.c.doador_id
+        )
+        .join(livros, livros.c.id == emprestimos.c.livro_id)
+        .where(emprestimos.c.excluido_em.is_(None), *criterios)
+    ).all()
+
+    generos_por_livro = defaultdict(list)
+    livros_id = {linha.livro_id for linha in linhas}
+    if livros_id:
+        for livro_id, genero_id in conexao.execute(
+            select(livros_generos.c.livro_id, livros_generos.c.genero_id)
+            .where(livros_generos.c.livro_id.in_(livros_id))
+        ):
+            generos_por_livro[livro_id].append(genero_id)
+    return contar(linhas, generos_por_livro)
+
+
+def aplicar(conexao: Connection, tabela: Table, contagens: Counter, sinal: int = 1):
+    # Soma (ou, com sinal -1, subtrai) as contagens, criando as que faltam
+    linhas = [
+        {'dimensao': dimensao, 'chave': chave, 'valor': sinal * valor}
+        for (dimensao, chave), valor in contagens.items() if valor
+    ]
+    if linhas:
+        instrucao = insert(tabela)
+        conexao.execute(
+            instrucao.on_conflict_do_update(
+                index_elements=['dimensao', 'chave'],
+                set_={'valor': tabela.c.valor + instrucao.excluded.valor}
+            ),
+            linhas
+        )
+
+
+def reconstruir(conexao: Connection, tabelas, tamanho_lote: int = 1000):
+    emprestimos, tabela = tabelas['emprestimos'], tabelas['estatisticas']
+    conexao.execute(delete(tabela))
+    ultimo_id = 0
+    while True:
+        ids = conexao.execute(
+            select(emprestimos.c.id).where(emprestimos.c.id > ultimo_id).order_by(emprestimos.c.id).limit(tamanho_lote)
+        ).scalars().all()
+        if not ids:
+            break
+        aplicar(conexao, tabela, contribuicoes(conexao, tabelas, emprestimos.c.id.in_(ids)))
+        ultimo_id = ids[-1]
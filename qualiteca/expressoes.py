@@ -0,0 +1,74 @@
+"""
+Expressões SQL que cada banco escreve de um jeito.
+"""
+from sqlalchemy import Date, Integer
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+
+class dias_entre(FunctionElement):
+    """Dias inteiros de `inicio` até `fim` (negativo se `fim` vier antes)."""
+    type = Integer()
+    name = 'dias_entre'
+    inherit_cache = True
+
+
+@compiles(dias_entre)
+def _dias_entre_padrao(elemento, compilador, **kwargs):
+    # PostgreSQL e o padrão SQL: a diferença entre duas datas já é em dias
+    inicio, fim = elemento.clauses
+    return f'(CAST({compilador.process(fim, **kwargs)} AS DATE) - CAST({compilador.process(inicio, **kwargs)} AS DATE))'
+
+
+@compiles(dias_entre, 'sqlite')
+def _dias_entre_sqlite(elemento, compilador, **kwargs):
+    inicio, fim = elemento.clauses
+    return (
+        f'CAST(julianday({compilador.process(fim, **kwargs)}) - '
+        f'julianday({compilador.process(inicio, **kwargs)}) AS INTEGER)'
+    )
+
+
+@compiles(dias_entre, 'mysql')
+@compiles(dias_entre, 'mariadb')
+def _dias_entre_mysql(elemento, compilador, **kwargs):
+    inicio, fim = elemento.clauses
+    return f'DATEDIFF({compilador.process(fim, **kwargs)}, {compilador.process(inicio, **kwargs)})'
+
+
+@compiles(dias_entre, 'mssql')
+def _dias_entre_mssql(elemento, compilador, **kwargs):
+    inicio, fim = elemento.clauses
+    return f'DATEDIFF(day, {compilador.process(inicio, **kwargs)}, {compilador.process(fim, **kwargs)})'
+
+
+class somar_dias(FunctionElement):
+    """A data `data` mais `dias` dias (menos, se negativo)."""
+    type = Date()
+    name = 'somar_dias'
+    inherit_cache = True
+
+
+@compiles(somar_dias)
+def _somar_dias_padrao(elemento, compilador, **kwargs):
+    data, dias = elemento.clauses
+    return f'(CAST({compilador.process(data, **kwargs)} AS DATE) + {compilador.process(dias, **kwargs)})'
+
+
+@compiles(somar_dias, 'sqlite')
+def _somar_dias_sqlite(elemento, compilador, **kwargs):
+    data, dias = elemento.clauses
+    return f"date({compilador.process(data, **kwargs)}, {compilador.process(dias, **kwargs)} || ' days')"
+
+
+@compiles(somar_dias, 'mysql')
+@compiles(somar_dias, 'mariadb')
+def _somar_dias_mysql(elemento, compilador, **kwargs):
+    data, dias = elemento.clauses
+    return f'DATE_ADD({compilador.process(data, **kwargs)}, INTERVAL {compilador.process(dias, **kwargs)} DAY)'
+
+
+@compiles(somar_dias, 'mssql')
+def _somar_dias_mssql(elemento, compilador, **kwargs):
+    data, dias = elemento.clauses
+    return f'DATEADD(day, {compilador.process(dias, **kwargs)}, {compilador.process(data, **kwargs)})'
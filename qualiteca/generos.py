@@ -0,0 +1,60 @@
+"""
+Gêneros literários como etiquetas.
+
+Os formulários continuam gravando os gêneros como texto separado por vírgulas
+(`Livro.genero`, `Usuario.genero_preferidos`). A partir desse texto cada
+gênero vira uma linha única em `generos`, e as tabelas de ligação guardam o
+índice invertido gênero -> livros e gênero -> leitores.
+"""
+from sqlalchemy import Table, delete, insert, select
+from sqlalchemy.engine import Connection
+
+from trigramas import normalizar
+
+
+def separar(texto: str | None) -> dict[str, str]:
+    # Chave normalizada -> nome como exibido ("Ficção" e "ficcao" são o mesmo)
+    generos = {}
+    for parte in (texto or '').split(','):
+        nome = ' '.join(parte.split()).upper()
+        chave = normalizar(nome)
+        if chave:
+            generos.setdefault(chave, nome)
+    return generos
+
+
+def _ids(conexao: Connection, tabela_generos: Table, generos: dict[str, str], agora) -> dict[str, int]:
+    if not generos:
+        return {}
+    consulta = select(tabela_generos.c.chave, tabela_generos.c.id).where(tabela_generos.c.chave.in_(generos))
+    ids = dict(conexao.execute(consulta).all())
+    novos = [
+        {'chave': chave, 'nome': nome, 'registrado_em': agora}
+        for chave, nome in generos.items() if chave not in ids
+    ]
+    if novos:
+        conexao.execute(insert(tabela_generos), novos)
+        ids = dict(conexao.execute(consulta).all())
+    return ids
+
+
+def vincular(conexao: Connection, tabela_generos: Table, tabela_ligacao: Table, coluna: str,
+             registros: list[tuple[int, str | None]], agora):
+    # Substitui os gêneros ligados aos registros informados como (id, texto)
+    desvincular(conexao, tabela_ligacao, coluna, [id for id, _ in registros])
+    separados = {id: separar(texto) for id, texto in registros}
+    ids = _ids(conexao, tabela_generos, {
+        chave: nome for generos in separados.values() for chave, nome in generos.items()
+    }, agora)
+    linhas = [
+        {coluna: id, 'genero_id': ids[chave]}
+        for id, generos in separados.items()
+        for chave in generos
+    ]
+    if linhas:
+        conexao.execute(insert(tabela_ligacao), linhas)
+
+
+def desvincular(conexao: Connection, tabela_ligacao: Table, coluna: str, ids: list[int]):
+    if ids:
+        conexao.execute(delete(tabela_ligacao).where(tabela_ligacao.c[coluna].in_(ids)))
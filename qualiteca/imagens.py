@@ -0,0 +1,59 @@
+from io import BytesIO
+from PIL import Image, ImageOps
+
+LADO_MINIATURA = 160
+QUALIDADE_MINIATURA = 70
+
+LADO_MAXIMO = 1024
+QUALIDADE = 80
+FORMATO = 'JPEG'
+EXTENSAO = 'jpeg'
+BYTES_POR_PIXEL_MAXIMO = 0.35
+# Abaixo disso, trocar a capa pela recomprimida não compensa
+ECONOMIA_MINIMA = 0.1
+
+
+def abrir_imagem(conteudo: bytes) -> Image.Image:
+    imagem = Image.open(BytesIO(conteudo))
+    imagem = ImageOps.exif_transpose(imagem)
+    if imagem.mode != 'RGB':
+        imagem = imagem.convert('RGB')
+    return imagem
+
+
+def _salvar(imagem: Image.Image, qualidade: int) -> bytes:
+    buffer = BytesIO()
+    imagem.save(buffer, format=FORMATO, quality=qualidade, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def gerar_miniatura(conteudo: bytes, lado: int = LADO_MINIATURA) -> bytes:
+    imagem = abrir_imagem(conteudo)
+    imagem.thumbnail((lado, lado))
+    return _salvar(imagem, QUALIDADE_MINIATURA)
+
+
+def recomprimir(conteudo: bytes, lado: int = LADO_MAXIMO) -> bytes:
+    imagem = abrir_imagem(conteudo)
+    imagem.thumbnail((lado, lado))
+    return _salvar(imagem, QUALIDADE)
+
+
+def recomprimir_se_menor(conteudo: bytes, lado: int = LADO_MAXIMO) -> bytes | None:
+    # None quando a recompressão não deixa o arquivo menor o bastante; sem
+    # isso a mesma capa seria recomprimida de novo a cada execução
+    recomprimida = recomprimir(conteudo, lado)
+    if len(recomprimida) > len(conteudo) * (1 - ECONOMIA_MINIMA):
+        return None
+    return recomprimida
+
+
+def precisa_recomprimir(conteudo: bytes, lado: int = LADO_MAXIMO) -> bool:
+    # Só lê o cabeçalho, sem decodificar a imagem inteira
+    imagem = Image.open(BytesIO(conteudo))
+    largura, altura = imagem.size
+    return any([
+        imagem.format != FORMATO,
+        max(largura, altura) > lado,
+        len(conteudo) > largura * altura * BYTES_POR_PIXEL_MAXIMO
+    ])
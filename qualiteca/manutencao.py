@@ -0,0 +1,367 @@
+import argparse
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import undefer
+
+from models import (
+    Base, Capa, Emprestimo, NOME_BANCO_PADRAO, session, agora, banco_atual, configurar_banco, configurar_armazem_capas,
+    consolidar_banco)
+from imagens import precisa_recomprimir, recomprimir_se_menor, EXTENSAO
+
+
+def _confirmar(mensagem_erro: str):
+    try:
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(mensagem_erro)
+        raise e
+
+
+def _armazem_obrigatorio():
+    armazem = banco_atual().armazem_capas
+    if armazem is None:
+        raise SystemExit('Informe o diretório do armazém de capas com --diretorio-capas')
+    return armazem
+
+
+def recomprimir_capas(tamanho_lote: int = 20, a_partir_de: int = 0):
+    ultimo_id = a_partir_de
+    recomprimidas = 0
+    bytes_economizados = 0
+
+    while True:
+        capas = (
+            session.query(Capa)
+            .options(undefer(Capa.foto))
+            .where(Capa.id > ultimo_id)
+            .order_by(Capa.id)
+            .limit(tamanho_lote)
+            .all()
+        )
+        if not capas:
+            break
+
+        for capa in capas:
+            try:
+                foto = capa.conteudo_foto
+                if not precisa_recomprimir(foto):
+                    continue
+                recomprimida = recomprimir_se_menor(foto)
+                if recomprimida is None:
+                    continue
+                capa.guardar_foto(recomprimida)
+            except OSError:
+                print(f'Capa {capa.id} (livro {capa.livro_id}) não é uma imagem válida, ignorada')
+                continue
+
+            capa.editado_em = agora()
+            recomprimidas += 1
+            bytes_economizados += len(foto) - len(capa.conteudo_foto)
+
+        _confirmar(f'Falha ao gravar o lote após a capa {ultimo_id}')
+
+        ultimo_id = capas[-1].id
+        session.expunge_all()
+        print(f'Processadas até a capa {ultimo_id}: {recomprimidas} recomprimidas, {bytes_economizados / 1024 / 1024:.1f} MB a menos')
+
+    return recomprimidas, bytes_economizados
+
+
+def mover_capas_para_armazem(tamanho_lote: int = 20):
+    armazem = _armazem_obrigatorio()
+    movidas = 0
+
+    while True:
+        capas = (
+            session.query(Capa)
+            .options(undefer(Capa.foto))
+            .where(Capa.digest.is_(None))
+            .order_by(Capa.id)
+            .limit(tamanho_lote)
+            .all()
+        )
+        if not capas:
+            break
+
+        for capa in capas:
+            capa.guardar_no_armazem(capa.foto, capa.miniatura)
+            capa.editado_em = agora()
+        movidas += len(capas)
+
+        _confirmar(f'Falha ao gravar o lote iniciado na capa {capas[0].id}')
+        session.expunge_all()
+        print(f'{movidas} capas movidas para {armazem.diretorio}')
+
+    # Devolve ao sistema as páginas liberadas pelas fotos
+    with banco_atual().engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexao:
+        conexao.execute(text('VACUUM'))
+
+    return movidas
+
+
+def verificar_armazem():
+    armazem = _armazem_obrigatorio()
+    resultado = armazem.verificar(Capa.referenciadas())
+    print(f"Ausentes: {len(resultado['ausentes'])}")
+    for digest, extensao in resultado['ausentes']:
+        print(f'  {digest}.{extensao}')
+    print(f"Corrompidos: {len(resultado['corrompidos'])}")
+    for digest, extensao in resultado['corrompidos']:
+        print(f'  {digest}.{extensao}')
+    print(f"Sem referência (removíveis pela coleta): {len(resultado['orfaos'])}")
+    return resultado
+
+
+def coletar_lixo_armazem(tolerancia_segundos: int = 3600):
+    armazem = _armazem_obrigatorio()
+    removidos, bytes_liberados = armazem.coletar_lixo(Capa.referenciadas(), tolerancia_segundos)
+    print(f'{removidos} arquivos removidos, {bytes_liberados / 1024 / 1024:.1f} MB liberados')
+    return removidos, bytes_liberados
+
+
+def reparar_disponibilidade():
+    divergentes = Emprestimo.reparar_disponibilidade()
+    print(f'{divergentes} livros com disponibilidade corrigida')
+    return divergentes
+
+
+def reconstruir_estatisticas():
+    Emprestimo.reconstruir_estatisticas()
+    print(f"Estatísticas recalculadas: {Emprestimo.totais().get('emprestimos', 0)} empréstimos contados")
+
+
+# Na ordem em que são criadas no arquivo; são removidas do banco na ordem inversa
+TABELAS_ARQUIVADAS = ['usuarios', 'livros', 'capas', 'emprestimos']
+
+
+def _tamanho_banco(conexao) -> int:
+    return conexao.execute(text('PRAGMA page_count')).scalar() * conexao.execute(text('PRAGMA page_size')).scalar()
+
+
+def _colunas(conexao, esquema: str, tabela: str) -> list[str]:
+    return [linha[1] for linha in conexao.execute(text(f'PRAGMA {esquema}.table_info({tabela})'))]
+
+
+def _preparar_arquivo(caminho: Path):
+    engine_arquivo = create_engine(f'sqlite:///{caminho}')
+    with engine_arquivo.begin() as conexao:
+        for tabela in TABELAS_ARQUIVADAS:
+            Base.metadata.tables[tabela].create(conexao, checkfirst=True)
+    engine_arquivo.dispose()
+
+
+def _selecionar_arquivaveis(conexao, corte_exclusao, corte_emprestimos):
+    # Livros só saem sem empréstimo em aberto; com eles saem a capa e todos os
+    # seus empréstimos. Pessoas só saem quando nada que fica aponta para elas.
+    # O maior id de cada tabela nunca sai: sem AUTOINCREMENT o SQLite voltaria a
+    # usá-lo num registro novo, que depois sobrescreveria o arquivado
+    for tabela in TABELAS_ARQUIVADAS:
+        conexao.execute(text(f'CREATE TEMP TABLE arquivar_{tabela} (id INTEGER PRIMARY KEY)'))
+    parametros = {'corte_exclusao': corte_exclusao, 'corte_emprestimos': corte_emprestimos}
+    conexao.execute(text(
+        'INSERT INTO temp.arquivar_livros SELECT id FROM livros '
+        'WHERE excluido_em < :corte_exclusao AND NOT EXISTS ('
+        'SELECT 1 FROM emprestimos WHERE emprestimos.livro_id = livros.id '
+        'AND devolvido_em IS NULL AND excluido_em IS NULL) '
+        'AND id < (SELECT max(id) FROM livros) '
+        'AND id NOT IN (SELECT livro_id FROM capas WHERE id = (SELECT max(id) FROM capas)) '
+        'AND id NOT IN (SELECT livro_id FROM emprestimos WHERE id = (SELECT max(id) FROM emprestimos))'
+    ), parametros)
+    conexao.execute(text(
+        'INSERT INTO temp.arquivar_capas SELECT id FROM capas '
+        'WHERE livro_id IN (SELECT id FROM temp.arquivar_livros)'
+    ))
+    conexao.execute(text(
+        'INSERT INTO temp.arquivar_emprestimos SELECT id FROM emprestimos '
+        'WHERE (excluido_em < :corte_exclusao '
+        'OR (excluido_em IS NULL AND devolvido_em < :corte_emprestimos) '
+        'OR livro_id IN (SELECT id FROM temp.arquivar_livros)) '
+        'AND id < (SELECT max(id) FROM emprestimos)'
+    ), parametros)
+    conexao.execute(text(
+        'INSERT INTO temp.arquivar_usuarios SELECT id FROM usuarios '
+        'WHERE excluido_em < :corte_exclusao AND id < (SELECT max(id) FROM usuarios) '
+        'AND NOT EXISTS (SELECT 1 FROM livros WHERE livros.doador_id = usuarios.id '
+        'AND livros.id NOT IN (SELECT id FROM temp.arquivar_livros)) '
+        'AND NOT EXISTS (SELECT 1 FROM emprestimos WHERE emprestimos.leitor_id = usuarios.id '
+        'AND emprestimos.id NOT IN (SELECT id FROM temp.arquivar_emprestimos))'
+    ), parametros)
+
+
+def _trazer_capas_do_armazem(conexao):
+    # A coleta de lixo do armazém apaga as capas de livros excluídos, então o
+    # arquivo guarda o conteúdo em vez de só a referência
+    armazem = banco_atual().armazem_capas
+    if armazem is None:
+        return
+    capas = conexao.execute(text(
+        'SELECT id, digest, digest_miniatura, extensao FROM arquivo.capas '
+        'WHERE digest IS NOT NULL AND foto IS NULL AND id IN (SELECT id FROM temp.arquivar_capas)'
+    )).all()
+    for id, digest, digest_miniatura, extensao in capas:
+        if not armazem.existe(digest, extensao):
+            continue
+        miniatura = armazem.ler(digest_miniatura, EXTENSAO) if armazem.existe(digest_miniatura, EXTENSAO) else None
+        conexao.execute(
+            text('UPDATE arquivo.capas SET foto = :foto, miniatura = :miniatura WHERE id = :id'),
+            {'foto': armazem.ler(digest, extensao), 'miniatura': miniatura, 'id': id}
+        )
+
+
+def _recuperar_espaco(conexao) -> None:
+    # O primeiro uso converte o banco para auto_vacuum incremental, o que exige
+    # um VACUUM completo; depois disso basta devolver as páginas livres
+    if conexao.execute(text('PRAGMA auto_vacuum')).scalar() != 2:
+        conexao.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+        conexao.execute(text('VACUUM'))
+    else:
+        # Pelo execute do sqlite3 cada passo do pragma libera só uma página;
+        # o executescript o roda até o fim
+        conexao.connection.driver_connection.executescript('PRAGMA incremental_vacuum')
+
+
+def arquivar(dias_exclusao: int = 90, anos_emprestimos: int = 5, caminho_arquivo: str | None = None) -> dict[str, int]:
+    """
+    Move para um banco de arquivo os registros excluídos há mais de
+    `dias_exclusao` dias e os empréstimos devolvidos há mais de
+    `anos_emprestimos` anos, apaga-os do banco em uso e recupera o espaço.
+
+    As estatísticas de circulação já contadas ficam como estão, mas um
+    `reconstruir-estatisticas` posterior só enxerga os empréstimos que ficaram.
+    """
+    banco = banco_atual()
+    arquivo_banco = Path(banco.nome_banco)
+    caminho = Path(caminho_arquivo) if caminho_arquivo else arquivo_banco.with_name(
+        f'{arquivo_banco.stem}_arquivo{arquivo_banco.suffix}')
+    _preparar_arquivo(caminho)
+
+    # Datas comuns, sem fuso, no mesmo formato em que o SQLAlchemy as grava
+    corte_exclusao = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=dias_exclusao)
+    corte_emprestimos = date.today() - timedelta(days=365 * anos_emprestimos)
+    arquivados = {}
+
+    # Solta a conexão da sessão, mas segue no mesmo banco
+    session.remove()
+    session(banco=banco)
+    with banco.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexao:
+        bytes_antes = _tamanho_banco(conexao)
+        conexao.execute(text('ATTACH DATABASE :caminho AS arquivo'), {'caminho': str(caminho)})
+        try:
+            conexao.execute(text('BEGIN'))
+            try:
+                _selecionar_arquivaveis(conexao, corte_exclusao, corte_emprestimos)
+                for tabela in TABELAS_ARQUIVADAS:
+                    colunas = ', '.join(
+                        coluna for coluna in _colunas(conexao, 'main', tabela)
+                        if coluna in _colunas(conexao, 'arquivo', tabela)
+                    )
+                    conexao.execute(text(
+                        f'INSERT OR REPLACE INTO arquivo.{tabela} ({colunas}) SELECT {colunas} FROM main.{tabela} '
+                        f'WHERE id IN (SELECT id FROM temp.arquivar_{tabela})'
+                    ))
+                _trazer_capas_do_armazem(conexao)
+
+                for tabela, coluna, origem in [
+                    ('livros_trigramas', 'livro_id', 'livros'),
+                    ('livros_generos', 'livro_id', 'livros'),
+                    ('usuarios_generos', 'usuario_id', 'usuarios'),
+                ]:
+                    conexao.execute(text(f'DELETE FROM main.{tabela} WHERE {coluna} IN (SELECT id FROM temp.arquivar_{origem})'))
+                for tabela in reversed(TABELAS_ARQUIVADAS):
+                    arquivados[tabela] = conexao.execute(text(
+                        f'DELETE FROM main.{tabela} WHERE id IN (SELECT id FROM temp.arquivar_{tabela})'
+                    )).rowcount
+                conexao.execute(text('COMMIT'))
+            except Exception as e:
+                conexao.execute(text('ROLLBACK'))
+                raise e
+            finally:
+                for tabela in TABELAS_ARQUIVADAS:
+                    conexao.execute(text(f'DROP TABLE IF EXISTS temp.arquivar_{tabela}'))
+        finally:
+            conexao.execute(text('DETACH DATABASE arquivo'))
+
+        _recuperar_espaco(conexao)
+        consolidar_banco()
+        bytes_recuperados = bytes_antes - _tamanho_banco(conexao)
+
+    banco.cache.limpar()
+    for tabela in TABELAS_ARQUIVADAS:
+        print(f'{arquivados[tabela]} registros de {tabela} arquivados em {caminho}')
+    print(f'{bytes_recuperados / 1024 / 1024:.1f} MB recuperados no banco em uso')
+    return {**arquivados, 'bytes_recuperados': bytes_recuperados}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rotinas de manutenção da Qualiteca')
+    parser.add_argument('--banco', default=NOME_BANCO_PADRAO, help=f'Arquivo do banco da biblioteca (padrão: {NOME_BANCO_PADRAO})')
+    parser.add_argument('--diretorio-capas', help='Diretório do armazém de capas, quando usado')
+    comandos = parser.add_subparsers(dest='comando', required=True)
+
+    comando_recomprimir = comandos.add_parser(
+        'recomprimir-capas',
+        help='Redimensiona e recomprime as capas já gravadas. Pode ser interrompido e retomado com --a-partir-de'
+    )
+    comando_recomprimir.add_argument('--lote', type=int, default=20)
+    comando_recomprimir.add_argument('--a-partir-de', type=int, default=0, help='Último id de capa já processado')
+
+    comando_mover = comandos.add_parser(
+        'capas-para-armazem',
+        help='Move as capas gravadas no banco para o armazém em disco e compacta o banco'
+    )
+    comando_mover.add_argument('--lote', type=int, default=20)
+
+    comandos.add_parser('verificar-armazem', help='Confere se as capas referenciadas existem e estão íntegras')
+
+    comando_coletar = comandos.add_parser(
+        'coletar-lixo-armazem',
+        help='Remove do armazém as capas que nenhum livro não excluído referencia'
+    )
+    comando_coletar.add_argument('--tolerancia', type=int, default=3600, help='Ignora arquivos gravados há menos segundos que isso')
+
+    comandos.add_parser(
+        'reparar-disponibilidade',
+        help='Recalcula a disponibilidade dos livros a partir dos empréstimos em aberto'
+    )
+
+    comandos.add_parser(
+        'reconstruir-estatisticas',
+        help='Recalcula do zero as estatísticas de circulação a partir de todos os empréstimos'
+    )
+
+    comando_arquivar = comandos.add_parser(
+        'arquivar',
+        help='Move os registros excluídos e os empréstimos antigos para um banco de arquivo e compacta o banco em uso'
+    )
+    comando_arquivar.add_argument('--dias-exclusao', type=int, default=90, help='Arquiva o que foi excluído há mais dias que isso')
+    comando_arquivar.add_argument('--anos-emprestimos', type=int, default=5, help='Arquiva os empréstimos devolvidos há mais anos que isso')
+    comando_arquivar.add_argument('--arquivo', help='Banco de arquivo (padrão: <banco>_arquivo.db ao lado do banco em uso)')
+
+    argumentos = parser.parse_args()
+    configurar_banco(argumentos.banco)
+    configurar_armazem_capas(argumentos.diretorio_capas)
+
+    if argumentos.comando == 'recomprimir-capas':
+        recomprimir_capas(tamanho_lote=argumentos.lote, a_partir_de=argumentos.a_partir_de)
+    elif argumentos.comando == 'capas-para-armazem':
+        mover_capas_para_armazem(tamanho_lote=argumentos.lote)
+    elif argumentos.comando == 'verificar-armazem':
+        verificar_armazem()
+    elif argumentos.comando == 'coletar-lixo-armazem':
+        coletar_lixo_armazem(tolerancia_segundos=argumentos.tolerancia)
+    elif argumentos.comando == 'reparar-disponibilidade':
+        reparar_disponibilidade()
+    elif argumentos.comando == 'reconstruir-estatisticas':
+        reconstruir_estatisticas()
+    elif argumentos.comando == 'arquivar':
+        arquivar(
+            dias_exclusao=argumentos.dias_exclusao,
+            anos_emprestimos=argumentos.anos_emprestimos,
+            caminho_arquivo=argumentos.arquivo
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+"""
+Migrações versionadas do esquema do banco.
+
+A versão aplicada fica em `PRAGMA user_version`. Um banco novo é criado direto
+com o esquema atual e marcado com a última versão; um banco existente recebe,
+em ordem e cada uma na sua transação, as migrações acima da sua versão.
+
+Para alterar o esquema, altere os modelos e registre aqui uma nova função com
+`@migracao(<próxima versão>)` que leve um banco da versão anterior até ela.
+Cada migração traz o próprio DDL e descreve as tabelas que usa como eram na
+sua versão: os modelos mudam depois, e uma migração antiga não pode depender
+deles.
+
+A exceção são os dados derivados: as migrações 4, 6 e 7 preenchem trigramas,
+gêneros e estatísticas com `trigramas.indexar`, `generos.vincular` e
+`estatisticas.reconstruir`, os mesmos que o app usa ao gravar, para que o
+banco migrado fique igual ao que o app calcularia hoje. Essas funções recebem
+as tabelas da migração e só transformam valores; se a regra de derivação
+mudar, registre uma migração nova que recalcule tudo, e confira que as
+antigas continuam rodando sobre as colunas da sua versão.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from io import BytesIO
+
+from PIL import Image, ImageOps
+from sqlalchemy import Date, DateTime, MetaData, column, inspect, insert, table, text
+from sqlalchemy.engine import Connection, Engine
+
+import trigramas
+import generos
+import estatisticas
+
+MIGRACOES = {}
+
+
+def migracao(versao: int):
+    def registrar(funcao):
+        MIGRACOES[versao] = funcao
+        return funcao
+    return registrar
+
+
+def versao_atual(conexao: Connection) -> int:
+    return conexao.execute(text('PRAGMA user_version')).scalar()
+
+
+def _marcar_versao(conexao: Connection, versao: int):
+    conexao.execute(text(f'PRAGMA user_version = {int(versao)}'))
+
+
+def _colunas(conexao: Connection, tabela: str) -> list[str]:
+    return [coluna['name'] for coluna in inspect(conexao).get_columns(tabela)]
+
+
+def _executar(conexao: Connection, *instrucoes: str):
+    for instrucao in instrucoes:
+        conexao.execute(text(instrucao))
+
+
+@contextmanager
+def _transacao(conexao: Connection):
+    # O pysqlite não abre transação antes de DDL; com a conexão em autocommit
+    # a transação é explícita e cobre também CREATE/ALTER/DROP
+    conexao.execute(text('BEGIN IMMEDIATE'))
+    try:
+        yield conexao
+    except Exception as e:
+        conexao.execute(text('ROLLBACK'))
+        raise e
+    conexao.execute(text('COMMIT'))
+
+
+def migrar(engine: Engine, metadata: MetaData):
+    ultima_versao = max(MIGRACOES)
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conexao:
+        with _transacao(conexao):
+            if versao_atual(conexao) == 0 and not inspect(conexao).has_table('usuarios'):
+                metadata.create_all(conexao)
+                _marcar_versao(conexao, ultima_versao)
+
+        for versao in sorted(MIGRACOES):
+            with _transacao(conexao):
+                if versao_atual(conexao) < versao:
+                    MIGRACOES[versao](conexao, metadata)
+                    _marcar_versao(conexao, versao)
+
+
+def _miniatura_v1(conteudo: bytes) -> bytes:
+    # Miniatura como `imagens.gerar_miniatura` a gerava na versão 1
+    imagem = ImageOps.exif_transpose(Image.open(BytesIO(conteudo)))
+    if imagem.mode != 'RGB':
+        imagem = imagem.convert('RGB')
+    imagem.thumbnail((160, 160))
+    buffer = BytesIO()
+    imagem.save(buffer, format='JPEG', quality=70, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+@migracao(1)
+def capas_em_tabela_propria(conexao: Connection, metadata: MetaData, tamanho_lote: int = 50):
+    _executar(conexao, """
+        CREATE TABLE IF NOT EXISTS capas (
+            livro_id INTEGER NOT NULL,
+            miniatura BLOB,
+            foto BLOB,
+            extensao VARCHAR NOT NULL,
+            digest VARCHAR(64),
+            digest_miniatura VARCHAR(64),
+            id INTEGER NOT NULL,
+            registrado_em DATETIME NOT NULL,
+            editado_em DATETIME,
+            excluido_em DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (livro_id),
+            FOREIGN KEY(livro_id) REFERENCES livros (id)
+        )
+    """)
+    if 'foto_livro' not in _colunas(conexao, 'livros'):
+        return
+
+    capas = table('capas', column('livro_id'), column('foto'), column('miniatura'), column('extensao'),
+                  column('registrado_em', DateTime))
+    agora = datetime.now(timezone.utc)
+    ultimo_id = 0
+    while True:
+        linhas = conexao.execute(
+            text(
+                'SELECT id, foto_livro, extensao_foto FROM livros '
+                'WHERE id > :ultimo_id ORDER BY id LIMIT :tamanho_lote'
+            ),
+            {'ultimo_id': ultimo_id, 'tamanho_lote': tamanho_lote}
+        ).all()
+        if not linhas:
+            break
+
+        novas = []
+        for livro_id, foto, extensao in linhas:
+            try:
+                miniatura = _miniatura_v1(foto)
+            except OSError:
+                miniatura = foto
+            novas.append({
+                'livro_id': livro_id,
+                'foto': foto,
+                'miniatura': miniatura,
+                'extensao': extensao,
+                'registrado_em': agora
+            })
+        conexao.execute(insert(capas), novas)
+        ultimo_id = linhas[-1].id
+
+    conexao.execute(text('ALTER TABLE livros DROP COLUMN foto_livro'))
+    conexao.execute(text('ALTER TABLE livros DROP COLUMN extensao_foto'))
+
+
+@migracao(2)
+def indices_filtros(conexao: Connection, metadata: MetaData):
+    _executar(
+        conexao,
+        'CREATE INDEX IF NOT EXISTS ix_usuarios_nome ON usuarios (nome, id) WHERE excluido_em IS NULL',
+        'CREATE INDEX IF NOT EXISTS ix_livros_doador_id ON livros (doador_id)',
+        'CREATE INDEX IF NOT EXISTS ix_livros_titulo ON livros (titulo, id) WHERE excluido_em IS NULL',
+        'CREATE INDEX IF NOT EXISTS ix_emprestimos_leitor_id ON emprestimos (leitor_id, devolvido_em)',
+        'CREATE INDEX IF NOT EXISTS ix_emprestimos_livro_id ON emprestimos (livro_id, devolvido_em)',
+        'CREATE INDEX IF NOT EXISTS ix_emprestimos_abertos ON emprestimos (devolucao_em, id) '
+        'WHERE devolvido_em IS NULL AND excluido_em IS NULL',
+        'CREATE INDEX IF NOT EXISTS ix_emprestimos_fechados ON emprestimos (devolvido_em, id) '
+        'WHERE devolvido_em IS NOT NULL AND excluido_em IS NULL',
+    )
+
+
+@migracao(3)
+def busca_textual(conexao: Connection, metadata: MetaData):
+    _executar(
+        conexao,
+        "CREATE VIRTUAL TABLE IF NOT EXISTS livros_busca USING fts5(titulo, autor, genero, observacao, "
+        "content='livros', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        'CREATE TRIGGER IF NOT EXISTS livros_busca_ai AFTER INSERT ON livros BEGIN '
+        'INSERT INTO livros_busca(rowid, titulo, autor, genero, observacao) '
+        'VALUES (new.id, new.titulo, new.autor, new.genero, new.observacao); END',
+        'CREATE TRIGGER IF NOT EXISTS livros_busca_ad AFTER DELETE ON livros BEGIN '
+        'INSERT INTO livros_busca(livros_busca, rowid, titulo, autor, genero, observacao) '
+        "VALUES ('delete', old.id, old.titulo, old.autor, old.genero, old.observacao); END",
+        'CREATE TRIGGER IF NOT EXISTS livros_busca_au AFTER UPDATE OF titulo, autor, genero, observacao ON livros BEGIN '
+        'INSERT INTO livros_busca(livros_busca, rowid, titulo, autor, genero, observacao) '
+        "VALUES ('delete', old.id, old.titulo, old.autor, old.genero, old.observacao); "
+        'INSERT INTO livros_busca(rowid, titulo, autor, genero, observacao) '
+        'VALUES (new.id, new.titulo, new.autor, new.genero, new.observacao); END',
+        "INSERT INTO livros_busca(livros_busca, rank) VALUES ('rank', 'bm25(10.0, 5.0, 2.0, 1.0)')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS usuarios_busca USING fts5(nome, email, "
+        "content='usuarios', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        'CREATE TRIGGER IF NOT EXISTS usuarios_busca_ai AFTER INSERT ON usuarios BEGIN '
+        'INSERT INTO usuarios_busca(rowid, nome, email) VALUES (new.id, new.nome, new.email); END',
+        'CREATE TRIGGER IF NOT EXISTS usuarios_busca_ad AFTER DELETE ON usuarios BEGIN '
+        "INSERT INTO usuarios_busca(usuarios_busca, rowid, nome, email) VALUES ('delete', old.id, old.nome, old.email); END",
+        'CREATE TRIGGER IF NOT EXISTS usuarios_busca_au AFTER UPDATE OF nome, email ON usuarios BEGIN '
+        "INSERT INTO usuarios_busca(usuarios_busca, rowid, nome, email) VALUES ('delete', old.id, old.nome, old.email); "
+        'INSERT INTO usuarios_busca(rowid, nome, email) VALUES (new.id, new.nome, new.email); END',
+        "INSERT INTO usuarios_busca(usuarios_busca, rank) VALUES ('rank', 'bm25(10.0, 5.0)')",
+        "INSERT INTO livros_busca(livros_busca) VALUES ('rebuild')",
+        "INSERT INTO usuarios_busca(usuarios_busca) VALUES ('rebuild')",
+    )
+
+
+@migracao(4)
+def trigramas_livros(conexao: Connection, metadata: MetaData, tamanho_lote: int = 500):
+    _executar(
+        conexao,
+        """
+        CREATE TABLE IF NOT EXISTS livros_trigramas (
+            trigrama VARCHAR(3) NOT NULL,
+            livro_id INTEGER NOT NULL,
+            PRIMARY KEY (trigrama, livro_id),
+            FOREIGN KEY(livro_id) REFERENCES livros (id)
+        ) WITHOUT ROWID
+        """,
+        'CREATE INDEX IF NOT EXISTS ix_livros_trigramas_livro_id ON livros_trigramas (livro_id)',
+    )
+    tabela = table('livros_trigramas', column('trigrama'), column('livro_id'))
+    ultimo_id = 0
+    while True:
+        livros = conexao.execute(
+            text(
+                'SELECT id, titulo, autor FROM livros '
+                'WHERE id > :ultimo_id AND excluido_em IS NULL ORDER BY id LIMIT :tamanho_lote'
+            ),
+            {'ultimo_id': ultimo_id, 'tamanho_lote': tamanho_lote}
+        ).all()
+        if not livros:
+            break
+        trigramas.indexar(conexao, tabela, [tuple(livro) for livro in livros])
+        ultimo_id = livros[-1].id
+
+
+@migracao(5)
+def disponibilidade_livros(conexao: Connection, metadata: MetaData):
+    if 'disponivel' not in _colunas(conexao, 'livros'):
+        conexao.execute(text('ALTER TABLE livros ADD COLUMN disponivel BOOLEAN NOT NULL DEFAULT 1'))
+    conexao.execute(text(
+        'UPDATE livros SET disponivel = NOT EXISTS ('
+        'SELECT 1 FROM emprestimos WHERE emprestimos.livro_id = livros.id '
+        'AND emprestimos.devolvido_em IS NULL AND emprestimos.excluido_em IS NULL)'
+    ))
+    _executar(
+        conexao,
+        'CREATE INDEX IF NOT EXISTS ix_livros_disponiveis ON livros (titulo, id) '
+        'WHERE disponivel = 1 AND excluido_em IS NULL'
+    )
+
+
+@migracao(6)
+def generos_como_etiquetas(conexao: Connection, metadata: MetaData, tamanho_lote: int = 500):
+    _executar(
+        conexao,
+        """
+        CREATE TABLE IF NOT EXISTS generos (
+            chave VARCHAR NOT NULL,
+            nome VARCHAR NOT NULL,
+            id INTEGER NOT NULL,
+            registrado_em DATETIME NOT NULL,
+            editado_em DATETIME,
+            excluido_em DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (chave)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS livros_generos (
+            genero_id INTEGER NOT NULL,
+            livro_id INTEGER NOT NULL,
+            PRIMARY KEY (genero_id, livro_id),
+            FOREIGN KEY(genero_id) REFERENCES generos (id),
+            FOREIGN KEY(livro_id) REFERENCES livros (id)
+        ) WITHOUT ROWID
+        """,
+        'CREATE INDEX IF NOT EXISTS ix_livros_generos_livro_id ON livros_generos (livro_id)',
+        """
+        CREATE TABLE IF NOT EXISTS usuarios_generos (
+            usuario_id INTEGER NOT NULL,
+            genero_id INTEGER NOT NULL,
+            PRIMARY KEY (usuario_id, genero_id),
+            FOREIGN KEY(usuario_id) REFERENCES usuarios (id),
+            FOREIGN KEY(genero_id) REFERENCES generos (id)
+        ) WITHOUT ROWID
+        """,
+        'CREATE INDEX IF NOT EXISTS ix_usuarios_generos_genero_id ON usuarios_generos (genero_id)',
+    )
+    tabela_generos = table(
+        'generos', column('id'), column('chave'), column('nome'), column('registrado_em', DateTime)
+    )
+
+    agora = datetime.now(timezone.utc)
+    for tabela, campo, tabela_ligacao, coluna in [
+        ('livros', 'genero', 'livros_generos', 'livro_id'),
+        ('usuarios', 'genero_preferidos', 'usuarios_generos', 'usuario_id'),
+    ]:
+        ligacao = table(tabela_ligacao, column(coluna), column('genero_id'))
+        ultimo_id = 0
+        while True:
+            registros = conexao.execute(
+                text(
+                    f'SELECT id, {campo} FROM {tabela} '
+                    'WHERE id > :ultimo_id AND excluido_em IS NULL ORDER BY id LIMIT :tamanho_lote'
+                ),
+                {'ultimo_id': ultimo_id, 'tamanho_lote': tamanho_lote}
+            ).all()
+            if not registros:
+                break
+            generos.vincular(
+                conexao, tabela_generos, ligacao, coluna,
+                [tuple(registro) for registro in registros], agora
+            )
+            ultimo_id = registros[-1].id
+
+
+@migracao(7)
+def estatisticas_circulacao(conexao: Connection, metadata: MetaData):
+    _executar(
+        conexao,
+        """
+        CREATE TABLE IF NOT EXISTS estatisticas (
+            dimensao VARCHAR NOT NULL,
+            chave VARCHAR NOT NULL,
+            valor INTEGER NOT NULL,
+            PRIMARY KEY (dimensao, chave)
+        ) WITHOUT ROWID
+        """,
+        'CREATE INDEX IF NOT EXISTS ix_estatisticas_dimensao_valor ON estatisticas (dimensao, valor)',
+    )
+    estatisticas.reconstruir(conexao, {
+        'emprestimos': table(
+            'emprestimos', column('id'), column('livro_id'), column('emprestado_em', Date),
+            column('devolucao_em', Date), column('devolvido_em', Date), column('vezes_adiado'),
+            column('excluido_em')
+        ),
+        'livros': table('livros', column('id'), column('doador_id')),
+        'livros_generos': table('livros_generos', column('livro_id'), column('genero_id')),
+        'estatisticas': table('estatisticas', column('dimensao'), column('chave'), column('valor')),
+    })
+
+
+@migracao(8)
+def versao_registros(conexao: Connection, metadata: MetaData):
+    for tabela in ['usuarios', 'livros', 'generos', 'capas', 'emprestimos']:
+        if 'versao' not in _colunas(conexao, tabela):
+            conexao.execute(text(f'ALTER TABLE {tabela} ADD COLUMN versao INTEGER NOT NULL DEFAULT 1'))
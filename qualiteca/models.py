@@ -1,31 +1,364 @@
-from sqlalchemy.orm import sessionmaker, Session, declarative_base, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, Session, declarative_base, declared_attr, relationship, deferred, joinedload
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.exc import OperationalError
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
     Integer,
     DateTime,
-    String, LargeBinary, ForeignKey, Date, func)
-from typing import Any
+    Boolean,
+    String, LargeBinary, ForeignKey, Date, Index, Table, func, literal, text, update, and_, or_, cast, select, tuple_, table, column, inspect)
+from typing import Any, Callable
+from functools import partial
+from collections import OrderedDict, defaultdict
+from threading import Lock
+from pathlib import Path
+from time import sleep
+from random import uniform
+import sqlite3
 import pendulum, pytz
-import hashlib
-
-engine = create_engine('sqlite:///biblioteca.db')
-Session = sessionmaker(bind=engine)
-session = Session()
+from re import fullmatch
+from imagens import gerar_miniatura, recomprimir, EXTENSAO
+from armazem import ArmazemCapas
+from migracoes import migrar
+from busca import expressao_busca, instalar_busca
+import trigramas
+import generos
+import estatisticas
+from expressoes import dias_entre, somar_dias
+from datetime import date, timedelta
+
+NOME_BANCO_PADRAO = 'biblioteca.db'
+PRAGMAS_PADRAO = {
+    # Só vale para bancos novos; os existentes são convertidos por `manutencao.py arquivar`
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def criar_engine(nome_banco: str = NOME_BANCO_PADRAO, pragmas: dict[str, Any] | None = None):
+    engine = create_engine(f'sqlite:///{nome_banco}')
+    pragmas = {**PRAGMAS_PADRAO, **(pragmas or {})}
+
+    @event.listens_for(engine, 'connect')
+    def aplicar_pragmas(conexao_dbapi, _):
+        cursor = conexao_dbapi.cursor()
+        for nome, valor in pragmas.items():
+            cursor.execute(f'PRAGMA {nome} = {valor}')
+        cursor.close()
+
+    return engine
+
+
+Session = sessionmaker()
 Base = declarative_base()
+CAPACIDADE_CACHE = 256
+MAXIMO_BANCOS_ABERTOS = 8
+TENTATIVAS_BANCO_OCUPADO = 5
+ESPERA_BANCO_OCUPADO = 0.05
+
+
+class CacheConsultas:
+    """
+    Cache de leituras de um banco, compartilhado por todas as sessões que o usam.
+
+    Cada entrada guarda a geração das tabelas de que depende no momento em que
+    foi carregada. Toda transação confirmada avança a geração das tabelas que
+    alterou, então uma entrada só é servida enquanto nada do que ela leu mudou.
+    As mais antigas saem quando a capacidade é atingida.
+
+    Os objetos ficam soltos, fora de qualquer sessão, e são copiados para a
+    sessão da rodada sem consultar o banco (`Session.merge(load=False)`).
+    Escritas feitas por outro processo no mesmo arquivo não são percebidas.
+    """
+
+    def __init__(self, engine, capacidade: int = CAPACIDADE_CACHE) -> None:
+        self.engine = engine
+        self.capacidade = capacidade
+        self.itens = OrderedDict()
+        self.geracoes = defaultdict(int)
+        self.acertos = 0
+        self.faltas = 0
+        self.trava = Lock()
+
+    def _geracao(self, tabelas: tuple[str, ...]) -> tuple[int, ...]:
+        return tuple(self.geracoes[tabela] for tabela in tabelas)
+
+    def consultar(self, tabelas: tuple[str, ...], chave: tuple, carregar: Callable[[Any], Any]):
+        with self.trava:
+            geracao = self._geracao(tabelas)
+            item = self.itens.get(chave)
+            if item is not None and item[0] == geracao:
+                self.itens.move_to_end(chave)
+                self.acertos += 1
+                return _anexar(item[1])
+            self.faltas += 1
+
+        # Carrega numa sessão própria, para que os objetos guardados nunca
+        # sejam alterados por quem os recebe
+        with Session(bind=self.engine) as sessao:
+            valor = carregar(sessao)
+            sessao.expunge_all()
+
+        with self.trava:
+            # Se houve escrita durante a carga, a geração anotada já é antiga
+            # e a entrada será descartada na próxima consulta
+            self.itens[chave] = (geracao, valor)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.capacidade:
+                self.itens.popitem(last=False)
+        return _anexar(valor)
+
+    def invalidar(self, *tabelas: str):
+        with self.trava:
+            for tabela in tabelas:
+                self.geracoes[tabela] += 1
+
+    def limpar(self):
+        with self.trava:
+            self.itens.clear()
+
+    def estatisticas(self) -> dict[str, int]:
+        with self.trava:
+            return {
+                'acertos': self.acertos,
+                'faltas': self.faltas,
+                'itens': len(self.itens),
+                'capacidade': self.capacidade
+            }
+
+
+class Banco:
+    """Engine, cache de leituras e armazém de capas de um arquivo de banco."""
+
+    def __init__(self, nome_banco: str, pragmas: dict[str, Any] | None = None, diretorio_capas=None,
+                 capas_publicas: bool = False) -> None:
+        self.nome_banco = nome_banco
+        self.pragmas = {**PRAGMAS_PADRAO, **(pragmas or {})}
+        self.engine = criar_engine(nome_banco, pragmas)
+        self.cache = CacheConsultas(self.engine)
+        self.armazem_capas = None
+        self.usar_armazem(diretorio_capas, capas_publicas)
+        migrar(self.engine, Base.metadata)
+
+    def usar_armazem(self, diretorio_capas, capas_publicas: bool = False):
+        atual = (self.armazem_capas.diretorio, self.armazem_capas.publicas) if self.armazem_capas else None
+        novo = (Path(diretorio_capas), capas_publicas) if diretorio_capas else None
+        if novo != atual:
+            self.armazem_capas = ArmazemCapas(*novo) if novo else None
+
+    def fechar(self):
+        self.engine.dispose()
+        self.cache.limpar()
+
+
+def _chave_banco(nome_banco: str) -> str:
+    # O mesmo arquivo é o mesmo banco, seja qual for o caminho usado para chegar nele
+    return str(Path(nome_banco).resolve())
+
+
+class RegistroBancos:
+    """
+    Bancos abertos pelo processo, um por arquivo, criados no primeiro uso.
+
+    Cada biblioteca servida tem o seu arquivo, e com ele a sua engine e o seu
+    cache, então as consultas de uma nunca são servidas a outra. Passando de
+    `capacidade`, o banco usado há mais tempo é fechado; sessões que ainda o
+    usem continuam funcionando, e ele é reaberto se voltar a ser pedido.
+    """
+
+    def __init__(self, capacidade: int = MAXIMO_BANCOS_ABERTOS) -> None:
+        self.capacidade = capacidade
+        self.bancos = OrderedDict()
+        self.padrao = (NOME_BANCO_PADRAO, None, None)
+        self.trava = Lock()
+
+    def obter(self, nome_banco: str, pragmas: dict[str, Any] | None = None, diretorio_capas=None,
+              capas_publicas: bool = False) -> Banco:
+        chave = _chave_banco(nome_banco)
+        with self.trava:
+            banco = self.bancos.get(chave)
+            if banco is not None and banco.pragmas != {**PRAGMAS_PADRAO, **(pragmas or {})}:
+                banco.fechar()
+                banco = None
+            if banco is None:
+                banco = Banco(nome_banco, pragmas, diretorio_capas, capas_publicas)
+                self.bancos[chave] = banco
+                while len(self.bancos) > self.capacidade:
+                    _, antigo = self.bancos.popitem(last=False)
+                    antigo.fechar()
+            else:
+                banco.usar_armazem(diretorio_capas, capas_publicas)
+            self.bancos.move_to_end(chave)
+            return banco
+
+    def obter_padrao(self) -> Banco:
+        return self.obter(*self.padrao)
+
+
+registro_bancos = RegistroBancos()
+
+
+def _nova_sessao(banco: Banco | None = None) -> Session:
+    banco = banco or registro_bancos.obter_padrao()
+    return Session(bind=banco.engine, info={'banco': banco})
+
+
+# Uma sessão por thread, e o streamlit executa cada rodada do script em uma
+# thread própria. A rodada começa com `usar_banco`, que liga a sessão ao banco
+# da biblioteca em uso, e `encerrar_sessao` deve ser chamado ao fim dela.
+# Fora do app a sessão usa o banco padrão (`configurar_banco`).
+session = scoped_session(_nova_sessao)
+
+
+def banco_atual() -> Banco:
+    return session.info['banco']
+
+
+def _anexar(valor):
+    if isinstance(valor, list):
+        return [_anexar(item) for item in valor]
+    if isinstance(valor, tuple):
+        return tuple(_anexar(item) for item in valor)
+    if isinstance(valor, ModeloBase):
+        return session.merge(valor, load=False)
+    return valor
+
+
+@event.listens_for(Session, 'after_flush')
+def _anotar_tabelas_alteradas(sessao, _):
+    alteradas = sessao.info.setdefault('tabelas_alteradas', set())
+    for objeto in (*sessao.new, *sessao.dirty, *sessao.deleted):
+        alteradas.add(objeto.__table__.name)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _anotar_tabelas_alteradas_em_massa(estado):
+    if (estado.is_update or estado.is_delete or estado.is_insert) and estado.bind_mapper is not None:
+        sessao = estado.session
+        sessao.info.setdefault('tabelas_alteradas', set()).add(estado.bind_mapper.local_table.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidar_cache(sessao):
+    sessao.info['banco'].cache.invalidar(*sessao.info.pop('tabelas_alteradas', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_tabelas_alteradas(sessao):
+    sessao.info.pop('tabelas_alteradas', None)
 
 def agora():
     return pendulum.now(pytz.UTC)
 
 
+def encerrar_sessao():
+    session.remove()
+
+
+class ConflitoEdicao(Exception):
+    """O registro foi alterado por outra pessoa depois de ter sido exibido."""
+
+    def __init__(self, modelo: str, id: int) -> None:
+        super().__init__(
+            f'{modelo} #{id} foi alterado por outra pessoa enquanto você o via. '
+            'Confira os dados atualizados e tente de novo.'
+        )
+
+
+def _banco_ocupado(erro: OperationalError) -> bool:
+    # Códigos estendidos (SQLITE_BUSY_SNAPSHOT e afins) têm o básico no byte baixo
+    codigo = getattr(erro.orig, 'sqlite_errorcode', None)
+    return codigo is not None and codigo & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+def _repetir_se_ocupado(operacao: Callable[[], Any]):
+    """
+    Executa `operacao`, que deve terminar em commit. Se o SQLite responder que
+    o banco está ocupado, desfaz a transação e tenta de novo algumas vezes,
+    esperando mais a cada tentativa; qualquer outro erro desfaz e é relançado.
+    """
+    for tentativa in range(TENTATIVAS_BANCO_OCUPADO):
+        try:
+            return operacao()
+        except OperationalError as e:
+            session.rollback()
+            if not _banco_ocupado(e) or tentativa == TENTATIVAS_BANCO_OCUPADO - 1:
+                raise e
+            sleep(ESPERA_BANCO_OCUPADO * 2 ** tentativa * uniform(0.5, 1.5))
+        except Exception as e:
+            session.rollback()
+            raise e
+
+
+def configurar_banco(nome_banco: str = NOME_BANCO_PADRAO, pragmas: dict[str, Any] | None = None) -> Banco:
+    # Banco usado pelas sessões que não passaram por `usar_banco`
+    session.remove()
+    registro_bancos.padrao = (nome_banco, pragmas, registro_bancos.padrao[2])
+    return registro_bancos.obter_padrao()
+
+
+def usar_banco(nome_banco: str, pragmas: dict[str, Any] | None = None, diretorio_capas=None,
+               capas_publicas: bool = False) -> Banco:
+    # Começa a sessão desta thread no banco informado, aberto no primeiro uso
+    banco = registro_bancos.obter(nome_banco, pragmas, diretorio_capas, capas_publicas)
+    session.remove()
+    session(banco=banco)
+    return banco
+
+
+def consolidar_banco():
+    # Traz para o arquivo principal o que ainda está no -wal, para que uma
+    # cópia do arquivo .db tenha todos os dados confirmados
+    with banco_atual().engine.connect() as conexao:
+        conexao.execute(text('PRAGMA wal_checkpoint(TRUNCATE)'))
+
+
+def fechar_conexoes():
+    # Fecha as conexões do banco em uso; as próximas já abrem o arquivo, que
+    # pode ter sido substituído (restauração de backup)
+    banco = banco_atual()
+    session.remove()
+    banco.fechar()
+    session(banco=banco)
+
+
+def atualizar_esquema():
+    migrar(banco_atual().engine, Base.metadata)
+
+
+def configurar_armazem_capas(diretorio=None):
+    session.remove()
+    registro_bancos.padrao = (*registro_bancos.padrao[:2], diretorio)
+    return registro_bancos.obter_padrao().armazem_capas
+
+
+# Bancos novos são criados direto pelo metadata, sem passar pelas migrações
+event.listen(Base.metadata, 'after_create', lambda _, conexao, **kwargs: instalar_busca(conexao))
+
+
 class ModeloBase(Base):
 
     __abstract__ = True
+    tabela_busca = None
+    # Tabelas lidas junto com o modelo por carregamento antecipado
+    tabelas_relacionadas = ()
 
     id = Column(Integer, primary_key=True)
     registrado_em = Column(DateTime, default=agora, nullable=False)
     editado_em = Column(DateTime)
     excluido_em = Column(DateTime)
+    # Incrementada a cada UPDATE do ORM, que só casa com a versão lida
+    versao = Column(Integer, nullable=False, default=1, server_default=text('1'))
+
+    @declared_attr
+    def __mapper_args__(cls):
+        return {'version_id_col': cls.versao}
 
     @classmethod
     @property
@@ -63,54 +396,218 @@ class ModeloBase(Base):
     def __str__(self):
         return f"<{self.__class__.__name__}(id={self.id})>"
 
+    # Pontos de extensão chamados antes do commit, para que os dados derivados
+    # de um modelo sejam gravados na mesma transação que ele
+    def _apos_adicionar(self):
+        pass
+
+    def _antes_editar(self, edicao: dict[str, Any]):
+        pass
+
+    def _apos_editar(self, edicao: dict[str, Any]):
+        pass
+
+    @classmethod
+    def _antes_editar_muitos(cls, condicao, edicao: dict[str, Any]):
+        pass
+
+    @classmethod
+    def _apos_editar_muitos(cls, editados: list[int], edicao: dict[str, Any]):
+        pass
+
     @classmethod
     def adicionar(cls, **kwargs):
-        try:
+        def operacao():
             novo = cls(**kwargs)
             session.add(novo)
+            novo._apos_adicionar()
             session.commit()
             return novo
+        return _repetir_se_ocupado(operacao)
+
+    @classmethod
+    def _filtro(cls, campo='id', valor=None):
+        if valor is None:
+            return True
+        atributo = getattr(cls, campo)
+        # Em "excluidos", "devolvidos" e afins, gera "IS NULL"/"IS NOT NULL",
+        # que o SQLite consegue casar com os índices parciais
+        if isinstance(valor, bool):
+            return atributo if valor else ~atributo
+        return (atributo == valor)
+
+    @classmethod
+    def adicionar_muitos(cls, registros: list[dict[str, Any]]) -> list[int]:
+        # Insere todos na mesma transação e solta as instâncias da sessão,
+        # para que lotes grandes não fiquem acumulados na memória
+        try:
+            novos = [cls(**registro) for registro in registros]
+            session.add_all(novos)
+            session.commit()
+            ids = [novo.id for novo in novos]
+            for novo in novos:
+                session.expunge(novo)
+            return ids
         except Exception as e:
             session.rollback()
             raise e
 
+    @classmethod
+    def buscar(cls, termo: str, *criterios, limite: int = 10, colunas: tuple[str, ...] | None = None) -> list:
+        # Busca textual com prefixo nas palavras, das mais relevantes para as menos.
+        # Com `colunas`, retorna só essas colunas, como em `ModeloBase.colunas`
+        expressao = expressao_busca(termo)
+        if cls.tabela_busca is None or expressao is None:
+            return []
+
+        busca = table(cls.tabela_busca, column('rowid'), column('rank'))
+        instrucao = (
+            select(*[getattr(cls, nome) for nome in colunas] if colunas else [cls])
+            .join(busca, busca.c.rowid == cls.id)
+            .where(
+                text(f'{cls.tabela_busca} MATCH :expressao').bindparams(expressao=expressao),
+                ~cls.excluidos,
+                *criterios
+            )
+            .order_by(busca.c.rank)
+            .limit(limite)
+        )
+        if colunas:
+            return session.execute(instrucao).all()
+        return session.scalars(instrucao).all()
+
+    @classmethod
+    def _em_cache(cls, chave: tuple, carregar: Callable[[Any], Any], *outras_tabelas: str):
+        tabelas = (cls.__tablename__, *cls.tabelas_relacionadas, *outras_tabelas)
+        return banco_atual().cache.consultar(tabelas, (cls.__name__, *chave), carregar)
+
+    @classmethod
+    def obter(cls, id: int):
+        return cls._em_cache(('obter', id), lambda sessao: sessao.get(cls, id))
+
     @classmethod
     def retornar(cls, campo='id', valor=None):
-        if valor is None:
-            filtro = True
-        else:
-            filtro = (getattr(cls, campo) == valor)
-        return session.query(cls).where(cls.excluidos == False, filtro).all()
+        return cls._em_cache(
+            ('retornar', campo, valor),
+            lambda sessao: sessao.query(cls).where(~cls.excluidos, cls._filtro(campo, valor)).all()
+        )
 
+    @classmethod
+    def colunas(cls, *nomes: str, campo='id', valor=None, ordem='id', por_coluna=False):
+        """
+        Retorna só as colunas pedidas dos registros não excluídos, sem montar
+        objetos do ORM: linhas nomeadas (`linha.nome`) ou, com `por_coluna`,
+        um dicionário com uma lista de valores por coluna.
+        """
+        linhas = cls._em_cache(
+            ('colunas', nomes, campo, valor, ordem),
+            lambda sessao: sessao.execute(
+                select(*[getattr(cls, nome) for nome in nomes])
+                .where(~cls.excluidos, cls._filtro(campo, valor))
+                .order_by(getattr(cls, ordem), cls.id)
+            ).all()
+        )
+        if por_coluna:
+            return {nome: [linha[posicao] for linha in linhas] for posicao, nome in enumerate(nomes)}
+        return linhas
 
-    def editar(self, edicao: dict[str, Any]):
-        for campo_edicao, valor_edicao in edicao.items():
-            setattr(self, campo_edicao, valor_edicao)
+    @classmethod
+    def paginar(cls, campo='id', valor=None, ordem='id', decrescente=False, depois_de=None, tamanho_pagina=20):
+        """
+        Retorna uma página de registros e o cursor da próxima, ou None na última.
+
+        A paginação é por chave (keyset): o cursor é o par (valor de `ordem`, id)
+        do último registro da página, então o custo não cresce com o número da página.
+        """
+        return cls._em_cache(
+            ('paginar', campo, valor, ordem, decrescente, depois_de, tamanho_pagina),
+            partial(cls._paginar, campo, valor, ordem, decrescente, depois_de, tamanho_pagina)
+        )
 
-        setattr(self, 'editado_em', agora())
+    @classmethod
+    def _paginar(cls, campo, valor, ordem, decrescente, depois_de, tamanho_pagina, sessao):
+        coluna_ordem = getattr(cls, ordem)
+        consulta = sessao.query(cls).where(~cls.excluidos, cls._filtro(campo, valor))
+
+        if depois_de is not None:
+            valor_ordem, ultimo_id = depois_de
+            if decrescente:
+                consulta = consulta.where(or_(
+                    coluna_ordem < valor_ordem,
+                    and_(coluna_ordem == valor_ordem, cls.id < ultimo_id)
+                ))
+            else:
+                consulta = consulta.where(or_(
+                    coluna_ordem > valor_ordem,
+                    and_(coluna_ordem == valor_ordem, cls.id > ultimo_id)
+                ))
 
-        try:
+        if decrescente:
+            consulta = consulta.order_by(coluna_ordem.desc(), cls.id.desc())
+        else:
+            consulta = consulta.order_by(coluna_ordem, cls.id)
+
+        registros = consulta.limit(tamanho_pagina + 1).all()
+        pagina = registros[:tamanho_pagina]
+        if len(registros) > tamanho_pagina:
+            ultimo = pagina[-1]
+            return pagina, (getattr(ultimo, ordem), ultimo.id)
+        return pagina, None
+
+
+    def editar(self, edicao: dict[str, Any], versao: int | None = None):
+        # `versao` é a que estava na tela de quem pediu a edição; sem ela, vale
+        # a lida agora. O UPDATE só é aplicado se o registro ainda estiver nela
+        versao = self.versao if versao is None else versao
+        modelo, id = self.__class__.__name__, self.id
+
+        def operacao():
+            if self.versao != versao:
+                raise StaleDataError()
+            self._antes_editar(edicao)
+            for campo_edicao, valor_edicao in edicao.items():
+                setattr(self, campo_edicao, valor_edicao)
+
+            setattr(self, 'editado_em', agora())
+            self._apos_editar(edicao)
             session.commit()
 
-        except Exception as e:
-            session.rollback()
-            raise e
-        
-        finally:
-            return self
+        try:
+            _repetir_se_ocupado(operacao)
+        except StaleDataError as e:
+            # O cache pode ter servido a versão antiga; a próxima leitura vai ao banco
+            banco_atual().cache.invalidar(self.__tablename__)
+            raise ConflitoEdicao(modelo, id) from e
+        return self
+
 
+    @classmethod
+    def _nas_versoes(cls, versoes: dict[int, int]):
+        # Registros {id: versão} que ainda estão na versão informada
+        return tuple_(cls.id, cls.versao).in_(list(versoes.items()))
 
     @classmethod
-    def editar_muitos(cls, edicao: dict[str, Any], campo='id', valor=None):
-        objetos = cls.retornar(campo=campo, valor=valor)
-        editados = []
-        for objeto in objetos:
-            editados.append(objeto.editar(edicao=edicao))
-        return editados
+    def editar_muitos(cls, edicao: dict[str, Any], campo='id', valor=None, criterios=()) -> list[int]:
+        # Um único UPDATE ... WHERE em uma transação; retorna os ids alterados
+        condicao = and_(~cls.excluidos, cls._filtro(campo, valor), *criterios)
+        instrucao = (
+            update(cls)
+            .where(condicao)
+            .values({**edicao, 'editado_em': agora(), 'versao': cls.versao + 1})
+            .returning(cls.id)
+        )
+
+        def operacao():
+            cls._antes_editar_muitos(condicao, edicao)
+            editados = session.execute(instrucao).scalars().all()
+            cls._apos_editar_muitos(editados, edicao)
+            session.commit()
+            return editados
+        return _repetir_se_ocupado(operacao)
     
 
-    def excluir(self):
-        return self.editar(edicao={'excluido_em':agora()})
+    def excluir(self, versao: int | None = None):
+        return self.editar(edicao={'excluido_em':agora()}, versao=versao)
 
     
     @classmethod
@@ -126,6 +623,10 @@ class ModeloBase(Base):
 
 class Usuario(ModeloBase):
     __tablename__ = 'usuarios'
+    tabela_busca = 'usuarios_busca'
+    __table_args__ = (
+        Index('ix_usuarios_nome', 'nome', 'id', sqlite_where=text('excluido_em IS NULL')),
+    )
 
     nome = Column(String, nullable=False)
     email = Column(String, nullable=False)
@@ -134,13 +635,59 @@ class Usuario(ModeloBase):
     emprestimos = relationship('Emprestimo', back_populates='leitor')
     doacao = relationship('Livro', back_populates='doador')
 
+    @classmethod
+    def _apos_editar_muitos(cls, editados: list[int], edicao: dict[str, Any]):
+        if editados and {'genero_preferidos', 'excluido_em'} & set(edicao):
+            _revincular_generos(cls, usuarios_generos, 'usuario_id', cls.genero_preferidos, editados)
+
+    @staticmethod
+    def email_valido(email: str) -> bool:
+        return fullmatch(r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+', email) is not None
+
     def volume_emprestimos_ativos(self):
+        # A mesma contagem, e o mesmo cache, da lista de empréstimos
+        return Usuario.volumes_emprestimos_ativos([self.id]).get(self.id, 0)
 
-        livros_emprestados = session.query(Emprestimo.id).filter(
-            (Emprestimo.devolvidos == False), (self.id == Emprestimo.leitor_id)
-        ).count()
+    @classmethod
+    def generos_por_usuario(cls, usuarios_id: list[int]) -> dict[int, tuple[str, ...]]:
+        # Os gêneros preferidos já normalizados, pelas etiquetas de `generos`
+        if not usuarios_id:
+            return {}
+
+        usuarios_id = tuple(sorted(set(usuarios_id)))
+
+        def carregar(sessao):
+            por_usuario = defaultdict(list)
+            for usuario_id, nome in (
+                sessao.query(usuarios_generos.c.usuario_id, Genero.nome)
+                .join(Genero, Genero.id == usuarios_generos.c.genero_id)
+                .where(usuarios_generos.c.usuario_id.in_(usuarios_id))
+                .order_by(Genero.nome)
+            ):
+                por_usuario[usuario_id].append(nome)
+            return {usuario_id: tuple(nomes) for usuario_id, nomes in por_usuario.items()}
+
+        return cls._em_cache(('generos_por_usuario', usuarios_id), carregar, 'usuarios_generos', 'generos')
 
-        return livros_emprestados
+    @classmethod
+    def volumes_emprestimos_ativos(cls, leitores_id: list[int]) -> dict[int, int]:
+        if not leitores_id:
+            return {}
+
+        leitores_id = tuple(sorted(set(leitores_id)))
+        return Emprestimo._em_cache(
+            ('volumes_ativos', leitores_id),
+            lambda sessao: dict(
+                sessao.query(Emprestimo.leitor_id, func.count(Emprestimo.id))
+                .where(
+                    ~Emprestimo.excluidos,
+                    ~Emprestimo.devolvidos,
+                    Emprestimo.leitor_id.in_(leitores_id)
+                )
+                .group_by(Emprestimo.leitor_id)
+                .all()
+            )
+        )
 
 
     def emprestimos_pendentes(self):
@@ -151,72 +698,358 @@ class Usuario(ModeloBase):
         return f"({self.id}) {self.nome}"
 
 
-    @property
-    def chave_container(self):
-        letras_correspondentes = {
-            '0': 'ab',
-            '1': 'cd',
-            '2': 'ef',
-            '3': 'gh',
-            '4': 'ij',
-            '5': 'kl',
-            '6': 'mn',
-            '7': 'op',
-            '8': 'qr',
-            '9': 'st'
-        }
-
-        dados_para_hash = f"{self.id}{self.nome}{self.email}{self.genero_preferidos}{self.registrado_em}"
-        sha256_hash = hashlib.sha256(dados_para_hash.encode()).hexdigest()
-
-        retorno = ''
-        for caractere in sha256_hash:
-            if caractere in letras_correspondentes.keys():
-                retorno += letras_correspondentes[caractere]
-            else:
-                retorno += caractere
-
-        return retorno
-
-
 class Livro(ModeloBase):
     __tablename__ = 'livros'
+    tabela_busca = 'livros_busca'
+    tabelas_relacionadas = ('capas',)
+    __table_args__ = (
+        Index('ix_livros_doador_id', 'doador_id'),
+        Index('ix_livros_titulo', 'titulo', 'id', sqlite_where=text('excluido_em IS NULL')),
+        Index(
+            'ix_livros_disponiveis', 'titulo', 'id',
+            sqlite_where=text('disponivel = 1 AND excluido_em IS NULL')
+        ),
+    )
     def tempo_emprestimo_padrao(): return 1
 
     titulo = Column(String, nullable=False)
     autor = Column(String, nullable=False)
     genero = Column(String, nullable=False)
     doador_id = Column(Integer, ForeignKey('usuarios.id'), nullable=False)
-    foto_livro = Column(LargeBinary, nullable=False)
     observacao = Column(String, nullable=True)
-    extensao_foto = Column(String, nullable=False)
+    # Mantido por Emprestimo (ver `Emprestimo.atualizar_disponibilidade`)
+    disponivel = Column(Boolean, nullable=False, default=True, server_default=text('1'))
 
     doador = relationship('Usuario', back_populates='doacao')
     emprestimos = relationship('Emprestimo', back_populates='livro')
+    capa = relationship('Capa', back_populates='livro', uselist=False, lazy='selectin', cascade='all, delete-orphan')
+
+    def _capa_editavel(self):
+        if self.capa is None:
+            self.capa = Capa()
+        return self.capa
+
+    @property
+    def foto_livro(self):
+        return self.capa.conteudo_foto if self.capa else None
+
+    @foto_livro.setter
+    def foto_livro(self, conteudo: bytes):
+        self._capa_editavel().receber_foto(conteudo)
+
+    @property
+    def extensao_foto(self):
+        return self.capa.extensao if self.capa else None
+
+    @property
+    def miniatura(self):
+        return self.capa.conteudo_miniatura if self.capa else None
 
 
     def emprestimos_pendentes(self):
         return Emprestimo.retornar_por_livro(livro=self, devolvidos=False)
 
+    @classmethod
+    @property
+    def nao_emprestados(cls):
+        # "= 1", não "IS 1", para o SQLite usar o índice parcial de disponíveis
+        return cls.disponivel == True
+
     @classmethod
     def disponiveis(cls):
-        livros_emprestados = (
-            session.query(Emprestimo.livro_id)
-            .filter( ~Emprestimo.devolvidos)
+        return cls._em_cache(
+            ('disponiveis',),
+            lambda sessao: (
+                sessao.query(Livro)
+                .where(Livro.nao_emprestados, ~Livro.excluidos)
+                .order_by(Livro.titulo, Livro.id)
+                .all()
+            )
+        )
+
+    @classmethod
+    def quantidade_disponiveis(cls) -> int:
+        return cls._em_cache(
+            ('quantidade_disponiveis',),
+            lambda sessao: sessao.query(func.count(Livro.id)).where(Livro.nao_emprestados, ~Livro.excluidos).scalar()
+        )
+
+
+
+    @classmethod
+    def _apos_editar_muitos(cls, editados: list[int], edicao: dict[str, Any]):
+        # O UPDATE em massa não passa pelos eventos do ORM que mantêm os
+        # trigramas e os gêneros
+        if editados and {'titulo', 'autor', 'excluido_em'} & set(edicao):
+            cls.reindexar_trigramas(editados)
+        if editados and {'genero', 'excluido_em'} & set(edicao):
+            _revincular_generos(cls, livros_generos, 'livro_id', cls.genero, editados)
+
+    @classmethod
+    def recomendados(cls, leitor_id: int, limite: int = 5) -> list[tuple['Livro', int]]:
+        """
+        Livros disponíveis nos gêneros preferidos do leitor, que ele ainda não
+        pegou emprestado, com quantos gêneros em comum cada um tem.
+        """
+        afinidade = func.count(livros_generos.c.genero_id).label('afinidade')
+        ja_emprestado = (
+            select(Emprestimo.id)
+            .where(Emprestimo.livro_id == cls.id, Emprestimo.leitor_id == leitor_id, ~Emprestimo.excluidos)
+            .exists()
+        )
+        return cls._em_cache(
+            ('recomendados', leitor_id, limite),
+            lambda sessao: [
+                tuple(linha) for linha in sessao.execute(
+                    select(cls, afinidade)
+                    .select_from(usuarios_generos)
+                    .join(livros_generos, livros_generos.c.genero_id == usuarios_generos.c.genero_id)
+                    .join(cls, cls.id == livros_generos.c.livro_id)
+                    .where(usuarios_generos.c.usuario_id == leitor_id, cls.nao_emprestados, ~cls.excluidos, ~ja_emprestado)
+                    .group_by(cls.id)
+                    .order_by(afinidade.desc(), cls.titulo)
+                    .limit(limite)
+                ).all()
+            ],
+            'usuarios', 'emprestimos'
         )
 
-        return session.query(Livro).filter(
-            Livro.id.not_in(livros_emprestados)
+    @classmethod
+    def reindexar_trigramas(cls, livros_id: list[int]):
+        livros = session.execute(
+            select(cls.id, cls.titulo, cls.autor, cls.excluido_em).where(cls.id.in_(livros_id))
         ).all()
+        trigramas.remover(session, livros_trigramas, livros_id)
+        trigramas.indexar(session, livros_trigramas, [
+            (id, titulo, autor) for id, titulo, autor, excluido_em in livros if excluido_em is None
+        ])
 
+    @classmethod
+    def parecidos(cls, titulo: str, autor: str = '', limite: int = 5, limiar: float = 0.4) -> list[tuple['Livro', float]]:
+        """
+        Livros da estante com titulo + autor parecidos, do mais ao menos
+        parecido, com a similaridade (0 a 1) de cada um.
+        """
+        procurados = trigramas.trigramas(titulo, autor)
+        if not procurados:
+            return []
 
+        candidatos = session.execute(
+            select(livros_trigramas.c.livro_id, func.count())
+            .where(livros_trigramas.c.trigrama.in_(procurados))
+            .group_by(livros_trigramas.c.livro_id)
+            .order_by(func.count().desc())
+            .limit(limite * 5)
+        ).all()
+        if not candidatos:
+            return []
+
+        totais = dict(session.execute(
+            select(livros_trigramas.c.livro_id, func.count())
+            .where(livros_trigramas.c.livro_id.in_([id for id, _ in candidatos]))
+            .group_by(livros_trigramas.c.livro_id)
+        ).all())
+        notas = {
+            id: trigramas.similaridade(comuns, len(procurados), totais[id])
+            for id, comuns in candidatos
+        }
+        ids = sorted((id for id, nota in notas.items() if nota >= limiar), key=notas.get, reverse=True)[:limite]
+        if not ids:
+            return []
+
+        livros = session.query(cls).where(cls.id.in_(ids), ~cls.excluidos).all()
+        return sorted(((livro, notas[livro.id]) for livro in livros), key=lambda par: par[1], reverse=True)
 
     def __str__(self):
         return f"({self.id}) {self.titulo} ({self.autor})"
 
 
+livros_trigramas = Table(
+    'livros_trigramas',
+    Base.metadata,
+    Column('trigrama', String(3), primary_key=True),
+    Column('livro_id', Integer, ForeignKey('livros.id'), primary_key=True),
+    Index('ix_livros_trigramas_livro_id', 'livro_id'),
+    sqlite_with_rowid=False,
+)
+
+
+@event.listens_for(Livro, 'after_insert')
+def _indexar_trigramas_livro_novo(mapper, conexao, livro):
+    trigramas.indexar(conexao, livros_trigramas, [(livro.id, livro.titulo, livro.autor)])
+
+
+@event.listens_for(Livro, 'after_update')
+def _reindexar_trigramas_livro(mapper, conexao, livro):
+    # Roda no mesmo flush de adicionar/editar/excluir, então o índice é gravado
+    # na mesma transação que o livro
+    estado = inspect(livro)
+    if not any(estado.attrs[campo].history.has_changes() for campo in ('titulo', 'autor', 'excluido_em')):
+        return
+    if livro.excluido:
+        trigramas.remover(conexao, livros_trigramas, [livro.id])
+    else:
+        trigramas.indexar(conexao, livros_trigramas, [(livro.id, livro.titulo, livro.autor)])
+
+
+class Genero(ModeloBase):
+    __tablename__ = 'generos'
+
+    # Nome sem acentos, pontuação nem maiúsculas, para juntar grafias diferentes
+    chave = Column(String, nullable=False, unique=True)
+    nome = Column(String, nullable=False)
+
+    def __str__(self):
+        return self.nome
+
+
+# Índices invertidos: por gênero, os livros e os leitores ligados a ele
+livros_generos = Table(
+    'livros_generos',
+    Base.metadata,
+    Column('genero_id', Integer, ForeignKey('generos.id'), primary_key=True),
+    Column('livro_id', Integer, ForeignKey('livros.id'), primary_key=True),
+    Index('ix_livros_generos_livro_id', 'livro_id'),
+    sqlite_with_rowid=False,
+)
+
+usuarios_generos = Table(
+    'usuarios_generos',
+    Base.metadata,
+    Column('usuario_id', Integer, ForeignKey('usuarios.id'), primary_key=True),
+    Column('genero_id', Integer, ForeignKey('generos.id'), primary_key=True),
+    Index('ix_usuarios_generos_genero_id', 'genero_id'),
+    sqlite_with_rowid=False,
+)
+
+
+def _revincular_generos(modelo, tabela_ligacao: Table, coluna: str, campo_generos, ids: list[int]):
+    registros = session.execute(
+        select(modelo.id, campo_generos, modelo.excluido_em).where(modelo.id.in_(ids))
+    ).all()
+    generos.desvincular(session, tabela_ligacao, coluna, ids)
+    generos.vincular(session, Genero.__table__, tabela_ligacao, coluna, [
+        (id, texto) for id, texto, excluido_em in registros if excluido_em is None
+    ], agora())
+
+
+def _manter_generos(tabela_ligacao: Table, coluna: str, campo: str):
+    # Liga os gêneros no mesmo flush em que o registro é gravado
+    def apos_inserir(mapper, conexao, registro):
+        generos.vincular(conexao, Genero.__table__, tabela_ligacao, coluna, [(registro.id, getattr(registro, campo))], agora())
+
+    def apos_atualizar(mapper, conexao, registro):
+        estado = inspect(registro)
+        if not any(estado.attrs[nome].history.has_changes() for nome in (campo, 'excluido_em')):
+            return
+        if registro.excluido:
+            generos.desvincular(conexao, tabela_ligacao, coluna, [registro.id])
+        else:
+            apos_inserir(mapper, conexao, registro)
+
+    return apos_inserir, apos_atualizar
+
+
+for _modelo, _tabela_ligacao, _coluna, _campo in [
+    (Livro, livros_generos, 'livro_id', 'genero'),
+    (Usuario, usuarios_generos, 'usuario_id', 'genero_preferidos'),
+]:
+    _apos_inserir, _apos_atualizar = _manter_generos(_tabela_ligacao, _coluna, _campo)
+    event.listen(_modelo, 'after_insert', _apos_inserir)
+    event.listen(_modelo, 'after_update', _apos_atualizar)
+
+
+class Capa(ModeloBase):
+    __tablename__ = 'capas'
+
+    livro_id = Column(Integer, ForeignKey('livros.id'), nullable=False, unique=True)
+    miniatura = Column(LargeBinary, nullable=True)
+    foto = deferred(Column(LargeBinary, nullable=True))
+    extensao = Column(String, nullable=False)
+    digest = Column(String(64), nullable=True)
+    digest_miniatura = Column(String(64), nullable=True)
+
+    livro = relationship('Livro', back_populates='capa')
+
+    @property
+    def no_armazem(self):
+        return self.digest is not None
+
+    @property
+    def conteudo_foto(self):
+        if self.no_armazem:
+            return banco_atual().armazem_capas.ler(self.digest, self.extensao)
+        return self.foto
+
+    @property
+    def conteudo_miniatura(self):
+        if self.no_armazem:
+            return banco_atual().armazem_capas.ler(self.digest_miniatura, EXTENSAO)
+        return self.miniatura
+
+    @property
+    def url_foto(self):
+        if self.no_armazem:
+            return banco_atual().armazem_capas.url(self.digest, self.extensao)
+        return None
+
+    @property
+    def url_miniatura(self):
+        if self.no_armazem:
+            return banco_atual().armazem_capas.url(self.digest_miniatura, EXTENSAO)
+        return None
+
+    def receber_foto(self, conteudo: bytes):
+        self.guardar_foto(recomprimir(conteudo))
+
+    def guardar_foto(self, foto: bytes):
+        # `foto` já recomprimida
+        miniatura = gerar_miniatura(foto)
+        self.extensao = EXTENSAO
+
+        if banco_atual().armazem_capas is None:
+            self.foto, self.miniatura = foto, miniatura
+            self.digest, self.digest_miniatura = None, None
+        else:
+            self.guardar_no_armazem(foto, miniatura)
+
+    def guardar_no_armazem(self, foto: bytes, miniatura: bytes):
+        self.digest = banco_atual().armazem_capas.guardar(foto, self.extensao)
+        self.digest_miniatura = banco_atual().armazem_capas.guardar(miniatura, EXTENSAO)
+        self.foto, self.miniatura = None, None
+
+    @classmethod
+    def referenciadas(cls) -> set[tuple[str, str]]:
+        linhas = (
+            session.query(cls.digest, cls.digest_miniatura, cls.extensao)
+            .join(Livro, Livro.id == cls.livro_id)
+            .where(cls.digest.is_not(None), ~Livro.excluidos)
+            .all()
+        )
+        referenciadas = set()
+        for digest, digest_miniatura, extensao in linhas:
+            referenciadas.add((digest, extensao))
+            referenciadas.add((digest_miniatura, EXTENSAO))
+        return referenciadas
+
+    def __str__(self):
+        return f"<Capa(livro_id={self.livro_id})>"
+
+
 class Emprestimo(ModeloBase):
     __tablename__ = 'emprestimos'
+    __table_args__ = (
+        Index('ix_emprestimos_leitor_id', 'leitor_id', 'devolvido_em'),
+        Index('ix_emprestimos_livro_id', 'livro_id', 'devolvido_em'),
+        Index(
+            'ix_emprestimos_abertos', 'devolucao_em', 'id',
+            sqlite_where=text('devolvido_em IS NULL AND excluido_em IS NULL')
+        ),
+        Index(
+            'ix_emprestimos_fechados', 'devolvido_em', 'id',
+            sqlite_where=text('devolvido_em IS NOT NULL AND excluido_em IS NULL')
+        ),
+    )
 
     leitor_id = Column(Integer, ForeignKey('usuarios.id'), nullable=False)
     livro_id = Column(Integer, ForeignKey('livros.id'), nullable=False)
@@ -229,6 +1062,8 @@ class Emprestimo(ModeloBase):
     leitor = relationship('Usuario', back_populates='emprestimos')
     livro = relationship('Livro', back_populates='emprestimos')
 
+    campos_estatisticas = {'emprestado_em', 'devolucao_em', 'devolvido_em', 'vezes_adiado', 'livro_id', 'excluido_em'}
+
     @property
     def devolvido(self):
         return self.devolvido_em is not None
@@ -238,56 +1073,268 @@ class Emprestimo(ModeloBase):
     def devolvidos(cls):
         return cls.devolvido_em.is_not(None)
     
+    @classmethod
     @property
-    def dias_para_termino(self):
-        date_temp = pendulum.datetime(self.devolucao_em.year, self.devolucao_em.month, self.devolucao_em.day, 0, 0, 0)
-        return date_temp.date().diff(agora().date()).in_days()
+    def dias_para_terminos(cls):
+        return cls.dias_restantes().label('dias_para_terminos')
+
+    @classmethod
+    def dias_restantes(cls, hoje: date | None = None):
+        # Negativo quando o empréstimo está atrasado
+        return dias_entre(literal(hoje or agora().date(), Date), cls.devolucao_em)
+
 
     @classmethod
     @property
-    def dias_para_terminos(cls):
-        return func.datediff(func.now(), cls.devolucao_em).label('dias_para_terminos')
+    def livro_emprestado(cls):
+        # EXISTS correlacionado ao Livro da consulta externa
+        return select(cls.id).where(cls.livro_id == Livro.id, ~cls.excluidos, ~cls.devolvidos).exists()
+
+    def _apos_adicionar(self):
+        Emprestimo.atualizar_disponibilidade([self.livro_id])
+        Emprestimo._variar_estatisticas(Emprestimo.id == self.id)
+
+    def _antes_editar(self, edicao: dict[str, Any]):
+        # Retira a contribuição atual, que _apos_editar soma de novo já alterada
+        if self.campos_estatisticas & set(edicao):
+            Emprestimo._variar_estatisticas(Emprestimo.id == self.id, sinal=-1)
+
+    def _apos_editar(self, edicao: dict[str, Any]):
+        if {'devolvido_em', 'excluido_em', 'livro_id'} & set(edicao):
+            livros_id = {self.livro_id}
+            anterior = inspect(self).attrs.livro_id.history.deleted
+            livros_id.update(id for id in anterior if id is not None)
+            Emprestimo.atualizar_disponibilidade(livros_id)
+        if self.campos_estatisticas & set(edicao):
+            Emprestimo._variar_estatisticas(Emprestimo.id == self.id)
+
+    @classmethod
+    def _antes_editar_muitos(cls, condicao, edicao: dict[str, Any]):
+        if cls.campos_estatisticas & set(edicao):
+            cls._variar_estatisticas(condicao, sinal=-1)
+
+    @classmethod
+    def _apos_editar_muitos(cls, editados: list[int], edicao: dict[str, Any]):
+        if editados and {'devolvido_em', 'excluido_em', 'livro_id'} & set(edicao):
+            livros_id = session.scalars(select(cls.livro_id).where(cls.id.in_(editados)).distinct()).all()
+            cls.atualizar_disponibilidade(livros_id)
+        if editados and cls.campos_estatisticas & set(edicao):
+            cls._variar_estatisticas(cls.id.in_(editados))
 
+    @classmethod
+    def _variar_estatisticas(cls, condicao, sinal: int = 1):
+        session.flush()
+        contagens = estatisticas.contribuicoes(session, Base.metadata.tables, condicao)
+        estatisticas.aplicar(session, tabela_estatisticas, contagens, sinal)
 
-    def devolver(self):
+    @classmethod
+    def reconstruir_estatisticas(cls):
+        try:
+            estatisticas.reconstruir(session, Base.metadata.tables)
+            session.commit()
+            # Escritas sem o ORM não são notadas pela invalidação do cache
+            banco_atual().cache.invalidar(cls.__tablename__)
+        except Exception as e:
+            session.rollback()
+            raise e
+
+    @classmethod
+    def totais(cls) -> dict[str, int]:
+        return cls._em_cache(
+            ('totais',),
+            lambda sessao: dict(sessao.execute(
+                select(tabela_estatisticas.c.chave, tabela_estatisticas.c.valor)
+                .where(tabela_estatisticas.c.dimensao == 'total')
+            ).all())
+        )
+
+    @classmethod
+    def por_mes(cls, meses: int = 12) -> list[tuple[str, int, int, int]]:
+        """(mês, empréstimos, devoluções, devolvidos com atraso) dos últimos `meses` meses com movimento."""
+        def carregar(sessao):
+            contagens = {
+                dimensao: dict(sessao.execute(
+                    select(tabela_estatisticas.c.chave, tabela_estatisticas.c.valor)
+                    .where(tabela_estatisticas.c.dimensao == dimensao)
+                    .order_by(tabela_estatisticas.c.chave.desc())
+                    .limit(meses)
+                ).all())
+                for dimensao in ('emprestimos_mes', 'devolucoes_mes', 'atrasos_mes')
+            }
+            todos = sorted(set().union(*contagens.values()))[-meses:]
+            return [
+                (mes, *(contagens[dimensao].get(mes, 0) for dimensao in ('emprestimos_mes', 'devolucoes_mes', 'atrasos_mes')))
+                for mes in todos
+            ]
+        return cls._em_cache(('por_mes', meses), carregar)
+
+    @classmethod
+    def mais_frequentes(cls, dimensao: str, limite: int = 10) -> list[tuple[str, int]]:
+        # Nome de cada livro, gênero ou doador com mais empréstimos, e quantos
+        nome = {'livro': Livro.titulo, 'genero': Genero.nome, 'doador': Usuario.nome}[dimensao]
+        return cls._em_cache(
+            ('mais_frequentes', dimensao, limite),
+            lambda sessao: [
+                tuple(linha) for linha in sessao.execute(
+                    select(nome, tabela_estatisticas.c.valor)
+                    .join(nome.class_, nome.class_.id == cast(tabela_estatisticas.c.chave, Integer))
+                    .where(tabela_estatisticas.c.dimensao == dimensao, tabela_estatisticas.c.valor > 0)
+                    .order_by(tabela_estatisticas.c.valor.desc())
+                    .limit(limite)
+                ).all()
+            ],
+            'livros', 'generos', 'usuarios'
+        )
+
+    @classmethod
+    def atualizar_disponibilidade(cls, livros_id=None):
+        """
+        Recalcula `Livro.disponivel` a partir dos empréstimos em aberto e não
+        excluídos, dos livros informados ou, sem ids, de todos. Não confirma
+        a transação.
+        """
+        session.flush()
+        instrucao = update(Livro).values(disponivel=~cls.livro_emprestado)
+        if livros_id is not None:
+            instrucao = instrucao.where(Livro.id.in_(livros_id))
+        session.execute(instrucao, execution_options={'synchronize_session': 'fetch'})
+
+    @classmethod
+    def reparar_disponibilidade(cls) -> int:
+        # Corrige livros cujo status diverge dos empréstimos e retorna quantos eram
+        try:
+            divergentes = session.query(func.count(Livro.id)).where(Livro.disponivel == cls.livro_emprestado).scalar()
+            cls.atualizar_disponibilidade()
+            session.commit()
+            return divergentes
+        except Exception as e:
+            session.rollback()
+            raise e
+
+    def devolver(self, versao: int | None = None):
         return self.editar({
             'devolvido_em' :  agora().date()
-        })
+        }, versao=versao)
 
 
-    def mais_prazo(self, aumento_prazo: int = 1):
+    def mais_prazo(self, aumento_prazo: int = 1, versao: int | None = None):
         date_temp = pendulum.datetime(self.devolucao_em.year, self.devolucao_em.month, self.devolucao_em.day, 0, 0, 0)
         return  self.editar({
             'devolucao_em' :  date_temp.add(days=aumento_prazo).date(),
             'vezes_adiado' : self.vezes_adiado + 1
-        })
+        }, versao=versao)
+
+
+    @classmethod
+    def devolver_muitos(cls, versoes: dict[int, int]) -> list[int]:
+        """
+        Devolve numa única transação os empréstimos em aberto informados como
+        {id: versão vista}. Retorna os ids devolvidos; os que faltarem já
+        estavam devolvidos ou foram alterados por outra pessoa.
+        """
+        if not versoes:
+            return []
+        return cls.editar_muitos(
+            {'devolvido_em': agora().date()},
+            criterios=(cls._nas_versoes(versoes), ~cls.devolvidos)
+        )
+
+
+    @classmethod
+    def mais_prazo_muitos(cls, versoes: dict[int, int], aumento_prazo: int = 1) -> list[int]:
+        # Como `devolver_muitos`, adiando a devolução de cada um em `aumento_prazo` dias
+        if not versoes:
+            return []
+        return cls.editar_muitos(
+            {
+                'devolucao_em': somar_dias(cls.devolucao_em, aumento_prazo),
+                'vezes_adiado': func.coalesce(cls.vezes_adiado, 0) + 1,
+            },
+            criterios=(cls._nas_versoes(versoes), ~cls.devolvidos)
+        )
 
 
     @classmethod
     def retornar_por_leitor(cls, leitor:Usuario, devolvidos:bool = False):
-        return session.query(cls).where(cls.leitor == leitor, cls.devolvidos == devolvidos).all()
+        return cls._em_cache(
+            ('por_leitor', leitor.id, devolvidos),
+            lambda sessao: sessao.query(cls).where(cls.leitor_id == leitor.id, cls._filtro('devolvidos', devolvidos)).all()
+        )
 
 
     @classmethod
     def retornar_por_livro(cls, livro:Livro, devolvidos:bool = False):
-        return session.query(cls).where(cls.livro == livro, cls.devolvidos == devolvidos).all()
+        return cls._em_cache(
+            ('por_livro', livro.id, devolvidos),
+            lambda sessao: sessao.query(cls).where(cls.livro_id == livro.id, cls._filtro('devolvidos', devolvidos)).all()
+        )
 
     @classmethod
-    def retornar_abertos_ordenados(cls, session: Session = session):
+    def _abertos_por_urgencia(cls, chave: tuple, hoje: date | None, *criterios) -> list[tuple['Emprestimo', int]]:
+        # Os filtros comparam devolucao_em direto com datas, para usar o índice
+        # de abertos; os dias restantes só são calculados para as linhas retornadas
+        hoje = hoje or agora().date()
+        return cls._em_cache(
+            (*chave, hoje),
+            lambda sessao: [
+                tuple(linha) for linha in
+                sessao.query(cls, cls.dias_restantes(hoje))
+                .options(joinedload(cls.livro), joinedload(cls.leitor))
+                .where(~cls.excluidos, ~cls.devolvidos, *criterios)
+                .order_by(cls.devolucao_em, cls.id)
+                .all()
+            ],
+            'livros', 'capas', 'usuarios'
+        )
 
-        emprestimos_abertos = cls.retornar(
-            campo='devolvidos',
-            valor=False
+    @classmethod
+    def obter_com_dias(cls, id: int, hoje: date | None = None) -> tuple['Emprestimo', int] | None:
+        # Um empréstimo com os dias restantes, como nas listas de abertos
+        hoje = hoje or agora().date()
+        return cls._em_cache(
+            ('obter_com_dias', id, hoje),
+            lambda sessao: next((
+                tuple(linha) for linha in
+                sessao.query(cls, cls.dias_restantes(hoje))
+                .options(joinedload(cls.livro), joinedload(cls.leitor))
+                .where(cls.id == id)
+            ), None),
+            'livros', 'capas', 'usuarios'
+        )
+
+    @classmethod
+    def retornar_por_urgencia(cls, hoje: date | None = None) -> list[tuple['Emprestimo', int]]:
+        """Empréstimos em aberto com os dias restantes, dos mais urgentes aos menos."""
+        return cls._abertos_por_urgencia(('por_urgencia',), hoje)
+
+    @classmethod
+    def retornar_atrasados(cls, hoje: date | None = None) -> list[tuple['Emprestimo', int]]:
+        hoje = hoje or agora().date()
+        return cls._abertos_por_urgencia(('atrasados',), hoje, cls.devolucao_em < hoje)
+
+    @classmethod
+    def retornar_vencendo(cls, dias: int, hoje: date | None = None) -> list[tuple['Emprestimo', int]]:
+        # Os que vencem de hoje até daqui a `dias` dias, sem os já atrasados
+        hoje = hoje or agora().date()
+        return cls._abertos_por_urgencia(
+            ('vencendo', dias),
+            hoje,
+            cls.devolucao_em >= hoje,
+            cls.devolucao_em <= hoje + timedelta(days=dias)
         )
-        if emprestimos_abertos:
-            return sorted(emprestimos_abertos, key=lambda x: x.devolucao_em)
-        else:
-            return []
 
     def __str__(self):
         return f'{self.livro.titulo} para {self.leitor.nome} até {self.devolucao_em.strftime("%A, %d de %B de %Y")}'
 
 
+# Contagens de circulação por (dimensão, chave), mantidas por `estatisticas`
+tabela_estatisticas = Table(
+    'estatisticas',
+    Base.metadata,
+    Column('dimensao', String, primary_key=True),
+    Column('chave', String, primary_key=True),
+    Column('valor', Integer, nullable=False, default=0),
+    Index('ix_estatisticas_dimensao_valor', 'dimensao', 'valor'),
+    sqlite_with_rowid=False,
+)
 
-
-Base.metadata.create_all(engine)
\ No newline at end of file
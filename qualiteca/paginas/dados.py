@@ -5,7 +5,13 @@ import pandas as pd
 from typing import Literal
 import streamlit as st
 from io import BytesIO
-from models import  Livro, Usuario, Emprestimo
+from pathlib import PurePath
+from zipfile import ZipFile
+from PIL import Image
+from sqlalchemy import func
+from models import  Livro, Usuario, Emprestimo, session, consolidar_banco, fechar_conexoes, atualizar_esquema
+from armazem import ArmazemCapas, diretorio_padrao
+import analise
 
 class Backup:
     def __init__(self, streamlit_secrets) -> None:
@@ -17,6 +23,10 @@ class Backup:
         self.meses_versoes = streamlit_secrets['BACKUP_MESES']
         self.dias_versoes = streamlit_secrets['BACKUP_DIAS']
         self.ultimas_versoes = streamlit_secrets['BACKUP_ULTIMAS']
+        self.diretorio_capas = streamlit_secrets.get('DIRETORIO_CAPAS', diretorio_padrao(False))
+        # Cada biblioteca tem sua pasta; '' é a raiz, usada quando há uma só
+        self.pasta_biblioteca = streamlit_secrets.get('PASTA_BACKUP', '')
+        self.pasta_capas = f'{self.pasta_biblioteca}/capas'
 
         self.template_headers = ['nome', 'hash_conteudo', 'modificado_em']
         self.dtypes = {'nome':'string','hash_conteudo':'string', 'modificado_em':'datetime64[ns]'}
@@ -46,8 +56,7 @@ class Backup:
     
     def automatico(self):
         disponiveis = self.listar()
-        ultimo_registro = disponiveis['modificado_em'].max().tz_localize(tz='UTC').astimezone(tz='America/Sao_Paulo').date()
-        if datetime.now().date() > ultimo_registro:
+        if disponiveis.empty or datetime.now().date() > disponiveis['modificado_em'].max().tz_localize(tz='UTC').astimezone(tz='America/Sao_Paulo').date():
             st.info('Backup: Criando vesão de hoje')
             self.criar()
         
@@ -64,28 +73,85 @@ class Backup:
 
     def criar(self):
         try:
+            consolidar_banco()
             with self.dropbox_autenticado as dbx:
                 with open(self.nome_banco_dados, 'rb') as f:
-                    dbx.files_upload(f.read(), f'/backup_{datetime.now().strftime("%Y_%m_%d_%H_%M_%S")}.db')
-                    return True
+                    dbx.files_upload(f.read(), f'{self.pasta_biblioteca}/backup_{datetime.now().strftime("%Y_%m_%d_%H_%M_%S")}.db')
+            self.sincronizar_capas()
+            return True
         except Exception as e:
             print(e)
             return False
 
+    def listar_capas_remotas(self, dbx):
+        try:
+            resultado = dbx.files_list_folder(self.pasta_capas, recursive=True)
+        except dropbox.exceptions.ApiError:
+            return set()
+
+        nomes = set()
+        while True:
+            for entrada in resultado.entries:
+                if isinstance(entrada, dropbox.files.FileMetadata):
+                    nomes.add(entrada.name)
+            if not resultado.has_more:
+                return nomes
+            resultado = dbx.files_list_folder_continue(resultado.cursor)
+
+    def sincronizar_capas(self):
+        # As capas são endereçadas pelo conteúdo, então só as novas precisam subir
+        if not self.diretorio_capas:
+            return 0
+
+        armazem = ArmazemCapas(self.diretorio_capas)
+        enviadas = 0
+        with self.dropbox_autenticado as dbx:
+            remotas = self.listar_capas_remotas(dbx)
+            for digest, extensao, caminho in armazem.listar():
+                if caminho.name not in remotas:
+                    dbx.files_upload(caminho.read_bytes(), f'{self.pasta_capas}/{digest[:2]}/{caminho.name}')
+                    enviadas += 1
+        return enviadas
+
+    def restaurar_capas(self):
+        if not self.diretorio_capas:
+            return 0
+
+        armazem = ArmazemCapas(self.diretorio_capas)
+        baixadas = 0
+        with self.dropbox_autenticado as dbx:
+            for nome in self.listar_capas_remotas(dbx):
+                digest, extensao = nome.split('.', 1)
+                if not armazem.existe(digest, extensao):
+                    _, resposta = dbx.files_download(f'{self.pasta_capas}/{digest[:2]}/{nome}')
+                    armazem.guardar(resposta.content, extensao)
+                    baixadas += 1
+        return baixadas
+
     def restaurar(self, arquivo):
         try:
             with self.dropbox_autenticado as dbx:
-                metadata, response = dbx.files_download(f'/{arquivo}')
+                metadata, response = dbx.files_download(f'{self.pasta_biblioteca}/{arquivo}')
+                fechar_conexoes()
                 with open(self.nome_banco_dados, 'wb') as f:
                     f.write(response.content)
-                    return True
+            atualizar_esquema()
+            self.restaurar_capas()
+            return True
         except Exception as e:
             return False
     
     def listar(self):
         with self.dropbox_autenticado as dbx:
             arquivos = []
-            for arquivo in dbx.files_list_folder('').entries:
+            try:
+                entradas = dbx.files_list_folder(self.pasta_biblioteca).entries
+            except dropbox.exceptions.ApiError:
+                # Biblioteca nova, ainda sem pasta
+                entradas = []
+            for arquivo in entradas:
+                if not isinstance(arquivo, dropbox.files.FileMetadata):
+                    continue
                 arquivos.append({
                     'nome' : arquivo.name,
                     'hash_conteudo' : arquivo.content_hash,
@@ -114,12 +180,203 @@ class Backup:
 
     def excluir(self, arquivo):
         with self.dropbox_autenticado as dbx:
-            dbx.files_delete_v2(f'/{arquivo}')
+            dbx.files_delete_v2(f'{self.pasta_biblioteca}/{arquivo}')
             return True
 
+class Importacao:
+    """
+    Importa pessoas e livros de planilhas (CSV ou Excel), uma linha por registro.
+
+    As linhas válidas são gravadas em lotes, cada lote em uma única transação.
+    Se um lote falha, suas linhas são regravadas uma a uma para isolar as
+    problemáticas. Os erros são devolvidos por linha da planilha.
+    """
+    colunas_usuarios = {'nome': True, 'email': True, 'genero_preferidos': False}
+    colunas_livros = {'titulo': True, 'autor': True, 'genero': True, 'doador_email': False,
+                      'doador_id': False, 'observacao': False, 'capa': False}
+
+    # Limites do zip de capas, para um arquivo pequeno que se expande demais
+    # (zip bomb) não esgotar a memória; o zip em si cabe em server.maxUploadSize
+    tamanho_maximo_zip = 50 * 1024 * 1024
+    tamanho_maximo_capa = 20 * 1024 * 1024
+    tamanho_maximo_capas = 500 * 1024 * 1024
+    quantidade_maxima_capas = 5000
+
+    def __init__(self, tamanho_lote: int = 200, tamanho_lote_capas: int = 25) -> None:
+        self.tamanho_lote = tamanho_lote
+        self.tamanho_lote_capas = tamanho_lote_capas
+        self.erros = []
+        self.importados = 0
+
+    @staticmethod
+    def ler_planilha(arquivo) -> pd.DataFrame:
+        if arquivo.name.lower().endswith('.csv'):
+            dados = pd.read_csv(arquivo, dtype=str, keep_default_na=False, sep=None, engine='python')
+        else:
+            dados = pd.read_excel(arquivo, dtype=str, keep_default_na=False)
+        dados.columns = [str(coluna).strip().lower() for coluna in dados.columns]
+        return dados.apply(lambda coluna: coluna.str.strip())
+
+    @classmethod
+    def indexar_capas(cls, arquivo_zip) -> tuple[ZipFile, dict[str, str]]:
+        # Casa pelo nome do arquivo, sem diferenciar maiúsculas e ignorando pastas
+        if arquivo_zip.seek(0, 2) > cls.tamanho_maximo_zip:
+            raise ValueError(f'O zip de capas passa de {cls.tamanho_maximo_zip // 1024 // 1024} MB')
+        arquivo_zip.seek(0)
+
+        capas = ZipFile(arquivo_zip)
+        # Os tamanhos declarados limitam quanto `ZipFile.read` descomprime
+        arquivos = [info for info in capas.infolist() if not info.is_dir()]
+        if len(arquivos) > cls.quantidade_maxima_capas:
+            capas.close()
+            raise ValueError(f'O zip de capas tem mais de {cls.quantidade_maxima_capas} arquivos')
+        tamanhos = [info.file_size for info in arquivos]
+        if max(tamanhos, default=0) > cls.tamanho_maximo_capa or sum(tamanhos) > cls.tamanho_maximo_capas:
+            capas.close()
+            raise ValueError('O zip de capas descomprimido é grande demais')
+
+        nomes = {}
+        for info in arquivos:
+            nomes[PurePath(info.filename).name.lower()] = info.filename
+        return capas, nomes
+
+    @property
+    def relatorio(self) -> pd.DataFrame:
+        return pd.DataFrame(self.erros, columns=['linha', 'erro']).sort_values('linha')
+
+    def _erro(self, indice: int, mensagem: str):
+        # A linha 1 da planilha é o cabeçalho
+        self.erros.append((indice + 2, mensagem))
+
+    def _faltantes(self, dados: pd.DataFrame, colunas: dict[str, bool]) -> list[str]:
+        return [coluna for coluna, obrigatoria in colunas.items() if obrigatoria and coluna not in dados.columns]
+
+    def _gravar(self, modelo, lote: list[tuple[int, dict]]):
+        try:
+            self.importados += len(modelo.adicionar_muitos([registro for _, registro in lote]))
+        except Exception:
+            for indice, registro in lote:
+                try:
+                    self.importados += len(modelo.adicionar_muitos([registro]))
+                except Exception as e:
+                    self._erro(indice, f'Não foi possível gravar: {e}')
+
+    def _gravar_em_lotes(self, modelo, registros, tamanho_lote: int):
+        lote = []
+        for indice, registro in registros:
+            lote.append((indice, registro))
+            if len(lote) >= tamanho_lote:
+                self._gravar(modelo, lote)
+                lote = []
+        if lote:
+            self._gravar(modelo, lote)
+
+    def importar_usuarios(self, dados: pd.DataFrame) -> int:
+        faltantes = self._faltantes(dados, self.colunas_usuarios)
+        if faltantes:
+            raise ValueError(f'Colunas obrigatórias ausentes: {", ".join(faltantes)}')
+
+        def registros():
+            for indice, linha in dados.iterrows():
+                if not linha['nome']:
+                    self._erro(indice, 'Nome não preenchido')
+                elif not Usuario.email_valido(linha['email']):
+                    self._erro(indice, f'E-mail inválido: {linha["email"]}')
+                else:
+                    yield indice, {
+                        'nome': linha['nome'],
+                        'email': linha['email'],
+                        'genero_preferidos': linha.get('genero_preferidos') or ''
+                    }
+
+        self._gravar_em_lotes(Usuario, registros(), self.tamanho_lote)
+        return self.importados
+
+    def _doadores(self, dados: pd.DataFrame) -> tuple[dict[str, int], set[int]]:
+        # Uma consulta para todos os doadores da planilha, não uma por linha
+        emails = set(dados['doador_email']) - {''} if 'doador_email' in dados.columns else set()
+        ids = {int(valor) for valor in dados['doador_id'] if valor.isdigit()} if 'doador_id' in dados.columns else set()
+        if not emails and not ids:
+            return {}, set()
+
+        por_email = {}
+        ids_existentes = set()
+        consulta = session.query(Usuario.id, Usuario.email).where(
+            ~Usuario.excluidos,
+            func.lower(Usuario.email).in_({email.lower() for email in emails}) | Usuario.id.in_(ids)
+        )
+        for id, email in consulta:
+            por_email.setdefault(email.lower(), id)
+            ids_existentes.add(id)
+        return por_email, ids_existentes
+
+    def _ler_capa(self, capas: ZipFile | None, nomes: dict[str, str], nome: str) -> bytes:
+        if capas is None:
+            raise ValueError('Capa indicada, mas nenhum arquivo zip foi enviado')
+        caminho = nomes.get(PurePath(nome).name.lower())
+        if caminho is None:
+            raise ValueError(f'Capa {nome} não encontrada no zip')
+        conteudo = capas.read(caminho)
+        try:
+            Image.open(BytesIO(conteudo)).verify()
+        except Exception:
+            raise ValueError(f'Capa {nome} não é uma imagem válida')
+        return conteudo
+
+    def importar_livros(self, dados: pd.DataFrame, arquivo_capas=None) -> int:
+        faltantes = self._faltantes(dados, self.colunas_livros)
+        if 'doador_email' not in dados.columns and 'doador_id' not in dados.columns:
+            faltantes.append('doador_email ou doador_id')
+        if faltantes:
+            raise ValueError(f'Colunas obrigatórias ausentes: {", ".join(faltantes)}')
+
+        capas, nomes = self.indexar_capas(arquivo_capas) if arquivo_capas is not None else (None, {})
+        por_email, ids_existentes = self._doadores(dados)
+
+        def registros():
+            for indice, linha in dados.iterrows():
+                vazios = [coluna for coluna in ['titulo', 'autor', 'genero'] if not linha[coluna]]
+                if vazios:
+                    self._erro(indice, f'Não preenchido: {", ".join(vazios)}')
+                    continue
+
+                doador_id = None
+                if linha.get('doador_id', '').isdigit() and int(linha['doador_id']) in ids_existentes:
+                    doador_id = int(linha['doador_id'])
+                elif linha.get('doador_email'):
+                    doador_id = por_email.get(linha['doador_email'].lower())
+                if doador_id is None:
+                    self._erro(indice, 'Doador não encontrado')
+                    continue
+
+                registro = {
+                    'titulo': linha['titulo'],
+                    'autor': linha['autor'],
+                    'genero': linha['genero'],
+                    'doador_id': doador_id,
+                    'observacao': linha.get('observacao') or None
+                }
+                if linha.get('capa'):
+                    try:
+                        registro['foto_livro'] = self._ler_capa(capas, nomes, linha['capa'])
+                    except ValueError as e:
+                        self._erro(indice, str(e))
+                        continue
+                yield indice, registro
+
+        # Lotes com capas são menores para limitar as imagens em memória
+        tamanho_lote = self.tamanho_lote_capas if capas is not None else self.tamanho_lote
+        try:
+            self._gravar_em_lotes(Livro, registros(), tamanho_lote)
+        finally:
+            if capas is not None:
+                capas.close()
+        return self.importados
+
+
 class Dados:
     nome = 'Backup'
-    nomes_abas = ['Criar','Restaurar','Gerenciar', 'Exportar']
+    nomes_abas = ['Criar','Restaurar','Gerenciar', 'Exportar', 'Importar']
     def __init__(self) -> None:
         super().__init__()
         st.header(self.nome, divider='orange')
@@ -137,11 +394,14 @@ class Dados:
         with abas[3]:
             self.exportar()
 
+        with abas[4]:
+            self.importar()
+
     def criar(self):
         st.markdown('### Crie novos backups')
         st.caption('O arquivo de banco de dados é guardado em uma conta do dropbox, vinculado ao e-mail qualiteca.livros@gmail.com')
         if st.button('Criar backup'):
-            backup = Backup(st.secrets)
+            backup = Backup(st.session_state.configuracao_biblioteca)
             if backup.criar():
                 st.success('Backup criado com sucesso!')
             else: 
@@ -152,11 +412,12 @@ class Dados:
         
         st.markdown('### Restaure os backups')
         st.caption('Abaixo são listados os backups gerados automaticamente e manualmente.')
-        st.caption(f'São apenas mantidos até 1 backup dos ultimos {st.secrets.BACKUP_MESES} meses,'+
-                   f' um de cada mês, 1 backup dos ultimos {st.secrets.BACKUP_DIAS} dias,'+
-                   f' um de cada dia e os ultimos {st.secrets.BACKUP_ULTIMAS} gerados')
+        configuracao = st.session_state.configuracao_biblioteca
+        st.caption(f'São apenas mantidos até 1 backup dos ultimos {configuracao["BACKUP_MESES"]} meses,'+
+                   f' um de cada mês, 1 backup dos ultimos {configuracao["BACKUP_DIAS"]} dias,'+
+                   f' um de cada dia e os ultimos {configuracao["BACKUP_ULTIMAS"]} gerados')
 
-        backup = Backup(st.secrets)
+        backup = Backup(st.session_state.configuracao_biblioteca)
         lista_backups = backup.listar_relevantes()
         if not lista_backups.empty:
             backup_selecionado = st.selectbox(
@@ -175,7 +436,7 @@ class Dados:
     def gerenciar(self):
         if st.button('Iniciar gerenciamento'):
             if 'BACKUP' not in st.session_state:
-                st.session_state['BACKUP'] = Backup(st.secrets)
+                st.session_state['BACKUP'] = Backup(st.session_state.configuracao_biblioteca)
 
             st.markdown('### Gerencie as configurações do backup')
             st.markdown('#### Autenticação DropBox')
@@ -207,10 +468,11 @@ class Dados:
 
         formato = st.radio(
             'Formato Exportação',
-            options=['Excel','Sqlite'],
+            options=['Excel','Sqlite','Análises'],
             index=None,
             horizontal=True,
-            captions=['Cada tabela será uma planilha.', 'Arquivo de banco de dados unico.']
+            captions=['Cada tabela será uma planilha.', 'Arquivo de banco de dados unico.',
+                      'Relatórios do histórico de empréstimos.']
         )
         
         if formato == 'Excel':
@@ -232,7 +494,8 @@ class Dados:
 
 
         if formato == 'Sqlite':
-            with open(st.secrets.NOME_BANCO_DADOS, 'rb') as f:
+            consolidar_banco()
+            with open(st.session_state.configuracao_biblioteca['NOME_BANCO_DADOS'], 'rb') as f:
                 conteudo_arquivo = f.read()
 
             st.download_button(
@@ -240,3 +503,71 @@ class Dados:
                 data=conteudo_arquivo,
                 file_name=f'backup_{datetime.now().strftime("%Y_%m_%d_%H_%M_%S")}.db',
             )
+
+        if formato == 'Análises':
+            self.exportar_analises()
+
+    def exportar_analises(self):
+        dados = analise.extrair()
+        anos = sorted(dados['emprestado_em'].dt.year.unique(), reverse=True)
+        ano = st.selectbox('Ano', options=['Todos', *anos])
+        if ano != 'Todos':
+            dados = dados[dados['emprestado_em'].dt.year == ano]
+
+        tabelas = analise.relatorio(dados)
+        st.caption(f'{len(dados)} empréstimos analisados')
+        duracao, atraso = st.columns(2)
+        with duracao:
+            st.markdown('##### Duração dos empréstimos')
+            st.bar_chart(tabelas['duracao'].set_index('dias'))
+        with atraso:
+            st.markdown('##### Dias de atraso na devolução')
+            st.dataframe(tabelas['atraso'], hide_index=True, use_container_width=True)
+
+        excel_buffer = BytesIO()
+        with pd.ExcelWriter(excel_buffer, engine='xlsxwriter', mode='w') as writer:
+            for nome, tabela in tabelas.items():
+                tabela.to_excel(writer, sheet_name=nome, index=nome == 'coortes')
+
+        st.download_button(
+            'Baixar análises',
+            data=excel_buffer,
+            file_name=f'analises_{ano}_{datetime.now().strftime("%Y_%m_%d_%H_%M_%S")}.xlsx',
+        )
+
+    def importar(self):
+        st.markdown('### Importe pessoas e livros de planilhas')
+        st.caption('A primeira linha deve ter o nome das colunas. Pessoas: nome, email e genero_preferidos.'
+                   ' Livros: titulo, autor, genero, doador_email (ou doador_id), observacao e capa.')
+        st.caption('Na coluna capa, informe o nome do arquivo de imagem que está dentro do zip de capas.'
+                   ' Importe as pessoas antes dos livros que elas doaram.')
+
+        tipo = st.radio('Importar', options=['Pessoas', 'Livros'], horizontal=True)
+        planilha = st.file_uploader('Planilha', type=['csv', 'xlsx'])
+        arquivo_capas = None
+        if tipo == 'Livros':
+            arquivo_capas = st.file_uploader('Capas (opcional)', type=['zip'])
+
+        if st.button('Importar', disabled=planilha is None):
+            importacao = Importacao()
+            try:
+                dados = importacao.ler_planilha(planilha)
+                with st.spinner(f'Importando {len(dados)} linhas...'):
+                    if tipo == 'Pessoas':
+                        importacao.importar_usuarios(dados)
+                    else:
+                        importacao.importar_livros(dados, arquivo_capas)
+            except Exception as e:
+                st.error(f'Não foi possível importar: {e}')
+                return
+
+            st.success(f'{importacao.importados} registros importados')
+            if importacao.erros:
+                relatorio = importacao.relatorio
+                st.warning(f'{len(relatorio)} linhas com problemas não foram importadas')
+                st.dataframe(relatorio, hide_index=True, use_container_width=True)
+                st.download_button(
+                    'Baixar relatório de erros',
+                    data=relatorio.to_csv(index=False).encode('utf-8'),
+                    file_name=f'erros_importacao_{datetime.now().strftime("%Y_%m_%d_%H_%M_%S")}.csv',
+                )
@@ -1,5 +1,11 @@
-from models import Livro, Usuario, Emprestimo, session
+from models import Livro, Usuario, Emprestimo, ConflitoEdicao
 import streamlit as st
+from container.busca import selecionar_por_busca
+from container.capa_livro import exibir_capa
+from container.paginacao import Paginacao
+from container.fragmento import fragmento, reexecucao_parcial
+from container.versao import versao_vista, versao_exibida, avisar_conflito
+from functools import partial
 from datetime import datetime, timedelta
 import locale
 
@@ -50,66 +56,55 @@ class Emprestimos:
         if st.session_state.emprestimo_funcao == 'emprestimo_adicionar':
             with self.placeholder_adicionar.container():
                 st.markdown('#### Sobre o livro')
-                livros_disponiveis = Livro.disponiveis()
-                if livros_disponiveis:
-                    livro_escolhido = st.selectbox(
-                        'Livro desejado *',
-                        options=livros_disponiveis,
-                        placeholder="Comece a digitar o nome para encontrar mais rapido...",
-                        index=None
-                    )
-                    if livro_escolhido:
-                        with st.expander(f'##### {livro_escolhido.titulo}'):
-                            colunas = st.columns(2)
-                            with colunas[0]:
-                                st.caption(f'ID: {livro_escolhido.id}')
-                                st.caption(f'Autor: {livro_escolhido.autor}')
-                                st.caption(f'Genero: {livro_escolhido.genero}')
-                                st.caption(
-                                    f'Observacao: {livro_escolhido.observacao}')
-                            with colunas[1]:
-                                st.image(
-                                    image=livro_escolhido.foto_livro,
-                                    output_format=livro_escolhido.extensao_foto
-                                )
-                    else:
-
-                        st.info(
-                            'Caso tenha o livro e ele não esteja listado, cheque se não está como "Emprestado"')
-
+                st.caption(f'{Livro.quantidade_disponiveis()} livros disponíveis para empréstimo')
+                livro_escolhido = selecionar_por_busca(
+                    'Livro desejado *', Livro, 'emprestimo_livro', Livro.nao_emprestados,
+                    colunas=('id', 'titulo', 'autor'))
+                if livro_escolhido:
+                    with st.expander(f'##### {livro_escolhido.titulo}'):
+                        colunas = st.columns(2)
+                        with colunas[0]:
+                            st.caption(f'ID: {livro_escolhido.id}')
+                            st.caption(f'Autor: {livro_escolhido.autor}')
+                            st.caption(f'Genero: {livro_escolhido.genero}')
+                            st.caption(
+                                f'Observacao: {livro_escolhido.observacao}')
+                        with colunas[1]:
+                            exibir_capa(livro_escolhido, miniatura=False)
                 else:
-                    livro_escolhido = None
-                    st.warning('Parece que não há livros dispoiveis')
+                    st.info(
+                        'Caso tenha o livro e ele não apareça na busca, cheque se não está como "Emprestado"')
 
                 st.markdown('#### Sobre o leitor')
-                leitores = Usuario.retornar()
-                if leitores:
-                    leitor = st.selectbox(
-                        'Leitor *',
-                        options=leitores,
-                        placeholder="Comece a digitar o nome para encontrar mais rapido...",
-                        index=None
-                    )
-                    if leitor:
-                        with st.expander(f'##### {leitor.nome}'):
-                            st.caption(f'ID: {leitor.id}')
-                            st.caption(leitor.email)
-                            st.write(
-                                f"Genêros preferidos:\n {leitor.genero_preferidos.upper()}")
+                leitor = selecionar_por_busca(
+                    'Leitor *', Usuario, 'emprestimo_leitor', colunas=('id', 'nome'))
+                if leitor:
+                    with st.expander(f'##### {leitor.nome}'):
+                        st.caption(f'ID: {leitor.id}')
+                        st.caption(leitor.email)
+                        generos_leitor = Usuario.generos_por_usuario([leitor.id]).get(leitor.id, ())
+                        st.write(
+                            f"Genêros preferidos:\n {', '.join(generos_leitor)}")
+                        st.caption(
+                            f'Cadastro criado em: {leitor.registrado_em}')
+                        st.caption(
+                            f'Ultima edição no cadastro em: {leitor.editado_em}') if leitor.editado_em is not None else None
+                        volume_emprestimos = leitor.volume_emprestimos_ativos()
+                        if volume_emprestimos:
+                            st.warning(
+                                f'Este leitor está com {volume_emprestimos} emprestimos atualmente')
+                        else:
                             st.caption(
-                                f'Cadastro criado em: {leitor.registrado_em}')
+                                f'Este leitor está com {volume_emprestimos} emprestimos atualmente')
+                    recomendados = Livro.recomendados(leitor.id)
+                    if recomendados:
+                        st.markdown('##### Sugestões para este leitor')
+                        for livro, afinidade in recomendados:
                             st.caption(
-                                f'Ultima edição no cadastro em: {leitor.editado_em}') if leitor.editado_em is not None else None
-                            if leitor.volume_emprestimos_ativos():
-                                st.warning(
-                                    f'Este leitor está com {leitor.volume_emprestimos_ativos()} emprestimos atualmente')
-                            else:
-                                st.caption(
-                                    f'Este leitor está com {leitor.volume_emprestimos_ativos()} emprestimos atualmente')
-
+                                f'({livro.id}) {livro.titulo} ({livro.autor}) - '
+                                f'{afinidade} gênero(s) em comum')
                 else:
-                    st.warning(
-                        'Antes de continuar, cadastre uma pessoa leitora em "Pessoas"')
+                    st.info('Leitor não encontrado? Cadastre-o antes em "Pessoas"')
 
                 quantidade_dias = st.number_input(
                     f'Hoje é {datetime.now().date().strftime("%A, %d de %B de %Y")}. Quantos dias durárá o empréstimo?',
@@ -121,7 +116,7 @@ class Emprestimos:
 
                 if st.button('Emprestar'):
                     if not livro_escolhido:
-                        st.error('Então, não há livros.')
+                        st.error('Escolha um livro disponível.')
                     elif not all([leitor, livro_escolhido, quantidade_dias]):
                         st.error(
                             'Ficou faltando algumas informações, observe o "*"')
@@ -141,80 +136,182 @@ class Emprestimos:
                             st.error(
                                 f'Parece que algo não funcionou como deveria. Não foi possivel emprestar o livro')
 
+    def em_lote(self, emprestimos_abertos, versoes: dict[int, int]) -> bool:
+        # Devolve ou adia vários de uma vez; retorna se algo foi gravado
+        if not st.toggle('Selecionar vários', key='emprestimos_em_lote'):
+            return False
+
+        nomes = {emprestimo.id: f'({emprestimo.id}) {emprestimo}' for emprestimo, _ in emprestimos_abertos}
+        with st.form('emprestimos_lote', clear_on_submit=True):
+            selecionados = st.multiselect(
+                'Empréstimos',
+                options=list(nomes),
+                format_func=lambda id: nomes.get(id, f'({id})'),
+                placeholder='Escolha os empréstimos'
+            )
+            colunas = st.columns(2)
+            with colunas[0]:
+                devolver = st.form_submit_button('Devolver selecionados', use_container_width=True)
+            with colunas[1]:
+                mais_prazo = st.form_submit_button('\+ 1 dia de prazo aos selecionados', use_container_width=True)
+
+        if not (devolver or mais_prazo) or not selecionados:
+            return False
+
+        vistas = {id: versoes[id] for id in selecionados if id in versoes}
+        if devolver:
+            alterados = Emprestimo.devolver_muitos(vistas)
+            st.success(f'{len(alterados)} livro(s) devolvido(s)')
+        else:
+            alterados = Emprestimo.mais_prazo_muitos(vistas)
+            st.info(f'OK. {len(alterados)} empréstimo(s) com mais 1 dia de prazo')
+
+        ignorados = set(selecionados) - set(alterados)
+        if ignorados:
+            st.warning(
+                f'{len(ignorados)} empréstimo(s) não foram alterados, pois já tinham sido devolvidos '
+                f'ou alterados por outra pessoa: {", ".join(map(str, sorted(ignorados)))}')
+        return bool(alterados)
+
+    def cartao_emprestimo(self, emprestimo_id: int, emprestimo: Emprestimo, dias_restantes: int,
+                          volume_emprestimos: int, generos_leitor: tuple[str, ...]):
+        # Devolver ou adiar reexecuta só este cartão, e com ele o contador do leitor
+        if reexecucao_parcial():
+            linha = Emprestimo.obter_com_dias(emprestimo_id)
+            if linha is None:
+                return
+            emprestimo, dias_restantes = linha
+            volume_emprestimos = Usuario.volumes_emprestimos_ativos([emprestimo.leitor_id]).get(emprestimo.leitor_id, 0)
+            generos_leitor = Usuario.generos_por_usuario([emprestimo.leitor_id]).get(emprestimo.leitor_id, ())
+        versao = versao_vista(emprestimo)
+        titulo_expander = f'##### {emprestimo}'
+        if emprestimo.devolvido_em is None and dias_restantes < 0:
+            titulo_expander = f'##### :red[Atrasado] {emprestimo}'
+        with st.expander(titulo_expander):
+            detalhes = st.empty()
+            if emprestimo.devolvido_em is not None:
+                devolver = mais_prazo = False
+            else:
+                st.divider()
+                colunas = st.columns(2)
+                with colunas[0]:
+                    devolver = st.button(
+                        'Devolver', use_container_width=True, key=f'devolver_{emprestimo.id}')
+                with colunas[1]:
+                    mais_prazo = st.button(
+                        '\+ 1 dia de prazo', use_container_width=True, key=f'mais_prazo_{emprestimo.id}')
+
+            alterado = False
+            try:
+                if devolver:
+                    emprestimo = emprestimo.devolver(versao=versao)
+                    alterado = True
+                    st.success('Livro devolvido')
+
+                if mais_prazo:
+                    emprestimo = emprestimo.mais_prazo(versao=versao)
+                    alterado = True
+                    st.info(
+                        f'OK. Novo prazo em: {emprestimo.devolucao_em}')
+            except ConflitoEdicao as e:
+                avisar_conflito(emprestimo, e)
+
+            if alterado:
+                # O cartão passa a exibir a versão gravada agora
+                versao_vista(emprestimo)
+                emprestimo, dias_restantes = Emprestimo.obter_com_dias(emprestimo.id)
+                volume_emprestimos = Usuario.volumes_emprestimos_ativos([emprestimo.leitor_id]).get(emprestimo.leitor_id, 0)
+
+            with detalhes.container():
+                st.caption(f'ID: {emprestimo.id}')
+                if emprestimo.devolvido_em is not None:
+                    prazo = f'Devolvido em {emprestimo.devolvido_em.strftime("%d/%m/%Y")}'
+                elif dias_restantes < 0:
+                    prazo = f'Está atrasado há {-dias_restantes} dia(s)'
+                elif dias_restantes == 0:
+                    prazo = 'Termina hoje'
+                else:
+                    prazo = f'Daqui a {dias_restantes} dia(s)'
+                st.markdown(
+                    f'Este empréstimo acaba em {emprestimo.devolucao_em.strftime("%A, %d de %B de %Y")}. ' +
+                    prazo
+                )
+                st.divider()
+                st.markdown('##### Livro')
+                colunas = st.columns(2)
+                with colunas[0]:
+                    st.caption(f'ID: {emprestimo.livro.id}')
+                    st.caption(f'Autor: {emprestimo.livro.autor}')
+                    st.caption(
+                        f'Genero: {emprestimo.livro.genero}')
+                    st.caption(
+                        f'Observacao: {emprestimo.livro.observacao}')
+                with colunas[1]:
+                    exibir_capa(emprestimo.livro)
+
+                st.divider()
+                st.markdown('##### Leitor')
+                st.caption(f'ID: {emprestimo.leitor.id}')
+                st.caption(emprestimo.leitor.email)
+                st.write(
+                    f"Genêros preferidos:\n {', '.join(generos_leitor)}")
+                st.caption(
+                    f'Cadastro criado em: {emprestimo.leitor.registrado_em}')
+                st.caption(
+                    f'Ultima edição no cadastro em: {emprestimo.leitor.editado_em}') if emprestimo.leitor.editado_em is not None else None
+                if volume_emprestimos:
+                    st.warning(
+                        f'Este leitor está com {volume_emprestimos} emprestimos atualmente')
+                else:
+                    st.caption(
+                        f'Este leitor está com {volume_emprestimos} emprestimos atualmente')
+
     def ver_emprestimos(self):
         if st.session_state.emprestimo_funcao == 'emprestimo_visualizar':
             with self.placeholder_visualizar.container():
 
-                emprestimos_abertos = Emprestimo.retornar_abertos_ordenados(
-                    session=session)
-                if emprestimos_abertos:
-                    st.markdown('#### Empréstimos pendentes')
-                    for emprestimo in emprestimos_abertos:
-                        with st.expander(f'##### {emprestimo}'):
-                            st.caption(f'ID: {emprestimo.id}')
-                            st.markdown(
-                                f'Este empréstimo acaba em {emprestimo.devolucao_em.strftime("%A, %d de %B de %Y")}. ' +
-                                f'Daqui a {emprestimo.dias_para_termino} dia(s)'
-                            )
-                            st.divider()
-                            st.markdown('##### Livro')
-                            colunas = st.columns(2)
-                            with colunas[0]:
-                                st.caption(f'ID: {emprestimo.livro.id}')
-                                st.caption(f'Autor: {emprestimo.livro.autor}')
-                                st.caption(
-                                    f'Genero: {emprestimo.livro.genero}')
-                                st.caption(
-                                    f'Observacao: {emprestimo.livro.observacao}')
-                            with colunas[1]:
-                                st.image(
-                                    image=emprestimo.livro.foto_livro,
-                                    output_format=emprestimo.livro.extensao_foto
-                                )
-
-                            st.divider()
-                            st.markdown('##### Leitor')
-                            st.caption(f'ID: {emprestimo.leitor.id}')
-                            st.caption(emprestimo.leitor.email)
-                            st.write(
-                                f"Genêros preferidos:\n {emprestimo.leitor.genero_preferidos.upper()}")
-                            st.caption(
-                                f'Cadastro criado em: {emprestimo.leitor.registrado_em}')
-                            st.caption(
-                                f'Ultima edição no cadastro em: {emprestimo.leitor.editado_em}') if emprestimo.leitor.editado_em is not None else None
-                            if emprestimo.leitor.volume_emprestimos_ativos():
-                                st.warning(
-                                    f'Este leitor está com {emprestimo.leitor.volume_emprestimos_ativos()} emprestimos atualmente')
-                            else:
-                                st.caption(
-                                    f'Este leitor está com {emprestimo.leitor.volume_emprestimos_ativos()} emprestimos atualmente')
-
-                            st.divider()
-                            colunas = st.columns(2)
-                            with colunas[0]:
-                                devolver = st.button(
-                                    'Devolver', use_container_width=True, key=f'devolver_{emprestimo.id}')
-                            with colunas[1]:
-                                mais_prazo = st.button(
-                                    '\+ 1 dia de prazo', use_container_width=True, key=f'mais_prazo_{emprestimo.id}')
-
-                            if devolver:
-                                emprestimo_modificado = emprestimo.devolver()
-                                st.success('Livro devolvido')
-
-                            if mais_prazo:
-                                emprestimo_modificado = emprestimo.mais_prazo()
-                                st.info(
-                                    f'OK. Novo prazo em: {emprestimo_modificado.devolucao_em}')
+                st.markdown('#### Empréstimos pendentes')
+                filtro = st.radio(
+                    'Mostrar',
+                    options=['Todos', 'Atrasados', 'Vencem em até 3 dias'],
+                    horizontal=True,
+                    key='emprestimos_filtro',
+                    label_visibility='collapsed'
+                )
+                if filtro == 'Atrasados':
+                    consulta = Emprestimo.retornar_atrasados
+                elif filtro == 'Vencem em até 3 dias':
+                    consulta = partial(Emprestimo.retornar_vencendo, 3)
+                else:
+                    consulta = Emprestimo.retornar_por_urgencia
+                emprestimos_abertos = consulta()
+                # Cada cartão guarda a versão que exibe; aqui só se consulta a da rodada anterior
+                versoes = {emprestimo.id: versao_exibida(emprestimo) for emprestimo, _ in emprestimos_abertos}
+
+                if emprestimos_abertos and self.em_lote(emprestimos_abertos, versoes):
+                    # Relê depois de gravar, para a lista abaixo já sair atualizada nesta rodada
+                    emprestimos_abertos = consulta()
+
+                if not emprestimos_abertos:
+                    st.caption('Nenhum empréstimo pendente aqui')
+                else:
+                    leitores_id = [emprestimo.leitor_id for emprestimo, _ in emprestimos_abertos]
+                    volumes_emprestimos = Usuario.volumes_emprestimos_ativos(leitores_id)
+                    generos_leitores = Usuario.generos_por_usuario(leitores_id)
+                    for emprestimo, dias_restantes in emprestimos_abertos:
+                        fragmento(self.cartao_emprestimo)(
+                            emprestimo.id, emprestimo, dias_restantes, volumes_emprestimos.get(emprestimo.leitor_id, 0),
+                            generos_leitores.get(emprestimo.leitor_id, ()))
 
                     st.divider()
 
-                emprestimos_fechados = Emprestimo.retornar(
-                    campo='devolvidos',
-                    valor=True
+                paginacao = Paginacao(
+                    'emprestimos_fechados',
+                    partial(Emprestimo.paginar, campo='devolvidos', valor=True, ordem='devolvido_em', decrescente=True)
                 )
-                if emprestimos_fechados:
+                if paginacao.itens:
                     st.markdown('#### Empréstimos fechados')
-                    for emprestimo in emprestimos_fechados:
+                    for emprestimo in paginacao.itens:
                         with st.expander(f'##### {emprestimo}'):
                             st.write(emprestimo)
+                    paginacao.controles()
@@ -1,5 +1,10 @@
-from models import Livro, Usuario, session, Emprestimo
+from models import Livro, Usuario, Emprestimo, ConflitoEdicao
 import streamlit as st
+from container.capa_livro import exibir_capa
+from container.paginacao import Paginacao
+from container.fragmento import fragmento, reexecucao_parcial
+from container.versao import versao_vista, avisar_conflito
+from functools import partial
 
 
 class Estante:
@@ -13,7 +18,6 @@ class Estante:
         self.adicionar_livro()
         self.ver_livros()
         self.excluir_livro()
-        self.editar_livro()
 
     def estrutura(self):
         if 'livro_funcao' not in st.session_state:
@@ -21,7 +25,6 @@ class Estante:
 
         self.placeholder_titulo = st.empty()
         self.placeholder_adicionar = st.empty()
-        self.placeholder_editar = st.empty()
         self.placeholder_excluir = st.empty()
         self.placeholder_visualizar = st.empty()
 
@@ -44,14 +47,21 @@ class Estante:
     def adicionar_livro(self):
         if st.session_state.livro_funcao == 'livro_adicionar':
             with self.placeholder_adicionar.container():
+                st.markdown('#### Sobre o livro')
+                # Fora do formulário para que os livros parecidos apareçam
+                # enquanto a doação é preenchida
+                colunas = st.columns(2)
+                with colunas[0]:
+                    titulo = st.text_input(
+                        'Titulo *', placeholder='Viagem ao centro da terra', key='livro_novo_titulo')
+                with colunas[1]:
+                    autor = st.text_input(
+                        'Autor *', placeholder='Júlio Verne', key='livro_novo_autor')
+                self.livros_parecidos(titulo, autor)
+
                 with st.form('adicionar_livro', clear_on_submit=True):
-                    st.markdown('#### Sobre o livro')
                     colunas = st.columns([0.6, 0.4])
                     with colunas[0]:
-                        titulo = st.text_input(
-                            'Titulo *', placeholder='Viagem ao centro da terra')
-                        autor = st.text_input(
-                            'Autor *', placeholder='Júlio Verne')
                         genero = st.text_input(
                             'Genêro *', placeholder='Aventura, Ficção')
 
@@ -64,22 +74,25 @@ class Estante:
                     )
 
                     st.markdown('#### Sobre o doador')
-                    pessoas_doadores = Usuario.retornar()
+                    pessoas_doadores = Usuario.colunas('id', 'nome', ordem='nome')
                     if pessoas_doadores:
-                        doador = st.selectbox(
+                        nomes_doadores = {doador.id: f'({doador.id}) {doador.nome}' for doador in pessoas_doadores}
+                        doador_id = st.selectbox(
                             'Doador',
-                            options=pessoas_doadores,
+                            options=list(nomes_doadores),
+                            format_func=nomes_doadores.get,
                             placeholder="Comece a digitar o nome para encontrar mais rapido...",
                             index=None
                         )
                         st.info(
                             'Doador não listado? Cadastre-o antes em "Pessoas"')
                     else:
+                        doador_id = None
                         st.warning(
                             'Antes de continuar, cadastre uma pessoa doadora em "Pessoas"')
 
                     if st.form_submit_button('Adicionar'):
-                        if not all([titulo, autor, genero, foto_livro, doador]):
+                        if not all([titulo, autor, genero, foto_livro, doador_id]):
                             st.error(
                                 'Ficou faltando algumas informações, observe o "*"')
                         else:
@@ -87,12 +100,13 @@ class Estante:
                                 titulo=titulo,
                                 autor=autor,
                                 genero=genero,
-                                doador_id=doador.id,
+                                doador_id=doador_id,
                                 foto_livro=foto_livro.getvalue(),
-                                observacao=observacao,
-                                extensao_foto=str(foto_livro.name.split('.')[-1])
+                                observacao=observacao
                             )
                             if novo:
+                                del st.session_state['livro_novo_titulo']
+                                del st.session_state['livro_novo_autor']
                                 st.success(
                                     f'{titulo} adicionado a nossa estante')
                                 st.session_state.livro_funcao = 'livro_visualizar'
@@ -102,45 +116,50 @@ class Estante:
                                     f'Parece que algo não funcionou como deveria. Não foi possivel adicionar o livro')
                                 st.session_state.livro_funcao = 'livro_visualizar'
 
+    def livros_parecidos(self, titulo: str, autor: str):
+        if len(titulo.strip()) < 3:
+            return
+
+        parecidos = Livro.parecidos(titulo, autor)
+        if parecidos:
+            st.warning('Talvez este livro já esteja na estante:')
+            for livro, similaridade in parecidos:
+                st.caption(f'{livro} - {similaridade:.0%} parecido')
+
     def ver_livros(self):
         if st.session_state.livro_funcao == 'livro_visualizar':
             with self.placeholder_visualizar.container():
-                livros = Livro.retornar()
+                termo = st.text_input(
+                    'Buscar livro',
+                    key='livros_busca_termo',
+                    placeholder='Titulo, autor, genero ou observação...'
+                )
+                if termo.strip():
+                    paginacao = None
+                    livros = Livro.buscar(termo, limite=20)
+                    if not livros:
+                        st.caption('Nenhum livro encontrado')
+                else:
+                    paginacao = Paginacao('livros', partial(Livro.paginar, ordem='titulo'))
+                    livros = paginacao.itens
+
                 for livro in livros:
-                    with st.expander(f'##### {livro.titulo}'):
-                        colunas = st.columns(2)
-                        with colunas[0]:
-                            st.caption(f'ID: {livro.id}')
-                            st.caption(f'Autor: {livro.autor}')
-                            st.caption(f'Genero: {livro.genero}')
-                            st.caption(f'Observacao: {livro.observacao}')
-                        with colunas[1]:
-                            st.image(
-                                image=livro.foto_livro,
-                                output_format=livro.extensao_foto
-                            )
-                        st.caption(f'Doado por: {livro.doador}')
-                        botoes = st.columns(2)
-                        with botoes[0]:
-                            if st.button('Editar', use_container_width=True, key=f'editar_{livro.id}'):
-                                st.session_state.livro_funcao = 'livro_editar'
-                                st.session_state.livro_funcao_editar = livro
-                                st.rerun()
-
-                        with botoes[1]:
-                            if st.button('Excluir', use_container_width=True, key=f'excluir_{livro.id}'):
-                                st.session_state.livro_funcao = 'livro_excluir'
-                                st.session_state.livro_funcao_excluir = livro
-                                st.rerun()
+                    fragmento(self.cartao_livro)(livro.id, livro)
+
+                if paginacao is not None:
+                    paginacao.controles()
 
     def excluir_livro(self):
         if st.session_state.livro_funcao == 'livro_excluir':
             with self.placeholder_excluir.container():
-                if st.session_state.livro_funcao_excluir is None:
+                livro = None
+                if st.session_state.livro_funcao_excluir is not None:
+                    livro = Livro.obter(st.session_state.livro_funcao_excluir)
+
+                if livro is None:
                     st.session_state.livro_funcao = 'livro_visualizar'
                 else:
-                    livro = st.session_state.livro_funcao_excluir
-
+                    versao = versao_vista(livro)
                     with st.expander(f'##### Excluir #{str(livro.id)} {livro.titulo}', expanded=True):
                         st.warning('A exclusão é definitiva')
                         emprestimos_pendentes = Emprestimo.retornar_por_livro(livro)
@@ -162,7 +181,11 @@ class Estante:
 
                         if botao_excluir:
                             if texto_confirmacao == 'excluir':
-                                excluido = livro.excluir()
+                                try:
+                                    excluido = livro.excluir(versao=versao)
+                                except ConflitoEdicao as e:
+                                    avisar_conflito(livro, e)
+                                    return
                                 if excluido:
                                     st.info('Excluido com sucesso')
                                     st.session_state.livro_funcao_excluir = None
@@ -174,82 +197,133 @@ class Estante:
                                 st.error(
                                     'Digite "excluir", para termos certeza que deseja tomar esta ação definitiva.')
 
-    def editar_livro(self):
-        if st.session_state.livro_funcao == 'livro_editar':
-            with self.placeholder_editar.container():
-                if st.session_state.livro_funcao_editar is None:
-                    st.session_state.livro_funcao = 'livro_visualizar'
-                else:
-                    livro = st.session_state.livro_funcao_editar
-                    with st.expander(f'##### Editar #{str(livro.id)} {livro.titulo}', expanded=True):
-                        st.markdown('#### Sobre o livro')
-                        colunas = st.columns([0.6, 0.4])
-                        with colunas[0]:
-                            titulo = st.text_input(
-                                'Titulo *', placeholder='Viagem ao centro da terra', value=livro.titulo)
-                            autor = st.text_input(
-                                'Autor *', placeholder='Júlio Verne', value=livro.autor)
-                            genero = st.text_input(
-                                'Genêro *', placeholder='Aventura, Ficção', value=livro.genero)
+    def _editar(self, livro_id: int):
+        st.session_state[f'livro_card_editando_{livro_id}'] = True
 
-                        with colunas[1]:
-                            st.image(
-                                image=livro.foto_livro,
-                                output_format=livro.extensao_foto
-                            )
-                            st.caption(
-                                'Caso deseje atualizar a imagem capture uma nova imagem')
-                            foto_livro = st.camera_input(
-                                'Adicione uma foto da capa livro *')
-
-                        observacao = st.text_area(
-                            'Observações ou qualquer coisa que queira dizer sobre o livro',
-                            placeholder="""Edição com ilustrações, capa dura, folhas em papel especial e etc.\nHistória de uma viagem, literalmente, ao centro da terra""",
-                            value=livro.observacao
-                        )
+    def _cancelar(self, livro_id: int):
+        st.session_state[f'livro_card_editando_{livro_id}'] = False
 
-                        st.markdown('### Sobre o doador')
-                        pessoas_doadores = Usuario.retornar()
+    def cartao_livro(self, livro_id: int, livro: Livro):
+        # Editar reexecuta só este cartão
+        if reexecucao_parcial():
+            livro = Livro.obter(livro_id)
+            if livro is None:
+                return
+        versao = versao_vista(livro)
+        chave_edicao = f'livro_card_editando_{livro.id}'
 
-                        if pessoas_doadores:
-                            pessoas_doadores_id = [
-                                doador.id for doador in pessoas_doadores]
-                            index_lista = pessoas_doadores_id.index(
-                                livro.doador_id)
+        with st.expander(f'##### {livro.titulo}', expanded=bool(st.session_state.get(chave_edicao))):
+            cartao = st.empty()
+            if st.session_state.get(chave_edicao):
+                with cartao.container():
+                    livro = self.editar_livro(livro, versao)
+                if not st.session_state.get(chave_edicao):
+                    st.success('Editado com sucesso')
 
-                            doador = st.selectbox(
-                                'Doador',
-                                options=pessoas_doadores,
-                                placeholder="Comece a digitar o nome para encontrar mais rapido...",
-                                index=index_lista,
-                            )
-                            st.info(
-                                'Doador não listado? Cadastre-o antes em "Pessoas"')
-                        else:
-                            st.warning(
-                                'Antes de continuar, cadastre uma pessoa doadora em "Pessoas"')
+            if not st.session_state.get(chave_edicao):
+                with cartao.container():
+                    colunas = st.columns(2)
+                    with colunas[0]:
+                        st.caption(f'ID: {livro.id}')
+                        st.caption(f'Autor: {livro.autor}')
+                        st.caption(f'Genero: {livro.genero}')
+                        st.caption(f'Observacao: {livro.observacao}')
+                    with colunas[1]:
+                        exibir_capa(livro)
+                    st.caption(f'Doado por: {livro.doador}')
+                    botoes = st.columns(2)
+                    with botoes[0]:
+                        st.button('Editar', use_container_width=True, key=f'editar_{livro.id}',
+                                  on_click=self._editar, args=(livro.id,))
 
-                        if st.button('Salvar alterações'):
-                            if not all([titulo, autor, genero, doador]):
-                                st.error(
-                                    'Ficou faltando algumas informações, observe o "*"')
-                            else:
-                                resultado_edicao = livro.editar(
-                                    edicao={
-                                        'titulo': titulo,
-                                        'autor': autor,
-                                        'genero': genero,
-                                        'doador_id': doador.id,
-                                        'foto_livro': foto_livro.getvalue() if foto_livro else livro.foto_livro,
-                                        'observacao': observacao,
-                                        'extensao_foto': str(foto_livro.name.split('.')[-1]) if foto_livro else livro.extensao_foto
-                                    }
-                                )
-
-                                if resultado_edicao:
-                                    st.success('Editado com sucesso')
-                                    st.session_state.livro_funcao_editar = None
-                                else:
-                                    st.error(
-                                        'Houve problemas ao editar o livro')
-                                    st.session_state.livro_funcao_editar = None
+                    with botoes[1]:
+                        if st.button('Excluir', use_container_width=True, key=f'excluir_{livro.id}'):
+                            st.session_state.livro_funcao = 'livro_excluir'
+                            st.session_state.livro_funcao_excluir = livro.id
+                            st.rerun()
+
+    def editar_livro(self, livro: Livro, versao: int) -> Livro:
+        st.markdown('#### Sobre o livro')
+        colunas = st.columns([0.6, 0.4])
+        with colunas[0]:
+            titulo = st.text_input(
+                'Titulo *', placeholder='Viagem ao centro da terra', value=livro.titulo, key=f'livro_{livro.id}_titulo')
+            autor = st.text_input(
+                'Autor *', placeholder='Júlio Verne', value=livro.autor, key=f'livro_{livro.id}_autor')
+            genero = st.text_input(
+                'Genêro *', placeholder='Aventura, Ficção', value=livro.genero, key=f'livro_{livro.id}_genero')
+
+        with colunas[1]:
+            exibir_capa(livro, miniatura=False)
+            st.caption(
+                'Caso deseje atualizar a imagem capture uma nova imagem')
+            foto_livro = st.camera_input(
+                'Adicione uma foto da capa livro *', key=f'livro_{livro.id}_foto')
+
+        observacao = st.text_area(
+            'Observações ou qualquer coisa que queira dizer sobre o livro',
+            placeholder="""Edição com ilustrações, capa dura, folhas em papel especial e etc.\nHistória de uma viagem, literalmente, ao centro da terra""",
+            value=livro.observacao,
+            key=f'livro_{livro.id}_observacao'
+        )
+
+        st.markdown('### Sobre o doador')
+        pessoas_doadores = Usuario.colunas('id', 'nome', ordem='nome')
+
+        if pessoas_doadores:
+            nomes_doadores = {doador.id: f'({doador.id}) {doador.nome}' for doador in pessoas_doadores}
+            pessoas_doadores_id = list(nomes_doadores)
+            index_lista = pessoas_doadores_id.index(
+                livro.doador_id) if livro.doador_id in nomes_doadores else None
+
+            doador_id = st.selectbox(
+                'Doador',
+                options=pessoas_doadores_id,
+                format_func=nomes_doadores.get,
+                placeholder="Comece a digitar o nome para encontrar mais rapido...",
+                index=index_lista,
+                key=f'livro_{livro.id}_doador'
+            )
+            st.info(
+                'Doador não listado? Cadastre-o antes em "Pessoas"')
+        else:
+            doador_id = None
+            st.warning(
+                'Antes de continuar, cadastre uma pessoa doadora em "Pessoas"')
+
+        botoes = st.columns(2)
+        with botoes[0]:
+            salvar = st.button('Salvar alterações', use_container_width=True, key=f'salvar_{livro.id}')
+        with botoes[1]:
+            st.button('Cancelar', use_container_width=True, key=f'cancelar_{livro.id}',
+                      on_click=self._cancelar, args=(livro.id,))
+
+        if salvar:
+            if not all([titulo, autor, genero, doador_id]):
+                st.error(
+                    'Ficou faltando algumas informações, observe o "*"')
+            else:
+                edicao = {
+                    'titulo': titulo,
+                    'autor': autor,
+                    'genero': genero,
+                    'doador_id': doador_id,
+                    'observacao': observacao,
+                }
+                if foto_livro:
+                    edicao['foto_livro'] = foto_livro.getvalue()
+
+                try:
+                    livro = livro.editar(edicao=edicao, versao=versao)
+                except ConflitoEdicao as e:
+                    avisar_conflito(livro, e)
+                    return livro
+
+                if livro:
+                    # O cartão passa a exibir a versão gravada agora
+                    versao_vista(livro)
+                    st.session_state[f'livro_card_editando_{livro.id}'] = False
+                else:
+                    st.error(
+                        'Houve problemas ao editar o livro')
+        return livro
@@ -0,0 +1,60 @@
+import pandas as pd
+import streamlit as st
+
+from models import Emprestimo
+
+
+class Estatisticas:
+    nome = 'Estatísticas'
+
+    def __init__(self) -> None:
+        super().__init__()
+        st.header('Estatísticas', anchor=False, divider='orange')
+        # Tudo vem das contagens mantidas a cada empréstimo, nunca do histórico inteiro
+        self.resumo()
+        self.por_mes()
+        self.mais_frequentes()
+
+    def resumo(self):
+        totais = Emprestimo.totais()
+        emprestimos = totais.get('emprestimos', 0)
+        devolucoes = totais.get('devolucoes', 0)
+        atrasados = totais.get('devolvidos_com_atraso', 0)
+
+        coluna_emprestimos, coluna_devolucoes, coluna_atraso, coluna_adiamentos = st.columns(4)
+        coluna_emprestimos.metric('Empréstimos', emprestimos)
+        coluna_devolucoes.metric('Devoluções', devolucoes)
+        coluna_atraso.metric(
+            'Devolvidos com atraso',
+            f'{atrasados / devolucoes:.0%}' if devolucoes else '-',
+            help='Proporção das devoluções feitas depois da data combinada'
+        )
+        coluna_adiamentos.metric('Prazos adiados', totais.get('adiamentos', 0))
+
+    def por_mes(self):
+        st.markdown('#### Empréstimos por mês')
+        meses = Emprestimo.por_mes()
+        if not meses:
+            st.caption('Nenhum empréstimo registrado ainda')
+            return
+        st.bar_chart(
+            pd.DataFrame(meses, columns=['Mês', 'Empréstimos', 'Devoluções', 'Com atraso']).set_index('Mês')
+        )
+
+    def mais_frequentes(self):
+        for coluna, (titulo, dimensao, rotulo) in zip(st.columns(3), [
+            ('Livros mais emprestados', 'livro', 'Livro'),
+            ('Gêneros mais emprestados', 'genero', 'Gênero'),
+            ('Doadores cujos livros mais circulam', 'doador', 'Doador'),
+        ]):
+            with coluna:
+                st.markdown(f'#### {titulo}')
+                frequentes = Emprestimo.mais_frequentes(dimensao)
+                if frequentes:
+                    st.dataframe(
+                        pd.DataFrame(frequentes, columns=[rotulo, 'Empréstimos']),
+                        hide_index=True,
+                        use_container_width=True
+                    )
+                else:
+                    st.caption('Nada por aqui ainda')
@@ -1,48 +1,157 @@
 
-from models import Usuario, Emprestimo
+from models import Usuario, Emprestimo, ConflitoEdicao
 import streamlit as st
-from re import fullmatch
-from streamlit_extras.stylable_container import stylable_container
-from container.container_estilizado import tagger_component 
+from container.container_estilizado import TAGGER_COLOR_PALETTE
+from container.paginacao import Paginacao
+from container.fragmento import fragmento, reexecucao_parcial
+from container.versao import versao_vista, avisar_conflito
+from functools import lru_cache, partial
+from html import escape
 
 
+# O bloco do streamlit que contém diretamente o marcador `pessoa-card` é a
+# borda do cartão; o mesmo estilo serve a todos os cartões da página
+SELETOR_CARTAO = (
+    'div[data-testid="stVerticalBlock"]:has(> div.element-container > div.stMarkdown'
+    ' > div[data-testid="stMarkdownContainer"] > p > span.pessoa-card)'
+)
+ESTILO_CARTOES = f"""
+<style>
+{SELETOR_CARTAO} {{
+    border: 1px solid rgba(250, 250, 250, 0.2);
+    border-radius: 0.5rem;
+    padding: calc(1em - 1px)
+}}
+{SELETOR_CARTAO} > div:first-child {{
+    margin-bottom: -1rem;
+}}
+span.pessoa-genero {{
+    display: inline-block;
+    background-color: {TAGGER_COLOR_PALETTE['orange']};
+    padding: 0.1rem 0.5rem;
+    font-size: 14px;
+    font-weight: 400;
+    color: white;
+    margin: 5px;
+    border-radius: 1rem;
+}}
+</style>
+"""
+
+
+def estilo_cartoes():
+    # Uma vez por página, antes dos cartões
+    st.markdown(ESTILO_CARTOES, unsafe_allow_html=True)
+
+
+def container_with_border():
+    container = st.container()
+    container.markdown('<span class="pessoa-card"></span>', unsafe_allow_html=True)
+    return container
+
+
+@lru_cache(maxsize=1024)
+def etiquetas_generos(generos: tuple[str, ...]) -> str:
+    return 'Genêros ' + ''.join(f'<span class="pessoa-genero">{escape(genero)}</span>' for genero in generos)
 
-def container_with_border(key:str):
-    return stylable_container(
-        key=key,
-        css_styles="""
-            {
-                border: 1px solid rgba(250, 250, 250, 0.2);
-                border-radius: 0.5rem; 
-                padding: calc(1em - 1px)
-            }
-        """,
-    )
-    
 
 
 class PessoaCard:
-    def __init__(self, usuario:Usuario) -> None:
-        with container_with_border(key=usuario.chave_container):
-            colunas = st.columns([0.1,0.5, 0.4])
-            with colunas[0]: st.write(usuario.id)
-            with colunas[1]: st.write(usuario.nome)
-            with colunas[2]: st.write(usuario.email)
-            generos = usuario.genero_preferidos.upper().split(',')
-            tagger_component('Genêros', generos, ['orange']*len(generos))
+    def __init__(self, usuario:Usuario, generos: tuple[str, ...]) -> None:
+        # Editar reexecuta só este cartão
+        self.usuario_id = usuario.id
+        self.usuario = usuario
+        self.generos = generos
+        self.chave_edicao = f'pessoa_card_editando_{usuario.id}'
+        fragmento(self.exibir)()
+
+    def _editar(self):
+        st.session_state[self.chave_edicao] = True
+
+    def _cancelar(self):
+        st.session_state[self.chave_edicao] = False
 
+    def exibir(self):
+        usuario = self.usuario
+        generos = self.generos
+        if reexecucao_parcial():
+            usuario = Usuario.obter(self.usuario_id)
+            if usuario is None:
+                return
+            generos = Usuario.generos_por_usuario([self.usuario_id]).get(self.usuario_id, ())
+        versao = versao_vista(usuario)
+
+        with container_with_border():
+            cartao = st.empty()
+            if st.session_state.get(self.chave_edicao):
+                with cartao.container():
+                    usuario = self.editar(usuario, versao)
+                if not st.session_state.get(self.chave_edicao):
+                    st.success('Editado com sucesso')
+                    generos = Usuario.generos_por_usuario([usuario.id]).get(usuario.id, ())
+
+            if not st.session_state.get(self.chave_edicao):
+                with cartao.container():
+                    self.visualizar(usuario, generos)
+
+    def visualizar(self, usuario: Usuario, generos: tuple[str, ...]):
+        colunas = st.columns([0.1,0.5, 0.4])
+        with colunas[0]: st.write(usuario.id)
+        with colunas[1]: st.write(usuario.nome)
+        with colunas[2]: st.write(usuario.email)
+        st.markdown(etiquetas_generos(generos), unsafe_allow_html=True)
+
+        botoes = st.columns(2)
+        with botoes[0]:
+            st.button('Editar', use_container_width=True, key=f'editar_{usuario.id}', on_click=self._editar)
+
+        with botoes[1]:
+            if st.button('Excluir', use_container_width=True, key=f'excluir_{usuario.id}'):
+                st.session_state.pessoa_funcao = 'pessoa_excluir'
+                st.session_state.pessoa_funcao_excluir = usuario.id
+                st.rerun()
+
+    def editar(self, usuario: Usuario, versao: int) -> Usuario:
+        with st.form(f'editar_pessoa_{usuario.id}'):
+            nome = st.text_input('Nome*', value=usuario.nome, key=f'pessoa_{usuario.id}_nome')
+            email = st.text_input('E-mail*', value=usuario.email, key=f'pessoa_{usuario.id}_email')
+            genero_preferidos = st.text_input(
+                'Genêros literários preferidos', value=usuario.genero_preferidos,
+                key=f'pessoa_{usuario.id}_generos')
             botoes = st.columns(2)
             with botoes[0]:
-                if st.button('Editar', use_container_width=True, key=f'editar_{usuario.id}'):
-                    st.session_state.pessoa_funcao = 'pessoa_editar'
-                    st.session_state.pessoa_funcao_editar = usuario
-                    st.rerun()
-
+                editado = st.form_submit_button("Salvar alterações", use_container_width=True)
             with botoes[1]:
-                if st.button('Excluir', use_container_width=True, key=f'excluir_{usuario.id}'):
-                    st.session_state.pessoa_funcao = 'pessoa_excluir'
-                    st.session_state.pessoa_funcao_excluir = usuario
-                    st.rerun()
+                st.form_submit_button('Cancelar', use_container_width=True, on_click=self._cancelar)
+
+        if editado:
+            if (not nome) or (not email):
+                st.error(
+                    'Ficou faltando algumas informações, observe o "*"')
+            elif not Usuario.email_valido(email):
+                st.error(
+                    'Confirme se o e-mail digitado é valido')
+            else:
+                try:
+                    usuario = usuario.editar(edicao={
+                            'nome': nome,
+                            'email': email,
+                            'genero_preferidos': genero_preferidos
+                        },
+                        versao=versao
+                    )
+                except ConflitoEdicao as e:
+                    avisar_conflito(usuario, e)
+                    return usuario
+
+                if usuario:
+                    # O cartão passa a exibir a versão gravada agora
+                    versao_vista(usuario)
+                    st.session_state[self.chave_edicao] = False
+                else:
+                    st.error(
+                        'Houve problemas ao editar o usuário')
+        return usuario
 
 
 
@@ -57,7 +166,6 @@ class Pessoas:
         self.titulo()
         self.visualizar_pessoa()
         self.excluir_pessoa()
-        self.editar_pessoa()
         self.adicionar_pessoa()
 
     def estrutura(self):
@@ -66,7 +174,6 @@ class Pessoas:
 
         self.placeholder_titulo = st.empty()
         self.placeholder_adicionar = st.empty()
-        self.placeholder_editar = st.empty()
         self.placeholder_excluir = st.empty()
         self.placeholder_visualizar = st.empty()
 
@@ -90,18 +197,37 @@ class Pessoas:
     def visualizar_pessoa(self):
         if st.session_state.pessoa_funcao == 'pessoa_visualizar':
             with self.placeholder_visualizar.container():
-                usuarios = Usuario.retornar()
-                for usuario in usuarios:
-                    PessoaCard(usuario)
+                estilo_cartoes()
+                termo = st.text_input(
+                    'Buscar pessoa',
+                    key='pessoas_busca_termo',
+                    placeholder='Nome ou e-mail...'
+                )
+                if termo.strip():
+                    usuarios = Usuario.buscar(termo, limite=20)
+                    if not usuarios:
+                        st.caption('Nenhuma pessoa encontrada')
+                    generos = Usuario.generos_por_usuario([usuario.id for usuario in usuarios])
+                    for usuario in usuarios:
+                        PessoaCard(usuario, generos.get(usuario.id, ()))
+                else:
+                    paginacao = Paginacao('pessoas', partial(Usuario.paginar, ordem='nome'))
+                    generos = Usuario.generos_por_usuario([usuario.id for usuario in paginacao.itens])
+                    for usuario in paginacao.itens:
+                        PessoaCard(usuario, generos.get(usuario.id, ()))
+                    paginacao.controles()
 
     def excluir_pessoa(self):
         if st.session_state.pessoa_funcao == 'pessoa_excluir':
             with self.placeholder_excluir.container():
-                if st.session_state.pessoa_funcao_excluir is None:
+                usuario = None
+                if st.session_state.pessoa_funcao_excluir is not None:
+                    usuario = Usuario.obter(st.session_state.pessoa_funcao_excluir)
+
+                if usuario is None:
                     st.session_state.pessoa_funcao = 'pessoa_visualizar'
                 else:
-                    usuario = st.session_state.pessoa_funcao_excluir
-
+                    versao = versao_vista(usuario)
                     with st.expander(f'##### Excluir #{str(usuario.id)} {usuario.nome}', expanded=True):
                         st.warning('A exclusão é definitiva')
                         emprestimos_pendentes = Emprestimo.retornar_por_leitor(usuario)
@@ -122,7 +248,11 @@ class Pessoas:
 
                         if botao_excluir:
                             if texto_confirmacao == 'excluir':
-                                excluido = usuario.excluir()
+                                try:
+                                    excluido = usuario.excluir(versao=versao)
+                                except ConflitoEdicao as e:
+                                    avisar_conflito(usuario, e)
+                                    return
                                 if excluido:
                                     st.info('Excluido com sucesso')
                                     st.session_state.pessoa_funcao_excluir = None
@@ -134,43 +264,6 @@ class Pessoas:
                                 st.error(
                                     'Digite "excluir", para termos certeza que deseja tomar esta ação definitiva.')
 
-    def editar_pessoa(self):
-        if st.session_state.pessoa_funcao == 'pessoa_editar':
-            with self.placeholder_editar.container():
-                if st.session_state.pessoa_funcao_editar is None:
-                    st.session_state.pessoa_funcao = 'pessoa_visualizar'
-                else:
-                    usuario = st.session_state.pessoa_funcao_editar
-                    with st.expander(f'##### Editar #{str(usuario.id)} {usuario.nome}', expanded=True):
-                        nome = st.text_input('Nome*', value=usuario.nome)
-                        email = st.text_input('E-mail*', value=usuario.email)
-                        genero_preferidos = st.text_input(
-                            'Genêros literários preferidos', value=usuario.genero_preferidos)
-                        editado = st.button(
-                            "Salvar alterações", key=f'editando_{usuario.id}')
-                        if editado:
-                            if (not nome) or (not email):
-                                st.error(
-                                    'Ficou faltando algumas informações, observe o "*"')
-                            elif not fullmatch(r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+', email):
-                                st.error(
-                                    'Confirme se o e-mail digitado é valido')
-                            else:
-                                resultado_edicao = usuario.editar(edicao={
-                                        'nome': nome,
-                                        'email': email,
-                                        'genero_preferidos': genero_preferidos
-                                    }
-                                )
-
-                                if resultado_edicao:
-                                    st.success('Editado com sucesso')
-                                    st.session_state.pessoa_funcao_editar = None
-                                else:
-                                    st.error(
-                                        'Houve problemas ao editar o usuário')
-                                    st.session_state.pessoa_funcao_editar = None
-
     def adicionar_pessoa(self):
         if st.session_state.pessoa_funcao == 'pessoa_adicionar':
             with self.placeholder_adicionar.container():
@@ -187,7 +280,7 @@ class Pessoas:
                         if (not nome) or (not email):
                             st.error(
                                 'Ficou faltando algumas informações, observe o "*"')
-                        elif not fullmatch(r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+', email):
+                        elif not Usuario.email_valido(email):
                             st.error('Confirme se o e-mail digitado é valido')
                         else:
                             novo = Usuario.adicionar(nome=nome, email=email, genero_preferidos=genero_preferidos)
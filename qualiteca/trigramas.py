@@ -0,0 +1,46 @@
+"""
+Trigramas de titulo + autor para encontrar livros parecidos.
+
+O texto é normalizado (minúsculas, sem acentos nem pontuação) e cada palavra,
+com dois espaços antes e um depois, é quebrada em sequências de 3 caracteres.
+Dois livros são comparados pela proporção de trigramas em comum (Jaccard).
+"""
+import re
+import unicodedata
+
+from sqlalchemy import Table, delete, insert
+from sqlalchemy.engine import Connection
+
+
+def normalizar(texto: str) -> str:
+    sem_acentos = unicodedata.normalize('NFKD', texto or '').encode('ascii', 'ignore').decode()
+    return ' '.join(re.findall(r'[a-z0-9]+', sem_acentos.lower()))
+
+
+def trigramas(*textos: str) -> set[str]:
+    resultado = set()
+    for palavra in normalizar(' '.join(texto or '' for texto in textos)).split():
+        palavra = f'  {palavra} '
+        resultado.update(palavra[posicao:posicao + 3] for posicao in range(len(palavra) - 2))
+    return resultado
+
+
+def similaridade(comuns: int, total_a: int, total_b: int) -> float:
+    return comuns / (total_a + total_b - comuns) if comuns else 0.0
+
+
+def indexar(conexao: Connection, tabela: Table, livros: list[tuple[int, str, str]]):
+    # Substitui os trigramas dos livros informados como (id, titulo, autor)
+    remover(conexao, tabela, [id for id, _, _ in livros])
+    linhas = [
+        {'trigrama': trigrama, 'livro_id': id}
+        for id, titulo, autor in livros
+        for trigrama in trigramas(titulo, autor)
+    ]
+    if linhas:
+        conexao.execute(insert(tabela), linhas)
+
+
+def remover(conexao: Connection, tabela: Table, livros_id: list[int]):
+    if livros_id:
+        conexao.execute(delete(tabela).where(tabela.c.livro_id.in_(livros_id)))
@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# Os módulos do app se importam pelo nome, como quando o streamlit roda a partir de qualiteca/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'qualiteca'))
+
+from models import banco_atual, encerrar_sessao, usar_banco
+
+
+@pytest.fixture
+def banco(tmp_path):
+    # Banco novo, só deste teste, na sessão da thread
+    banco = usar_banco(str(tmp_path / 'biblioteca.db'))
+    yield banco
+    banco_atual().fechar()
+    encerrar_sessao()
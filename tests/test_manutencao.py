@@ -0,0 +1,52 @@
+import sqlite3
+from datetime import date, timedelta
+
+from sqlalchemy import text
+
+from manutencao import arquivar
+from models import Emprestimo, Livro, Usuario, session
+
+
+def test_arquivar_move_os_antigos_para_o_arquivo(banco, tmp_path):
+    # O arquivamento troca a sessão, então o teste guarda só os ids
+    ana, bruno, carla = (
+        Usuario.adicionar(nome=nome, email=f'{nome.lower()}@exemplo.com', genero_preferidos='Ficção').id
+        for nome in ('Ana', 'Bruno', 'Carla')
+    )
+    excluido, mantido, _ = (
+        Livro.adicionar(titulo=titulo, autor='Autor', genero='Ficção', doador_id=carla).id
+        for titulo in ('Excluído', 'Mantido', 'Último')
+    )
+    antigo = date.today() - timedelta(days=365 * 6)
+    emprestimos = [
+        Emprestimo.adicionar(leitor_id=bruno, livro_id=livro_id, emprestado_em=emprestado_em,
+                             devolucao_em=emprestado_em + timedelta(days=7), vezes_adiado=0).id
+        for livro_id, emprestado_em in [(mantido, antigo), (excluido, antigo), (mantido, date.today())]
+    ]
+    Emprestimo.devolver_muitos({id: 1 for id in emprestimos[:2]})
+    # Devolvido há mais de 5 anos, e excluídos há mais de 90 dias
+    session.execute(text('UPDATE emprestimos SET devolvido_em = :data WHERE id IN (:a, :b)'),
+                    {'data': antigo + timedelta(days=3), 'a': emprestimos[0], 'b': emprestimos[1]})
+    for tabela, id in [('usuarios', ana), ('livros', excluido)]:
+        session.execute(text(f"UPDATE {tabela} SET excluido_em = '2000-01-01 00:00:00.000000' WHERE id = :id"),
+                        {'id': id})
+    session.commit()
+
+    caminho = tmp_path / 'arquivo.db'
+    resultado = arquivar(caminho_arquivo=str(caminho))
+
+    assert (resultado['usuarios'], resultado['livros'], resultado['emprestimos']) == (1, 1, 2)
+    assert Usuario.obter(ana) is None
+    assert Livro.obter(excluido) is None
+    assert [emprestimo.id for emprestimo in Emprestimo.retornar()] == [emprestimos[2]]
+    assert Livro.obter(mantido).titulo == 'Mantido'
+    # As ligações dos arquivados saem junto
+    assert Usuario.generos_por_usuario([ana]) == {}
+    assert session.execute(text('SELECT count(*) FROM livros_trigramas WHERE livro_id = :id'),
+                           {'id': excluido}).scalar() == 0
+
+    with sqlite3.connect(caminho) as conexao:
+        assert conexao.execute('SELECT id FROM usuarios').fetchall() == [(ana,)]
+        assert conexao.execute('SELECT id FROM livros').fetchall() == [(excluido,)]
+        assert conexao.execute('SELECT id FROM emprestimos ORDER BY id').fetchall() == [
+            (emprestimos[0],), (emprestimos[1],)]
@@ -0,0 +1,128 @@
+import sqlite3
+from io import BytesIO
+
+import pytest
+from PIL import Image
+from sqlalchemy import create_engine, inspect
+
+from migracoes import MIGRACOES
+from models import Base, Livro, banco_atual, encerrar_sessao, usar_banco
+
+# Esquema de antes da primeira migração, como os bancos em uso foram criados
+ESQUEMA_INICIAL = """
+CREATE TABLE usuarios (
+    nome VARCHAR NOT NULL,
+    email VARCHAR NOT NULL,
+    genero_preferidos VARCHAR,
+    id INTEGER NOT NULL,
+    registrado_em DATETIME NOT NULL,
+    editado_em DATETIME,
+    excluido_em DATETIME,
+    PRIMARY KEY (id)
+);
+CREATE TABLE livros (
+    titulo VARCHAR NOT NULL,
+    autor VARCHAR NOT NULL,
+    genero VARCHAR NOT NULL,
+    doador_id INTEGER NOT NULL,
+    foto_livro BLOB NOT NULL,
+    observacao VARCHAR,
+    extensao_foto VARCHAR NOT NULL,
+    id INTEGER NOT NULL,
+    registrado_em DATETIME NOT NULL,
+    editado_em DATETIME,
+    excluido_em DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(doador_id) REFERENCES usuarios (id)
+);
+CREATE TABLE emprestimos (
+    leitor_id INTEGER NOT NULL,
+    livro_id INTEGER NOT NULL,
+    emprestado_em DATE NOT NULL,
+    devolucao_em DATE NOT NULL,
+    devolvido_em DATE,
+    vezes_adiado INTEGER,
+    id INTEGER NOT NULL,
+    registrado_em DATETIME NOT NULL,
+    editado_em DATETIME,
+    excluido_em DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY(leitor_id) REFERENCES usuarios (id),
+    FOREIGN KEY(livro_id) REFERENCES livros (id)
+);
+"""
+
+
+def _foto() -> bytes:
+    arquivo = BytesIO()
+    Image.new('RGB', (40, 60), 'navy').save(arquivo, format='JPEG')
+    return arquivo.getvalue()
+
+
+def _esquema(caminho) -> dict[str, tuple[set[str], set[str]]]:
+    # Colunas e índices de cada tabela do modelo
+    engine = create_engine(f'sqlite:///{caminho}')
+    try:
+        inspetor = inspect(engine)
+        return {
+            tabela: (
+                {coluna['name'] for coluna in inspetor.get_columns(tabela)},
+                {indice['name'] for indice in inspetor.get_indexes(tabela)},
+            )
+            for tabela in Base.metadata.tables
+        }
+    finally:
+        engine.dispose()
+
+
+@pytest.fixture
+def banco_inicial(tmp_path):
+    caminho = tmp_path / 'antigo.db'
+    with sqlite3.connect(caminho) as conexao:
+        conexao.executescript(ESQUEMA_INICIAL)
+        conexao.executemany(
+            'INSERT INTO usuarios (id, nome, email, genero_preferidos, registrado_em) VALUES (?, ?, ?, ?, ?)',
+            [
+                (1, 'Ana', 'ana@exemplo.com', 'Ficção, romance', '2023-01-10 09:00:00.000000'),
+                (2, 'Bruno', 'bruno@exemplo.com', None, '2023-01-11 09:00:00.000000'),
+            ]
+        )
+        conexao.execute(
+            'INSERT INTO livros (id, titulo, autor, genero, doador_id, foto_livro, extensao_foto, registrado_em) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (1, 'Dom Casmurro', 'Machado de Assis', 'ficcao, Clássico', 1, _foto(), 'jpg', '2023-01-12 09:00:00.000000')
+        )
+        conexao.executemany(
+            'INSERT INTO emprestimos (id, leitor_id, livro_id, emprestado_em, devolucao_em, devolvido_em, '
+            'vezes_adiado, registrado_em) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (1, 2, 1, '2023-02-01', '2023-02-15', '2023-02-20', 1, '2023-02-01 10:00:00.000000'),
+                (2, 2, 1, '2023-03-01', '2023-03-15', None, 0, '2023-03-01 10:00:00.000000'),
+            ]
+        )
+    yield caminho
+    banco_atual().fechar()
+    encerrar_sessao()
+
+
+def test_banco_inicial_chega_a_ultima_versao(banco_inicial, tmp_path):
+    usar_banco(str(banco_inicial))
+
+    with sqlite3.connect(banco_inicial) as conexao:
+        assert conexao.execute('PRAGMA user_version').fetchone()[0] == max(MIGRACOES)
+        assert conexao.execute('SELECT livro_id, extensao FROM capas').fetchall() == [(1, 'jpg')]
+        assert conexao.execute('SELECT disponivel FROM livros WHERE id = 1').fetchone()[0] == 0
+        assert {chave for chave, in conexao.execute('SELECT chave FROM generos')} == {'ficcao', 'romance', 'classico'}
+        assert conexao.execute(
+            "SELECT valor FROM estatisticas WHERE dimensao = 'total' AND chave = 'devolvidos_com_atraso'"
+        ).fetchone()[0] == 1
+
+    # O banco migrado tem as mesmas colunas e índices de um criado do zero
+    novo = tmp_path / 'novo.db'
+    usar_banco(str(novo))
+    assert _esquema(banco_inicial) == _esquema(novo)
+
+    usar_banco(str(banco_inicial))
+    livro = Livro.obter(1)
+    assert (livro.titulo, livro.versao) == ('Dom Casmurro', 1)
+    assert banco_atual().nome_banco == str(banco_inicial)
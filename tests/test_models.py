@@ -0,0 +1,135 @@
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from models import ConflitoEdicao, Emprestimo, Livro, Usuario, session
+
+
+@pytest.fixture
+def acervo(banco):
+    ana = Usuario.adicionar(nome='Ana', email='ana@exemplo.com', genero_preferidos='Ficção, romance')
+    bruno = Usuario.adicionar(nome='Bruno Souza', email='bruno@exemplo.com')
+    livros = [
+        Livro.adicionar(titulo=titulo, autor=autor, genero=genero, doador_id=ana.id)
+        for titulo, autor, genero in [
+            ('Dom Casmurro', 'Machado de Assis', 'Ficção'),
+            ('Memórias Póstumas de Brás Cubas', 'Machado de Assis', 'ficcao, Clássico'),
+            ('Vidas Secas', 'Graciliano Ramos', 'Romance'),
+        ]
+    ]
+    return ana.id, bruno.id, [livro.id for livro in livros]
+
+
+def _emprestar(leitor_id: int, livro_id: int, prazo: int = 7) -> int:
+    hoje = date.today()
+    return Emprestimo.adicionar(
+        leitor_id=leitor_id, livro_id=livro_id, emprestado_em=hoje,
+        devolucao_em=hoje + timedelta(days=prazo), vezes_adiado=0
+    ).id
+
+
+def test_cache_serve_a_leitura_ate_a_tabela_mudar(banco, acervo):
+    ana_id, _, _ = acervo
+    assert Usuario.obter(ana_id).nome == 'Ana'
+    acertos = banco.cache.estatisticas()['acertos']
+    assert Usuario.obter(ana_id).nome == 'Ana'
+    assert banco.cache.estatisticas()['acertos'] == acertos + 1
+
+    Usuario.obter(ana_id).editar({'nome': 'Ana Maria'})
+    assert Usuario.obter(ana_id).nome == 'Ana Maria'
+
+    # O UPDATE em massa também avança a geração da tabela
+    Usuario.editar_muitos({'nome': 'Ana Clara'}, valor=ana_id)
+    assert Usuario.obter(ana_id).nome == 'Ana Clara'
+    assert Usuario.generos_por_usuario([ana_id]) == {ana_id: ('FICÇÃO', 'ROMANCE')}
+
+
+def test_disponibilidade_acompanha_os_emprestimos(banco, acervo):
+    _, bruno_id, (livro_id, *_) = acervo
+    emprestimo_id = _emprestar(bruno_id, livro_id)
+    assert not Livro.obter(livro_id).disponivel
+    assert livro_id not in [livro.id for livro in Livro.disponiveis()]
+
+    Emprestimo.obter(emprestimo_id).devolver()
+    assert Livro.obter(livro_id).disponivel
+
+
+def test_reparar_disponibilidade_corrige_os_divergentes(banco, acervo):
+    _, bruno_id, (emprestado_id, livre_id, _) = acervo
+    _emprestar(bruno_id, emprestado_id)
+    # Escritas fora do app não passam pela manutenção de `disponivel`
+    session.execute(text('UPDATE livros SET disponivel = NOT disponivel WHERE id IN (:a, :b)'),
+                    {'a': emprestado_id, 'b': livre_id})
+    session.commit()
+
+    assert Emprestimo.reparar_disponibilidade() == 2
+    assert not Livro.obter(emprestado_id).disponivel
+    assert Livro.obter(livre_id).disponivel
+    assert Emprestimo.reparar_disponibilidade() == 0
+
+
+def test_editar_com_versao_antiga_gera_conflito(banco, acervo):
+    ana_id, _, _ = acervo
+    vista = Usuario.obter(ana_id).versao
+    Usuario.obter(ana_id).editar({'nome': 'Ana Maria'}, versao=vista)
+
+    with pytest.raises(ConflitoEdicao):
+        Usuario.obter(ana_id).editar({'nome': 'Ana Clara'}, versao=vista)
+    usuario = Usuario.obter(ana_id)
+    assert (usuario.nome, usuario.versao) == ('Ana Maria', vista + 1)
+
+
+def test_devolver_muitos_ignora_versoes_antigas(banco, acervo):
+    _, bruno_id, livros_id = acervo
+    ids = [_emprestar(bruno_id, livro_id) for livro_id in livros_id]
+    versoes = {id: Emprestimo.obter(id).versao for id in ids}
+    # Alterado por outra pessoa depois de exibido
+    Emprestimo.obter(ids[0]).mais_prazo()
+
+    assert sorted(Emprestimo.devolver_muitos(versoes)) == ids[1:]
+    assert [Emprestimo.obter(id).devolvido for id in ids] == [False, True, True]
+    assert [Livro.obter(id).disponivel for id in livros_id] == [False, True, True]
+    totais = Emprestimo.totais()
+    assert (totais['emprestimos'], totais['devolucoes'], totais['adiamentos']) == (3, 2, 1)
+
+
+def test_mais_prazo_muitos_adia_e_conta_adiamentos(banco, acervo):
+    _, bruno_id, livros_id = acervo
+    ids = [_emprestar(bruno_id, livro_id) for livro_id in livros_id[:2]]
+    prazos = {id: Emprestimo.obter(id).devolucao_em for id in ids}
+
+    assert sorted(Emprestimo.mais_prazo_muitos({id: Emprestimo.obter(id).versao for id in ids}, 2)) == ids
+    for id in ids:
+        emprestimo = Emprestimo.obter(id)
+        assert emprestimo.devolucao_em == prazos[id] + timedelta(days=2)
+        assert emprestimo.vezes_adiado == 1
+    assert Emprestimo.totais()['adiamentos'] == 2
+
+    # As contagens mantidas a cada gravação batem com as recalculadas do zero
+    mantidas = (Emprestimo.totais(), Emprestimo.mais_frequentes('genero'))
+    Emprestimo.reconstruir_estatisticas()
+    assert (Emprestimo.totais(), Emprestimo.mais_frequentes('genero')) == mantidas
+
+
+def test_busca_textual_acompanha_as_edicoes(banco, acervo):
+    ana_id, bruno_id, _ = acervo
+    assert [usuario.id for usuario in Usuario.buscar('souz')] == [bruno_id]
+    assert [livro.titulo for livro in Livro.buscar('memorias')] == ['Memórias Póstumas de Brás Cubas']
+
+    Usuario.obter(ana_id).editar({'nome': 'Ana Souza'})
+    assert {usuario.id for usuario in Usuario.buscar('souza')} == {ana_id, bruno_id}
+
+    Usuario.obter(bruno_id).excluir()
+    assert [usuario.id for usuario in Usuario.buscar('souza')] == [ana_id]
+
+
+def test_parecidos_encontra_grafias_proximas(banco, acervo):
+    _, _, (dom_casmurro_id, memorias_id, _) = acervo
+    parecidos = Livro.parecidos('Dom Casmuro', 'Machado de Assis')
+    assert parecidos[0][0].id == dom_casmurro_id
+    assert parecidos[0][1] > 0.4
+    assert Livro.parecidos('Química Orgânica') == []
+
+    Livro.obter(dom_casmurro_id).excluir()
+    assert dom_casmurro_id not in [livro.id for livro, _ in Livro.parecidos('Dom Casmurro')]